@@ -4,11 +4,20 @@ from tqdm import tqdm
 import params
 import os
 import RPL_importer as RPLi
+import street_graph as sg
+import block_tracer as bt
+import spatial_index as si
+import street_names as sn
 import math
 import itertools
 from collections import defaultdict
 from datetime import datetime
 import getpass
+import csv
+import run_trace
+import pipeline
+import snapshot
+import argparse
 
 # ***TODO***
 # mft for the intersection of 2 rb streets is problematic ec. 63 st and queens blvd
@@ -94,6 +103,9 @@ def archive(dbo, lion=params.LION, node=params.NODE, schema=params.WORKING_SCHEM
                            u=getpass.getuser(), d=datetime.now().strftime('%Y-%m-%d %H:%M')))
 
 
+DISTRICT_TABLES = ['nycc', 'nyss', 'nynta', 'nypp']
+
+
 def import_districts(dbo, schema=params.WORKING_SCHEMA, folder=params.FOLDER):
     """
     Use DCP files NOT clipped to shoreline - USE water included to avoid problems with bridges 
@@ -132,7 +144,9 @@ def import_districts(dbo, schema=params.WORKING_SCHEMA, folder=params.FOLDER):
 
 @db2.timeDec
 def setup_database(dbo, lion=params.LION, node=params.NODE, version=params.VERSION, rpl=params.RPL_TXT,
-                   schema=params.WORKING_SCHEMA, folder=params.FOLDER):
+                   schema=params.WORKING_SCHEMA, folder=params.FOLDER, districts=True):
+    # districts=False leaves import_districts and add_districts to be run separately (the pipeline runs them
+    # alongside other stages)
     # clear tables if exist
     tables = [lion, node, rpl[:-4]]
     for table in tables:
@@ -173,26 +187,31 @@ def setup_database(dbo, lion=params.LION, node=params.NODE, version=params.VERSI
     # add RPL table
     RPLi.run(dbo, folder, rpl)
     # add districts
-    import_districts(dbo, schema=schema, folder=folder)
+    if districts:
+        import_districts(dbo, schema=schema, folder=folder)
 
     # add version
-    add_version(dbo, schema, version, [lion, node, 'tbl_'+rpl[:-4], 'nycc', 'nyss', 'nynta', 'nypp'])
+    add_version(dbo, schema, version, [lion, node, 'tbl_'+rpl[:-4]] + (DISTRICT_TABLES if districts else []))
     # add master id columns
     add_clion_columns(dbo, schema, lion, node)
     # add districts
-    add_districts(dbo, schema, lion)
+    if districts:
+        add_districts(dbo, schema, lion)
 
 
 def add_version(dbo, schema=params.WORKING_SCHEMA, version=params.VERSION,
                 tables=[params.LION, params.NODE, 'tbl_'+params.RPL_TXT[:-4]]):
     # update lion, node and rpl with version number
     # tables = [lion, node, 'tbl_'+rpl[:-4]]
+    print 'Updating {}...'.format(', '.join(tables))
+    statements = ["SET timezone = 'America/New_York'"]
     for table in tables:
-        print 'Updating {}...'.format(table)
-        dbo.query("ALTER TABLE {s}.{t} ADD if not exists version varchar(5)".format(s=schema, t=table))
-        dbo.query("ALTER TABLE {s}.{t} ADD if not exists created TIMESTAMP; SET timezone = 'America/New_York';".format(
-            s=schema, t=table))
-        dbo.query("UPDATE {s}.{t} set version = '{v}', created = now()".format(s=schema, t=table, v=version))
+        statements += [
+            "ALTER TABLE {s}.{t} ADD if not exists version varchar(5)".format(s=schema, t=table),
+            "ALTER TABLE {s}.{t} ADD if not exists created TIMESTAMP".format(s=schema, t=table),
+            "UPDATE {s}.{t} set version = '{v}', created = now()".format(s=schema, t=table, v=version)
+        ]
+    dbo.batch(statements)
 
 
 def add_clion_columns(dbo, schema=params.WORKING_SCHEMA, lion=params.LION, node=params.NODE):
@@ -212,7 +231,10 @@ def add_clion_columns(dbo, schema=params.WORKING_SCHEMA, lion=params.LION, node=
                  add column lntacode varchar(10),
                  add column rntacode varchar(10),
                  add column lprecinct int,
-                 add column rprecinct int
+                 add column rprecinct int,
+                 -- filled by the corridor stages, added here so they only update lion
+                 add column corridor_street text,
+                 add column cid text
                  """.format(
         schema, lion))
     dbo.query("""alter table {0}.{1} 
@@ -223,102 +245,165 @@ def add_clion_columns(dbo, schema=params.WORKING_SCHEMA, lion=params.LION, node=
 
 
 @db2.timeDec
-def add_districts(dbo, schema=params.WORKING_SCHEMA, lion=params.LION):
+def add_districts(dbo, schema=params.WORKING_SCHEMA, lion=params.LION, pool=None):
     print 'Adding Districts...'
-    # update city council districts
+    # (district table, id field, left field, right field, buffered geom, label)
+    # added st_makevalid because there was an issue with 61st PCT
+    # pct boundaries are not cleanly drawn so larger buffer is needed
+    districts = [
+        ('nycc', 'coundist', 'lcoundist', 'rcoundist', 'st_buffer(geom, 10)', 'City Council districts'),
+        ('nynta', 'ntacode', 'lntacode', 'rntacode', 'st_buffer(geom, 10)', 'NTAs'),
+        ('nypp', 'precinct', 'lprecinct', 'rprecinct', 'st_buffer(st_makevalid(geom), 25)', 'Police Precincts'),
+        ('nyss', 'stsendist', 'lstsendist', 'rstsendist', 'st_buffer(geom, 10)', 'State Senate districts')
+    ]
+    # buffered polygons of every layer in 1 table, plus the same polygons cut into small pieces
+    dbo.batch([
+        "drop table if exists {s}.district_buf".format(s=schema),
+        "create table {s}.district_buf (buf_id serial primary key, layer text, district text, geom geometry)".format(
+            s=schema),
+        "drop table if exists {s}.district_piece".format(s=schema),
+        "create table {s}.district_piece (buf_id int, geom geometry)".format(s=schema)
+    ])
+    # layers are independent, buffer and subdivide them at the same time
+    pool_db = pool or db2.PostgresPool(dbo, min(params.DB_POOL_SIZE, len(districts)))
+    pool_db.query(["""
+        with buf as (
+            insert into {s}.district_buf (layer, district, geom)
+            select '{t}', {f}::text, {g} from {s}.{t}
+            returning buf_id, geom
+        )
+        insert into {s}.district_piece select buf_id, st_subdivide(geom, 64) from buf
+    """.format(s=schema, t=tbl, f=field, g=buf) for tbl, field, lf, rf, buf, label in districts])
+    if not pool:
+        pool_db.close()
+    dbo.batch([
+        "CREATE INDEX district_piece_idx ON {s}.district_piece USING gist (geom)".format(s=schema),
+        "CREATE INDEX district_piece_buf_idx ON {s}.district_piece (buf_id)".format(s=schema),
+        "analyze {s}.district_buf".format(s=schema),
+        "analyze {s}.district_piece".format(s=schema)
+    ])
+    # every (segment, district) where the segment is within the buffered district, 1 scan for all layers
+    # a segment inside 1 piece is inside the district, only segments crossing pieces need the full polygon
     dbo.query("""
-       drop table if exists buf;
-        create table {s}.buf as select coundist, st_buffer(geom, 10) as geom from {s}.nycc;
-        CREATE INDEX temp_buf_idx ON {s}.buf USING gist (geom); 
-        
-        update {s}.{l} as l
-        set lcoundist = coundist, rcoundist = coundist
-        from {s}.buf p
-        where st_within(l.geom, p.geom);
-        
-        update {s}.{l} as l
-        set rcoundist = coundist
-        from {s}.buf p
-        where lcoundist != coundist and st_within(l.geom, p.geom);
-        
-        drop table if exists {s}.buf;
+        drop table if exists {s}.district_match;
+        create table {s}.district_match as
+        select c.ogc_fid, b.layer, b.district
+        from (
+            select distinct l.ogc_fid, p.buf_id
+            from {s}.{l} l join {s}.district_piece p on l.geom && p.geom
+        ) c
+        join {s}.{l} l on l.ogc_fid = c.ogc_fid
+        join {s}.district_buf b on b.buf_id = c.buf_id
+        where case when exists (
+                select 1 from {s}.district_piece p
+                where p.buf_id = c.buf_id and p.geom && l.geom and st_within(l.geom, p.geom)
+            ) then true
+            else st_within(l.geom, b.geom) end;
     """.format(s=schema, l=lion))
-    print 'City Council districts added'
-    # update nta districts
+    # left/right for every layer in 1 update, the lower id on the left when a segment is in 2 districts
+    pivot = []
+    for tbl, field, lf, rf, buf, label in districts:
+        typ = dbo.column_type(schema, lion, lf)
+        pivot.append("min(district::{y}) filter (where layer = '{t}') as {lf}".format(y=typ, t=tbl, lf=lf))
+        pivot.append("max(district::{y}) filter (where layer = '{t}') as {rf}".format(y=typ, t=tbl, rf=rf))
     dbo.query("""
-           drop table if exists buf;
-            create table {s}.buf as select ntacode, st_buffer(geom, 10) as geom from {s}.nynta;
-            CREATE INDEX temp_buf_idx ON {s}.buf USING gist (geom); 
-
-            update {s}.{l} as l
-            set lntacode = ntacode, rntacode = ntacode
-            from {s}.buf p
-            where st_within(l.geom, p.geom);
-
-            update {s}.{l} as l
-            set rntacode = ntacode
-            from {s}.buf p
-            where lntacode != ntacode and st_within(l.geom, p.geom);
-
-            drop table if exists {s}.buf;
-        """.format(s=schema, l=lion))
-    print 'NTAs added'
-    # update police precincts
-    # added st_makevalid because there was an issue with 61st PCT
-    # pct boundaries are not cleanly drawn so larger buffer is needed
+        update {s}.{l} as l
+        set {set}
+        from (
+            select ogc_fid, {pivot}
+            from {s}.district_match
+            group by ogc_fid
+        ) d
+        where l.ogc_fid = d.ogc_fid
+    """.format(s=schema, l=lion, pivot=',\n                   '.join(pivot),
+               set=', '.join('{f} = d.{f}'.format(f=f) for row in districts for f in row[2:4])))
+    # segments left without a district
     dbo.query("""
-              drop table if exists buf;
-               create table {s}.buf as select precinct, st_buffer(st_makevalid(geom), 25) as geom from {s}.nypp;
-               CREATE INDEX temp_buf_idx ON {s}.buf USING gist (geom); 
-
-               update {s}.{l} as l
-               set lprecinct = precinct, rprecinct = precinct
-               from {s}.buf p
-               where st_within(l.geom, p.geom);
-
-               update {s}.{l} as l
-               set rprecinct = precinct
-               from {s}.buf p
-               where lprecinct != precinct and st_within(l.geom, p.geom);
-
-               drop table if exists {s}.buf;
-           """.format(s=schema, l=lion))
-    print 'Police Precincts added'
+        drop table if exists {s}.district_unmatched;
+        create table {s}.district_unmatched as
+        select ogc_fid, segmentid, array_remove(array[{missing}], null) as missing
+        from {s}.{l}
+        where {any_null};
+        drop table if exists {s}.district_buf;
+        drop table if exists {s}.district_piece;
+        drop table if exists {s}.district_match;
+    """.format(s=schema, l=lion,
+               missing=', '.join("case when {} is null then '{}' end".format(lf, tbl)
+                                 for tbl, field, lf, rf, buf, label in districts),
+               any_null=' or '.join('{} is null'.format(lf) for tbl, field, lf, rf, buf, label in districts)))
+    unmatched = dbo.query("""
+        select {counts} from {s}.district_unmatched
+    """.format(s=schema, counts=', '.join("count(*) filter (where '{}' = any(missing))".format(tbl)
+                                          for tbl, field, lf, rf, buf, label in districts))).data[0]
+    for (tbl, field, lf, rf, buf, label), cnt in zip(districts, unmatched):
+        print '{} added ({} segments not in any district)'.format(label, cnt)
+    print 'Unmatched segments are in {s}.district_unmatched'.format(s=schema)
 
-    # update state senate districts
-    dbo.query("""
-                  drop table if exists buf;
-                   create table {s}.buf as select stsendist, st_buffer(geom, 10) as geom from {s}.nyss;
-                   CREATE INDEX temp_buf_idx ON {s}.buf USING gist (geom); 
+# |||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||
+# Step 2: Define street network to use (centerline)
+# |||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||
 
-                   update {s}.{l} as l
-                   set lstsendist = stsendist, rstsendist = stsendist
-                   from {s}.buf p
-                   where st_within(l.geom, p.geom);
 
-                   update {s}.{l} as l
-                   set rstsendist = stsendist
-                   from {s}.buf p
-                   where lstsendist != stsendist and st_within(l.geom, p.geom);
+def read_manual_fixes(fix_file):
+    # [(fix_id, table, where field, where value, update field, update value, comment)], blank update value is NULL
+    with open(fix_file, 'rb') as f:
+        return [(i + 1, row['table'], row['where_field'], row['where_value'], row['update_field'],
+                 row['update_value'] or None, row['comment'])
+                for i, row in enumerate(csv.DictReader(f))]
 
-                   drop table if exists {s}.buf;
-               """.format(s=schema, l=lion))
-    print 'State Senate districts added'
 
-# |||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||
-# Step 2: Define street network to use (centerline)
-# |||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||
+def latest_fixes(fixes):
+    # the last fix in the file for each (table, where field, where value, update field), so a row added to correct
+    # a fix overrides it, both in one UPDATE ... FROM would leave postgres to apply either of them
+    latest = dict(((tbl, wf, wv, uf), fix_id) for fix_id, tbl, wf, wv, uf, uv, comment in fixes)
+    return [fix for fix in fixes if latest[fix[1:5]] == fix[0]]
 
 
-def manual_fixes(dbo, to_fix):
-    # to_dos = [(where field, where value, update field, update value)]
-    for row in to_fix:
-        wf, wv, uf, uv, tbl = row
-        print 'Updating {s} field {f} to {v}'.format(f=row[1], v=row[2], s=row[0])
-        dbo.query("update {t} set {u_f} = {u_v}, manual_fix = True where {w_f} = {w_v}".format(
-            t=tbl, u_f=uf, u_v=uv, w_f=wf, w_v=wv
-        ))
-        dbo.conn.commit()
+@db2.timeDec
+def manual_fixes(dbo, fix_file=params.MANUAL_FIXES, schema=params.WORKING_SCHEMA,
+                 lion=params.LION, rpl=params.RPL):
+    """
+    Fixes known errors in LION and the RPL from the manual fix file
+    one UPDATE per (table, where field, update field) group, all in one transaction, of fixes to the same
+    field of the same rows only the last one in the file is applied
+     :fix_file kwarg: csv of table (lion or rpl), where_field, where_value, update_field, update_value, comment
+    """
+    tables = {'lion': lion, 'rpl': rpl}
+    fixes = read_manual_fixes(fix_file)
+    latest = latest_fixes(fixes)
+    if len(latest) < len(fixes):
+        print '{} manual fixes overridden by a later fix of the same field'.format(len(fixes) - len(latest))
+    fixes = latest
+    dbo.copy_to_temp('manual_fix_list',
+                     [('fix_id', 'int'), ('tbl', 'text'), ('where_field', 'text'), ('where_value', 'text'),
+                      ('update_field', 'text'), ('update_value', 'text'), ('comment', 'text')],
+                     fixes,
+                     key='fix_id')
+    # groups in file order, so a later fix reaching the same rows through another where field still wins
+    groups = []
+    for fix_id, tbl, wf, wv, uf, uv, comment in fixes:
+        if (tbl, wf, uf) not in groups:
+            groups.append((tbl, wf, uf))
+    matched = defaultdict(int)
+    with dbo.transaction():
+        for tbl, wf, uf in groups:
+            # values are cast to the column types, so the where field can use its index
+            wt, ut = dbo.column_type(schema, tables[tbl], wf), dbo.column_type(schema, tables[tbl], uf)
+            updated = dbo.query("""update {s}.{t} as t
+                                   set {uf} = f.update_value::{ut}, manual_fix = True
+                                   from manual_fix_list as f
+                                   where f.tbl = '{tbl}' and f.where_field = '{wf}' and f.update_field = '{uf}'
+                                   and t.{wf} = f.where_value::{wt}
+                                   returning f.fix_id
+                                """.format(s=schema, t=tables[tbl], tbl=tbl, wf=wf, uf=uf, wt=wt, ut=ut)).data
+            for fix_id, in updated:
+                matched[fix_id] += 1
+    dbo.query('drop table pg_temp.manual_fix_list')
+    print '{} manual fixes applied, {} rows updated'.format(len(fixes), sum(matched.values()))
+    for fix_id, tbl, wf, wv, uf, uv, comment in fixes:
+        if matched[fix_id] != 1:
+            print '\tfix {i} ({t} {wf} = {wv}, {uf}) matched {n} rows'.format(
+                i=fix_id, t=tbl, wf=wf, wv=wv, uf=uf, n=matched[fix_id])
 
 
 @db2.timeDec
@@ -602,50 +687,26 @@ def define_double_segments(dbo, schema=params.WORKING_SCHEMA, lion=params.LION,
 
 
 @db2.timeDec
-def node_names(dbo, node_street_names, node_is_intersection, schema=params.WORKING_SCHEMA, node=params.NODE):
-    # TODO: Need to create an exclusion list - ex. concourse village east/west
-    def de_suffix(name):
-        # remove some precision in street names to create better sets
-        d = {' WEST': ' DIR',
-             ' EAST': ' DIR',
-             ' SOUTH': ' DIR',
-             ' NORTH': ' DIR',
-             ' EXIT': ' DIR',
-             ' ENTRANCE': ' DIR',
-             ' APPROACH': ' DIR',
-             ' NORTHBOUND': ' DIR',
-             ' NB': ' DIR',
-             ' SOUTHBOUND': ' DIR',
-             ' SB': ' DIR',
-             ' EASTBOUND': ' DIR',
-             ' EB': ' DIR',
-             ' WESTBOUND': ' DIR',
-             ' WB': ' DIR'}
-        for i in d:
-            if name not in {'WEST STREET', 'SOUTH STREET', 'NORTH STREET', 'EAST STREET',
-                            'WEST AVENUE', 'SOUTH AVENUE', 'NORTH AVENUE', 'EAST AVENUE',
-                            'WEST BOULEVARD', 'SOUTH BOULEVARD', 'NORTH BOULEVARD', 'EAST BOULEVARD',
-                            'WEST LOOP', 'SOUTH LOOP', 'NORTH LOOP', 'EAST LOOP',
-                            'WEST DRIVE', 'SOUTH DRIVE', 'NORTH DRIVE', 'EAST DRIVE',
-                            'WEST ROAD', 'SOUTH ROAD', 'NORTH ROAD', 'EAST ROAD',
-                            'JUNIPER BOULEVARD NORTH', 'JUNIPER BOULEVARD SOUTH',
-                            'PROSPECT PARK WEST', 'AVENUE N', 'AVENUE S', 'AVENUE E',
-                            'AVENUE W'}:
-                if name:
-                    name = name.replace(i, d[i])
-        return name
+def node_names(dbo, node_street_names, node_is_intersection, schema=params.WORKING_SCHEMA, node=params.NODE,
+               normalizer=None, street_ids=params.streetIds):
+    # exclusion list (ex. concourse village east/west) can be extended from a file with params.STREET_NAME_EXCEPTIONS
+    if normalizer is None:
+        if params.STREET_NAME_EXCEPTIONS:
+            normalizer = sn.StreetNameNormalizer.from_file(params.STREET_NAME_EXCEPTIONS)
+        else:
+            normalizer = sn.StreetNameNormalizer()
     # build the dictionary of the street names for each node
-    q = dbo.query("""
+    q = dbo.stream("""
                         select n.nodeid, n.is_int, s.street 
                         from {s}.{n} n 
                         join {s}.node_stnameFT s
                         on n.nodeid = s.node
                     """.format(s=schema, n=node))
-    for row in tqdm(q.data):
+    for row in tqdm(q):
         node, isint, street = row
         node = int(node)
-        # normalize the street name
-        street = de_suffix(street)
+        # normalize the street name and swap it for its id
+        street = street_ids.id(normalizer(street))
         # update the intersection diction with is_int flag
         node_is_intersection[node] = isint
         # add street name(s) to dict
@@ -654,161 +715,105 @@ def node_names(dbo, node_street_names, node_is_intersection, schema=params.WORKI
         #     node_street_names[node] = [{street}, 0]  # [set([street]), masterid]
         # else:
         #     node_street_names[node][0].add(street)
+    # freeze the name sets as sorted id tuples
+    for names in node_street_names.itervalues():
+        names[0] = tuple(sorted(names[0]))
+    print normalizer.stats()
+    print '{} distinct street names'.format(len(street_ids))
     return node_street_names, node_is_intersection
 
 
 @db2.timeDec
-def graph(dbo, node_next_steps=params.nodeNextSteps, schema=params.WORKING_SCHEMA, lion=params.LION):
+def graph(dbo, schema=params.WORKING_SCHEMA, lion=params.LION):
     # builds non-directional graph of included street network
-    q = dbo.query("select street, segmentid, nodeidfrom, nodeidto from {0}.{1} where exclude = False".format(
+    q = dbo.stream("select street, segmentid, nodeidfrom, nodeidto from {0}.{1} where exclude = False".format(
         schema, lion))
-    for row in tqdm(q.data):
-        street, segmentid, nodeidfrom, nodeidto = row
-        node_next_steps[int(nodeidfrom)][street].add(int(nodeidto))
-        node_next_steps[int(nodeidto)][street].add(int(nodeidfrom))
-    return node_next_steps
+    street_graph = sg.StreetGraph.from_rows(tqdm(q))
+    print 'Graph: {} nodes, {} segments ({:.1f} MB)'.format(
+        len(street_graph), len(street_graph.segments), street_graph.nbytes / 1e6)
+    return street_graph
 
 
 @db2.timeDec
-def search(node_street_names, street_set, node_is_intersection, node_next_steps):
+def search(node_street_names, street_set, node_is_intersection, street_graph):
     """gets intersection to intersection segments or collection of segments"""
-    # get blocks for every intersection node
-    for startNode in node_street_names.keys():
-        if node_is_intersection[startNode]:
-            # blocks formed for each available street name
-            for street in node_next_steps[startNode].keys():
-                # run DFS block maker for each street of the node
-                queue = list(node_next_steps[startNode][street])
-                while len(queue) > 0:
-                    to_node = queue.pop()
-                    street_set.append(
-                        go_to_end(
-                            street, [startNode], {to_node}, node_is_intersection, node_next_steps
-                        )
-                    )
+    # each block is traced once, from its lowest index intersection
+    street_set += bt.trace_blocks(street_graph, street_graph.mask(node_is_intersection))
+    print '{} blocks'.format(len(street_set))
     return node_street_names, street_set
 
 
-def go_to_end(street, done, todo, node_is_intersection, node_next_steps):
-    # forms blocks using DFS
-        # 1(i) - 2 - 3 -4(i) - 5
-        # done = [1], todo_set = {2}
-            # [1-2], {1,3}
-                # [1,2,3], {2,4}
-                    # [1,2,3,4]
-        # [5], {4,6}...
-    # anything left in the queue?
-    if len(todo) == 0:
-        # you're done exit
-        return done
-    else:
-        # get new starting point
-        start = todo.pop()
-        # add it to the visited nodes
-        done.append(start)
-        # make sure it is not an ending point
-        if not node_is_intersection[start]:
-            # see where we can go from here
-            for i in node_next_steps[start][street]:
-                # make sure we haven't done it yet
-                if i not in done:
-                    # add it to the queue
-                    todo.add(i)
-        return go_to_end(street, done, todo, node_is_intersection, node_next_steps)
-
-
 @db2.timeDec
 def generate_blocks_from_masterids(dbo,
-                                   alt_graph=params.altGraph,
+                                   street_graph,
                                    street_set=params.streetSet,
                                    mft_1_dict=params.mft1Dict,
-                                   folder=params.FOLDER,
                                    lion=params.LION,
                                    schema=params.WORKING_SCHEMA):
     """gets simplest master segments based on from to nodes, intersections only"""
-    sql = """select segmentid, nodeidfrom, nodeidto
-            from {0}.{1} where exclude is false
-            group by segmentid, nodeidfrom, nodeidto""".format(schema, lion)
-
-    data = dbo.query(sql)
-    # build local dict of seg node ids from-to to build mft
-    for row in tqdm(data[0]):
-        # build up simple graph
-        # node : [[other node , segid], [other node , segid]]
-        segment, fromid, toid = row
-        alt_graph[int(fromid)].append([int(toid), segment])
-        alt_graph[int(toid)].append([int(fromid), segment])
-    print 'done graphing\n'
     mft = 0
-    to_write_out = []
+    seg_mft = dict()
     # go through all nodes in each block and get all of the segmentids that have
     # from and to nodes both in the block list
     for block in tqdm(street_set):  # streetSet is a set of nodes that together make up a block
-        if block:
+        if len(block):
             mft += 1
-            for node in block:
-                for other_node, seg in alt_graph[node]:
-                    if other_node in block:  # both ends of the street are in the block
-                        mft_1_dict[mft].append(seg)
-                        to_write_out.append([mft, seg])
-    print 'Writing out csv\n'
-    db2.write(os.path.join(folder, "mft.csv"), to_write_out, ['mft', 'segment'])
-    dbo.query(
-        'drop table if exists {0}.tempMaster; CREATE TABLE {0}.tempMaster (mft varchar(10), seg varchar(10))'.format(
-            schema
-            )
-    )
+            for seg in street_graph.block_segments(block).tolist():
+                # both ends of the street are in the block
+                # segments shared by 2 blocks (ex. 2 streets between the same intersections) keep the first mft
+                if seg not in seg_mft:
+                    seg_mft[seg] = mft
+                    mft_1_dict[mft].append(seg)
     print 'Adding outputs to DB\n'
-    db2.add_data_to_pg(dbo, 'tempMaster', schema, ',', os.path.join(folder, "mft.csv"))
+    # typed like the lion columns so the join needs no casts
+    dbo.copy_to_temp('tempmaster',
+                     [('seg', dbo.column_type(schema, lion, 'segmentid')),
+                      ('mft', dbo.column_type(schema, lion, 'mft'))],
+                     seg_mft.iteritems(),
+                     key='seg')
     print 'Updating lion with mfts\n'
     dbo.query("""update {0}.{1} as l
-                       set mft = t.mft::int
-                       -- added min(mft) sice blockes are defined in both directions
-                       -- and mft attribution was random
-                       from (select seg, min(mft) as mft from {0}.tempmaster group by seg) as t
-                       where l.segmentid =t.seg""".format(schema, lion))
-    dbo.query("drop table {}.tempmaster".format(schema))
-    return alt_graph
+                       set mft = t.mft
+                       -- 1 row per segment, blocks are traced once and shared segments keep the first mft
+                       from tempmaster as t
+                       where l.segmentid = t.seg""".format(schema, lion))
+    dbo.query("drop table pg_temp.tempmaster")
+    return mft_1_dict
 
 
 @db2.timeDec
 def update_blocks_limit_to_1_street_name(dbo,
                                          lion=params.LION,
                                          schema=params.WORKING_SCHEMA):
-    # find all blocks with more than 1 street name
-    unique_names_mfts = dbo.query("""
-        select t.* from (
-            select mft, street, rank() over (partition by street, mft order by segmentid ) strts 
-            from {0}.{1} where  mft is not null
-        ) t 
-        join (
-            select mft, count(distinct street) cnt
-            from {0}.{1}
-            where  mft is not null
-            group by mft having count(distinct street) > 1
-        ) problem_mfts
-        on t.mft=problem_mfts.mft 
-        where strts = 1
+    # blocks with more than 1 street name get a new mft for each (mft, street), numbered after the current max
+    # blocks' rows with no street name keep the old mft
+    dbo.query("""
+        update {0}.{1} as l
+        set mft = s.new_mft
+        from (
+            select d.mft, d.street, m.max_mft + dense_rank() over (order by d.mft, d.street) as new_mft
+            from (
+                select distinct l.mft, l.street
+                from {0}.{1} as l
+                join (
+                    select mft
+                    from {0}.{1}
+                    where mft is not null
+                    group by mft having count(distinct street) > 1
+                ) problem_mfts
+                on l.mft = problem_mfts.mft
+                where l.street is not null
+            ) d
+            cross join (select max(mft) as max_mft from {0}.{1}) m
+        ) s
+        where l.mft = s.mft and l.street = s.street
     """.format(schema, lion))
-    # get max mft
-    max_mft = dbo.query("select max(mft) from {0}.{1}".format(schema, lion))
-    max_mft = max_mft.data[0][0]
-    # get unique street names
-    for row in tqdm(unique_names_mfts.data):
-        mft, street_name, _ = row
-        max_mft += 1
-        # update mft to split on street name
-        dbo.query("update {s}.{l} set mft = {new_m} where street='{st}' and mft={old_m}".format(
-            s=schema, l=lion, new_m=max_mft, st=street_name, old_m=mft
-        ))
     print '\nSplit mfts on name'
 
 
 def street_name_key(street_set):
-    street_set = list(street_set)
-    street_set.sort()
-    street_set = str(street_set)
-    return street_set[1:-1]
+    # sorted tuple of street name ids
+    return tuple(sorted(street_set))
 
 
 @db2.timeDec
@@ -825,27 +830,50 @@ def intersection_cluster_dict(node_street_names, cluster_intersections, node_is_
 
 
 def merge_clusters(cluster_intersections, key1, key2):
-    cluster = dict(cluster_intersections)
     # #clusterIntersections = {sorted-street-names: [set([nodes]), masterID]}
-    # merge nodes from key2 into key 1
-    cluster[key1][0] = cluster[key1][0].union(cluster[key2][0])
+    # merge nodes from key2 into key 1 (in place)
+    cluster_intersections[key1][0] = cluster_intersections[key1][0].union(cluster_intersections[key2][0])
     # copy full cluster to second key (includes all nodes and master)
-    cluster[key2] = cluster[key1]
-    return cluster
+    cluster_intersections[key2] = cluster_intersections[key1]
+    return cluster_intersections
+
+
+def build_name_index(street_set_list):
+    # inverted index of street name -> positions in street_set_list (ascending)
+    name_index = defaultdict(list)
+    for pos, names in enumerate(street_set_list):
+        if names:
+            for name in names:
+                name_index[name].append(pos)
+    return name_index
+
+
+def find_supersets(name_index, names):
+    # positions of all indexed sets containing every name in names (ascending)
+    # intersect the posting lists starting from the shortest
+    postings = sorted((name_index.get(name, []) for name in names), key=len)
+    if not postings or not postings[0]:
+        return []
+    candidates = set(postings[0])
+    for posting in postings[1:]:
+        candidates.intersection_update(posting)
+        if not candidates:
+            return []
+    return sorted(candidates)
 
 
 def sub_get_doubles(dbo, schema):
-    data = dbo.query("""select nf from {0}.doubles
+    data = dbo.stream("""select nf from {0}.doubles
                         union select nt from {0}.doubles
                     """.format(schema))
     d = set()
-    for i in data.data:
+    for i in data:
         d.add(i[0])
     return d
 
 
 @db2.timeDec
-def subset_merge_with_superset(dbo, schema, cluster_intersections, node_street_names):
+def subset_merge_with_superset(dbo, schema, cluster_intersections, node_street_names, street_ids=params.streetIds):
     # sample problem
         # set(['BROADWAY', 'WEST 225 STREET', 'BROADWAY BRIDGE'])
         # set(['BROADWAY', 'BROADWAY BRIDGE'])
@@ -865,24 +893,24 @@ def subset_merge_with_superset(dbo, schema, cluster_intersections, node_street_n
             return names
     # double block conditions to skip
     double_nodes = sub_get_doubles(dbo, schema)
+    ramp = street_ids.get('Ramp')
     # list of sets to test
     street_set_list = [sub_get_name_set_from_str(str_street_set, double_nodes)
                        for str_street_set in cluster_intersections.keys()]
+    name_index = build_name_index(street_set_list)
     for str_street_set in tqdm(cluster_intersections.keys()):
-        # ex. "'QUEENS BOULEVARD', 'VAN DAM STREET'"
+        # ex. (12, 408) -> ('QUEENS BOULEVARD', 'VAN DAM STREET')
         # get node to get street names as set
         street_name_set = sub_get_name_set_from_str(str_street_set, double_nodes)
-        # check for super set
-        for super_set in street_set_list:
-            if all([super_set, street_name_set]) and \
-                            'Ramp' not in super_set and \
-                            len(street_name_set) > 1 and \
-                            street_name_set != super_set and \
-                    street_name_set.issubset(super_set):
-                # print 'Merging {} with, {}'.format(str_street_set, street_name_key(super_set))
+        if not street_name_set or len(street_name_set) < 2:
+            continue
+        # check for super sets (in street_set_list order)
+        for pos in find_supersets(name_index, street_name_set):
+            super_set = street_set_list[pos]
+            if ramp not in super_set and street_name_set != super_set:
+                # print 'Merging {} with, {}'.format(street_ids.names_of(str_street_set), street_ids.names_of(super_set))
                 # merge clusters
-                # clusterIntersections[street_name_key(super)]
-                cluster_intersections = merge_clusters(
+                merge_clusters(
                     cluster_intersections,
                     str_street_set,
                     street_name_key(super_set))
@@ -890,18 +918,20 @@ def subset_merge_with_superset(dbo, schema, cluster_intersections, node_street_n
 
 
 @db2.timeDec
-def master_intersection_first_pass(cluster_intersections, node_master, master_node):
+def master_intersection_first_pass(cluster_intersections, masters):
     master = 0
+    node_master = dict()
     for street_set in cluster_intersections.keys():
         master += 1
         # add masterid to each set of street names
         cluster_intersections[street_set][-1] = master
-        # update node: master dict and master : node dict
+        # update node: master dict
         # This may be overkill, but it allows for 3 way lookups by street names, nodeid, or masterid
         for node in cluster_intersections[street_set][0]:
             node_master[node] = master
-            master_node[master].append(node)
-    return cluster_intersections, node_master, master_node
+    # group nodes by master (masters.groups() gives master : node lookup)
+    masters.load(node_master)
+    return cluster_intersections, masters
 # |||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||
 # Step 6: Revise simplified network
 # |||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||
@@ -914,10 +944,9 @@ def distance(x1, y1, x2, y2):
 
 def get_nodes_pct(dbo, schema):
     node_pct_dict = defaultdict(list)
-    data = dbo.query("select distinct nodeid, precinct from {}.c_intersection_name".format(schema))
-    for row in data.data:
+    data = dbo.stream("select distinct nodeid, precinct from {}.c_intersection_name".format(schema))
+    for row in data:
         node_pct_dict[row[0]].append(row[1])
-    del data
     return node_pct_dict
 
 
@@ -947,158 +976,116 @@ def get_all_database_needs_for_distance_check(dbo, schema, node_table, precinct_
     #                         join {3} as p on st_within(n.geom, p.geom)
     #                         where l.street !=ll.street
     #                 """.format(schema, node_table, lion_table, precinct_table))
-    data = dbo.query("""select nodeid::int as nodeid, precinct
+    data = dbo.stream("""select nodeid::int as nodeid, precinct
                             from {0}.{1} as n join {2} as p 
                             on st_dwithin(n.geom, p.geom, 10)
                     """.format(schema, node_table, precinct_table))
     pct_lookup = dict()
-    for row in data[0]:
+    for row in data:
         node, pct = row
         pct_lookup[node] = pct
-    del data
     # get the neighboring pcts for each pct
-    data = dbo.query("""select p1.precinct, p2.precinct
+    data = dbo.stream("""select p1.precinct, p2.precinct
                            from {0} as p1
                            join {0} as p2
                            on st_intersects(p1.geom, p2.geom)
                            """.format(precinct_table))
     pct_neighbors = defaultdict(set)
-    for row in tqdm(data[0]):
+    for row in tqdm(data):
         p1, p2 = row
         pct_neighbors[p1].add(p2)
-    del data
-    data = dbo.query("select nodeid, st_x(geom), st_y(geom) from {sch}.{nt}".format(sch=schema, nt=node_table))
+    data = dbo.stream("select nodeid, st_x(geom), st_y(geom) from {sch}.{nt}".format(sch=schema, nt=node_table))
     node_coords = dict()
-    for row in tqdm(data[0]):
+    for row in tqdm(data):
         nd, x, y = row
         node_coords[nd] = (x, y)
-    del data, row
     return pct_lookup, pct_neighbors, node_coords
 
 
-def find_masters_with_distant_nodes(master_nodes, node_is_int, node_coords):
-    tolerance = 1000  # used to be 300.........
-    problems = list()  # list of masterIDs to be split
-    for master in master_nodes.keys():
-        node_list = master_nodes[master]
-        for pair in itertools.product(list(node_list), repeat=2):
-            n1, n2 = pair
-            if node_is_int[n1] and node_is_int[n2]:
-                (x1, y1), (x2, y2) = node_coords[n1], node_coords[n2]
-                if distance(x1, y1, x2, y2) > tolerance:
-                    problems.append(master)
+def find_masters_with_distant_nodes(master_nodes, node_is_int, node_coords, tolerance=1000, extents=None):
+    # tolerance used to be 300.........
+    # pass extents (spatial_index.GroupExtents) back in to re-check the same masters with another tolerance
+    if extents is None:
+        extents = si.GroupExtents(
+            dict((master, [n for n in nodes if node_is_int[n]]) for master, nodes in master_nodes.iteritems()),
+            node_coords)
+    problems = extents.wider_than(tolerance)  # list of masterIDs to be split
     return problems
 
 
 @db2.timeDec
-def update_problem_groups(problems, pct_lookup, node_master, master_node, street_names):
+def update_problem_groups(problems, pct_lookup, masters, street_names):
     problems = set(problems)
+    master_node = masters.groups()
     for problem_master_id in tqdm(problems):
         print 'Updating {} ({})'.format(problem_master_id, master_node[problem_master_id])
         # group nodes in master by pct
         temp_pct_dict = defaultdict(list)
         for node in master_node[problem_master_id]:
             temp_pct_dict[pct_lookup[node]].append(node)
-        # 1st clean up existing data
-        del master_node[problem_master_id]
-        # update masterids for each pct
-        for p in temp_pct_dict.keys():
-            # get next availible masterid
-            mx = max(master_node.keys()) + 1
-            for node in temp_pct_dict[p]:
-                # update masters
-                node_master[node] = mx
+        # update masterids for each pct (replaces the existing master)
+        for mx, nodes in masters.split(problem_master_id, temp_pct_dict.values()):
+            for node in nodes:
                 street_names[node][1] = mx
-                master_node[mx].append(node)
     print 'CLUSTER INTERSECTION DICT NO LONGER ACCURATE'
-    return node_master, master_node, street_names
-
-
-def merge_masters(nodes_to_merge, node_master, master_node):
-    masters_to_merge = [node_master[n] for n in nodes_to_merge]
-    new_master = masters_to_merge[0]
-    # get all of the nodes that belong to the masters of the nodes to merge
-    # need to make sure to bring sibling nodes along in the merger
-    all_nodes_to_merge = list()
-    for n in [master_node[m] for m in masters_to_merge]:
-        all_nodes_to_merge += n
-    for n in all_nodes_to_merge:
-        node_master[n] = new_master
-    for m in masters_to_merge:
-        if m != new_master:
-            master_node[new_master] = master_node[new_master] + master_node[m]
-            del master_node[m]
-    return node_master, master_node
+    return masters, street_names
+
+
+def merge_masters(nodes_to_merge, masters):
+    # merge the masters of the nodes, sibling nodes come along with their master
+    # the merged group keeps the master of the first node
+    masters.union(nodes_to_merge)
+    return masters
 
 
 @db2.timeDec
-def near_by_simple(dbo, schema, node_table, node_master, master_node, search_distance):
-    # TODO: this is very slow and needs to be refactored
-    # get all nodes within seach distance
-    for node in tqdm(node_master.keys()):
-        near_nodes = dbo.query("""
-                select near.nodeid 
-                from {s}.{n} as near, 
-                (
-                    select geom 
-                    from {s}.{n}
-                    where nodeid = {nd}
-                ) as src
-                where st_dwithin(near.geom, src.geom, {sd})
-                and near.is_int = True
-                and near.nodeid != {nd}
-        """.format(s=schema, n=node_table, nd=node, sd=search_distance))
-        node_master, master_node = merge_masters([int(n[0]) for n in near_nodes.data]+[node], node_master, master_node)
-    return node_master, master_node
+def near_by_simple(dbo, schema, node_table, masters, search_distance, node_index=None):
+    # get all intersection nodes within seach distance of each node in one pass over an in memory grid
+    # (same results as st_dwithin(near.geom, src.geom, search_distance) and near.is_int = True)
+    if node_index is None:
+        node_index = si.NodeIndex.from_db(dbo, schema, node_table, search_distance)
+    near_nodes = node_index.pairs_within(search_distance, masters.keys())
+    for node in tqdm(masters.keys()):
+        masters = merge_masters(near_nodes.get(node, []) + [node], masters)
+    return masters
 
 
 @db2.timeDec
-def triangle(node_coords, next_steps, node_master, master_node, node_is_int, triangle_dist=150):
+def triangle(node_coords, street_graph, masters, node_is_int, triangle_dist=150):
     # for every intersection
     #     get all nodes 1 step away
     #     check the distance between origin node and 1 step nodes
     #     if less than predefined distance group
+    # (done for all nodes at once on the graph arrays, see street_graph.find_triangles)
+    starts = [i for i in (street_graph.index.get(node) for node in masters.keys()) if i is not None]
+    triangles = sg.find_triangles(street_graph,
+                                  street_graph.coords(node_coords),
+                                  street_graph.mask(node_is_int),
+                                  starts,
+                                  triangle_dist)
+    node_ids = street_graph.node_ids.tolist()
     triangles_list = list()
-    for node in tqdm(node_master.keys()):
-        x, y = node_coords[node]
-        one_hop_nodes = dict()
-        for s in next_steps[node]:  # get steets steaming from node
-            for nd in params.nodeNextSteps[node][s]:  # get the next nodes down each street
-                if node_is_int[nd]:  # ignore non-intersection nodes
-                    x1, y1, = node_coords[nd]
-                    d = distance(x, y, x1, y1)
-                    if d < triangle_dist:  # check distance
-                        one_hop_nodes[nd] = d
-        if len(one_hop_nodes) == 2:
-            # check if each of the 1 hop nodes will also connect to eachother in 1 hop
-            n1, n2 = one_hop_nodes.keys()
-            for street_name in next_steps[n1].keys():
-                if n2 in next_steps[n1][street_name]:
-                    new_tri = set(one_hop_nodes.keys())
-                    new_tri.add(node)
-                    if new_tri not in triangles_list:
-                        triangles_list.append(new_tri)
-                        merge_masters(new_tri, node_master, master_node)
-    return triangles_list, node_master, master_node
+    for tri in tqdm(triangles):
+        new_tri = frozenset(node_ids[i] for i in tri)
+        triangles_list.append(new_tri)
+        merge_masters(new_tri, masters)
+    return triangles_list, masters
 
 
 @db2.timeDec
-def update_db_nodes(dbo, schema, node_table, folder, node_master):
-    # prep dict to write to csv
-    data_to_write = [[node, node_master[node]] for node in node_master]
-    # write out data
-    db2.write(os.path.join(folder, "nodeMaster.csv"), data_to_write)  # , ['nodeid', 'masterid'])
-    # create temp_table
-    dbo.query('''drop table if exists {0}.nodeMaster; CREATE TABLE {0}.nodeMaster 
-                (nodeid numeric(10,0), masterid numeric(10,0))
-            '''.format(schema))
-    db2.add_data_to_pg(dbo, 'nodeMaster', schema, ',', os.path.join(folder, "nodeMaster.csv"))
+def update_db_nodes(dbo, schema, node_table, masters):
+    # stream {node: masterid} into a temp table typed like the node table
+    dbo.copy_to_temp('nodemaster',
+                     [('nodeid', dbo.column_type(schema, node_table, 'nodeid')),
+                      ('masterid', dbo.column_type(schema, node_table, 'masterid'))],
+                     masters.items(),
+                     key='nodeid')
     dbo.query("""update {0}.{1} as n
                 set masterid = nm.masterid
-                from {0}.nodemaster as nm
+                from nodemaster as nm
                 where n.nodeid = nm.nodeid
             """.format(schema, node_table))
-    dbo.query('drop table {}.nodemaster'.format(schema))
+    dbo.query('drop table pg_temp.nodemaster')
 # |||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||
 # Step 7: Generate stable master ids
 # |||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||
@@ -1106,18 +1093,21 @@ def update_db_nodes(dbo, schema, node_table, folder, node_master):
 
 @db2.timeDec
 def stabilize_masters(dbo, node_table, schema):
-    dbo.query("alter table {s}.{n} add newid int;".format(s=schema, n=node_table))
-    dbo.query("""drop table if exists {s}.new_masters;
+    # 1 round trip and 1 commit, a failure leaves the node table as it was
+    dbo.batch([
+        "alter table {s}.{n} add newid int;".format(s=schema, n=node_table),
+        """drop table if exists {s}.new_masters;
                 create table {s}.new_masters as
-                select masterid, max(nodeid) newid from {s}.{n} group by masterid;""".format(s=schema, n=node_table))
-    dbo.query("""
+                select masterid, max(nodeid) newid from {s}.{n} group by masterid;""".format(s=schema, n=node_table),
+        """
                 update {s}.{n} as n
                 set newid = nm.newid
                 from {s}.new_masters as nm
-                where n.masterid = nm.masterid;""".format(s=schema, n=node_table))
-    dbo.query("update {s}.{n} set masterid = newid;".format(s=schema, n=node_table))
-    dbo.query("alter table {s}.{n} drop column newid;".format(s=schema, n=node_table))
-    dbo.query("drop table if exists {s}.new_masters;".format(s=schema))
+                where n.masterid = nm.masterid;""".format(s=schema, n=node_table),
+        "update {s}.{n} set masterid = newid;".format(s=schema, n=node_table),
+        "alter table {s}.{n} drop column newid;".format(s=schema, n=node_table),
+        "drop table if exists {s}.new_masters;".format(s=schema)
+    ])
 # |||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||
 #     8. Rebuild street network with new masterid info
 # |||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||
@@ -1268,16 +1258,18 @@ def fix_dead_ends(dbo, lion_table, node_table, schema):
 ############################################################################################
 @db2.timeDec
 def stabilize_mfts(dbo, lion_table, schema):
-    dbo.query("alter table {s}.{n} add newid int;".format(s=schema, n=lion_table))
-    dbo.query("""drop table if exists {s}.new_mft;
+    # 1 round trip and 1 commit, a failure leaves lion as it was
+    dbo.batch([
+        "alter table {s}.{n} add newid int;".format(s=schema, n=lion_table),
+        """drop table if exists {s}.new_mft;
                 create table {s}.new_mft as
                 select masteridfrom, masteridto, max(segmentid ) as newid
                 from {s}.{n}
                 where (masteridfrom is not null or masteridto is not null)
                 and exclude = False
                 group by masteridfrom, masteridto
-                """.format(s=schema, n=lion_table))
-    dbo.query("""
+                """.format(s=schema, n=lion_table),
+        """
                 update {s}.{n} as n
                 set newid = nm.newid::int
                 from {s}.new_mft as nm
@@ -1292,10 +1284,11 @@ def stabilize_mfts(dbo, lion_table, schema):
                     COALESCE(n.masteridfrom,0) = COALESCE(nm.masteridto,0)
                     )
                 ;
-            """.format(s=schema, n=lion_table))
-    dbo.query("update {s}.{n} set mft = newid;".format(s=schema, n=lion_table))
-    dbo.query("alter table {s}.{n} drop column newid;".format(s=schema, n=lion_table))
-    dbo.query("drop table if exists {s}.new_mft;".format(s=schema))
+            """.format(s=schema, n=lion_table),
+        "update {s}.{n} set mft = newid;".format(s=schema, n=lion_table),
+        "alter table {s}.{n} drop column newid;".format(s=schema, n=lion_table),
+        "drop table if exists {s}.new_mft;".format(s=schema)
+    ])
 # @db2.timeDec
 # def stabilize_mfts(dbo, lion_table, schema):
 #     dbo.query("alter table {s}.{n} add newid int;".format(s=schema, n=lion_table))
@@ -1505,8 +1498,7 @@ def update_roadbed_nodes(dbo, schema, node_table, tbl_rpl):
 @db2.timeDec
 def corridor_names(dbo):
     dbo.query("""-- p street is the street name without directional prefix
-                alter table {s}.{l} drop column if exists corridor_street;
-                alter table {s}.{l} add corridor_street text;
+                -- corridor_street is added by add_clion_columns, altering lion here would lock out its readers
                 update {s}.{l} set corridor_street = case 
                     -- edge case streets where the direction is the name
                     when street in ('SOUTH STREET', 'WEST STREET','NORTH STREET', 'EAST STREET',
@@ -1533,8 +1525,8 @@ def corridor_names(dbo):
 @db2.timeDec
 def dissolve_corridors(dbo):
     dbo.query("""
-                alter table {s}.{l} drop column if exists cid; 
-                alter table {s}.{l} add cid text; 
+                -- clears cid of an earlier run (the column is added by add_clion_columns)
+                update {s}.{l} set cid = null where cid is not null;
 
                 drop table if exists {s}._corridor_;
                 create table {s}._corridor_ as (
@@ -1813,17 +1805,17 @@ def ramp_intersection_views(dbo, schema, node_table, lion_table):
 # |||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||
 
 
-def add_indexes(dbo,  node_table, lion_table, schema=params.WORKING_SCHEMA):
+def add_indexes(dbo,  node_table, lion_table, schema=params.WORKING_SCHEMA, pool=None):
     print 'Adding indexes'
-    index_list = ["drop index if exists {s}.nd_IDX;".format(s=schema),
-                  "drop index if exists {s}.master_IDX;".format(s=schema),
-                  "drop index if exists {s}.seg_IDX;".format(s=schema),
-                  "drop index if exists {s}.mft_IDX;".format(s=schema),
-                  "drop index if exists {s}.nf_IDX;".format(s=schema),
-                  "drop index if exists {s}.nt_IDX;".format(s=schema),
-                  "drop index if exists {s}.mf_IDX;".format(s=schema),
-                  "drop index if exists {s}.mt_IDX;".format(s=schema),
-                  "CREATE INDEX nd_IDX ON {s}.{n} (nodeid);".format(s=schema, n=node_table),
+    drop_list = ["drop index if exists {s}.nd_IDX;".format(s=schema),
+                 "drop index if exists {s}.master_IDX;".format(s=schema),
+                 "drop index if exists {s}.seg_IDX;".format(s=schema),
+                 "drop index if exists {s}.mft_IDX;".format(s=schema),
+                 "drop index if exists {s}.nf_IDX;".format(s=schema),
+                 "drop index if exists {s}.nt_IDX;".format(s=schema),
+                 "drop index if exists {s}.mf_IDX;".format(s=schema),
+                 "drop index if exists {s}.mt_IDX;".format(s=schema)]
+    index_list = ["CREATE INDEX nd_IDX ON {s}.{n} (nodeid);".format(s=schema, n=node_table),
                   "CREATE INDEX master_IDX ON {s}.{n} (masterid);".format(s=schema, n=node_table),
                   "CREATE INDEX seg_IDX ON {s}.{l} (segmentid);".format(s=schema, l=lion_table),
                   "CREATE INDEX mft_IDX ON {s}.{l} (mft);".format(s=schema, l=lion_table),
@@ -1832,9 +1824,13 @@ def add_indexes(dbo,  node_table, lion_table, schema=params.WORKING_SCHEMA):
                   "CREATE INDEX mf_IDX ON {s}.{l} (masteridfrom);".format(s=schema, l=lion_table),
                   "CREATE INDEX mt_IDX ON {s}.{l} (masteridto);".format(s=schema, l=lion_table)
                   ]
+    dbo.batch(drop_list)
     print 'Indexing...\n'
-    for idx in tqdm(index_list):
-        dbo.query(idx)
+    # index builds only share locks on the table, so they can run side by side
+    pool_db = pool or db2.PostgresPool(dbo, params.DB_POOL_SIZE)
+    pool_db.query(index_list)
+    if not pool:
+        pool_db.close()
 
 
 # |||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||
@@ -1842,293 +1838,329 @@ def add_indexes(dbo,  node_table, lion_table, schema=params.WORKING_SCHEMA):
 # |||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||
 
 
-@db2.timeDec
-def run():
-    db = db2.PostgresDb(params.DB_HOST, params.DB_NAME, quiet=True)
-    #     1. Setup databases
+# |||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||
+# Pipeline: stages with the tables ('params.'/'ctx.' for in memory structures) they read and write
+# |||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||
+# params globals checkpointed after python stages, so a run can resume without rebuilding them
+STATE_NAMES = ('streetIds', 'nodeStreetNames', 'nodeIsIntersection', 'streetGraph', 'nodeMaster',
+               'clusterIntersections', 'streetSet', 'mft1Dict')
+
+
+def archive_stage(ctx):
     if raw_input('Archive (Y/N) ?\n').upper() == 'Y':
-        archive(db,
+        archive(ctx['db'],
                 params.LION,
                 params.NODE,
                 params.WORKING_SCHEMA,
                 params.ARCHIVE_SCHEMA)
-    fixes = [
-        # KNOWN ERRORS IN LION TO FIX | INPUTS:
-        # (field to select on, value to select on, field to update, value to update)
-        ('segmentid', "'0164415'", 'trafdir', "'A'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was P
-        ('segmentid', "'0297670'", 'trafdir', "'A'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was P
-        ('segmentid', "'0276350'", 'trafdir', "'A'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was P
-        ('segmentid', "'0164344'", 'trafdir', "'A'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was P
-        ('segmentid', "'0276509'", 'trafdir', "'A'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was P
-        ('segmentid', "'0164272'", 'trafdir', "'A'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was P
-        ('segmentid', "'0164273'", 'trafdir', "'A'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was P
-        ('segmentid', "'0164278'", 'trafdir', "'A'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was P
-        ('segmentid', "'0164279'", 'trafdir', "'A'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was P
-        ('segmentid', "'0164362'", 'trafdir', "'A'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was P
-        ('segmentid', "'0164361'", 'trafdir', "'A'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was P
-
-        ('segmentid', "'0262058'", 'nonped', 'null', "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was V
-        ('segmentid', "'0159297'", 'nonped', 'null', "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was V
-        ('segmentid', "'0145754'", 'nonped', 'null', "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was V
-        ('segmentid', "'0145755'", 'nonped', 'null', "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was V
-        ('segmentid', "'0320220'", 'nonped', 'null', "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was V
-        ('segmentid', "'0320221'", 'nonped', 'null', "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was V
-        ('segmentid', "'0139548'", 'nonped', 'null', "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was V
-        ('segmentid', "'0270493'", 'nonped', "'V'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was NULL
-
-         # need to treat as ramps
-        ('segmentid', "'0038411'", 'rw_type', "'9'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0038398'", 'rw_type', "'9'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0176861'", 'rw_type', "'9'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0175063'", 'rw_type', "'9'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0122207'", 'rw_type', "'9'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0174787'", 'rw_type', "'9'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-
-         # incorrectly coded as Non-Physical Street Segment
-        ('segmentid', "'0174786'", 'rw_type', "'9'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0136065'", 'rw_type', "'9'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0180628'", 'rw_type', "'9'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0180621'", 'rw_type', "'9'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0180563'", 'rw_type', "'9'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0180625'", 'rw_type', "'9'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0180612'", 'rw_type', "'9'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0180657'", 'rw_type', "'9'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-
-        # rename streets
-         # was 70 STREET
-        ('segmentid', "'0174839'", 'street', "'45 AVENUE'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0174841'", 'street', "'45 AVENUE'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0174840'", 'street', "'45 AVENUE'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-
-        # fix missing nodes (from/to)
-         # was 00000-1
-        ('segmentid', "'0320176'", 'nodeidfrom', "'9013735'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'8500414'", 'nodeidto', "'9012927'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'8500521'", 'nodeidfrom', "'9012929'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0320175'", 'nodeidto', "'9013736'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'9016530'", 'nodeidfrom', "'9012931'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0320122'", 'nodeidto', "'9011373'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-
-        # fix node levels
-        ('segmentid', "'0176861'", 'nodelevelt', "'M'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was *
-        ('segmentid', "'0176861'", 'nodelevelf', "'M'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was *
-        ('segmentid', "'0176861'", 'rb_layer', "'B'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was G
-
-        ('segmentid', "'0122207'", 'nodelevelt', "'M'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was *
-        ('segmentid', "'0122207'", 'nodelevelf', "'M'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was *
-        ('segmentid', "'0122207'", 'rb_layer', "'B'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was G
-
-        ('segmentid', "'0175063'", 'nodelevelt', "'M'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was *
-        ('segmentid', "'0175063'", 'nodelevelf', "'M'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was *
-        ('segmentid', "'0175063'", 'rb_layer', "'B'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),  # was G
-
-         # need to treat it as a street (not highway)
-        ('segmentid', "'0188328'", 'nonped', "'D'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0051303'", 'nonped', "'D'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0051299'", 'nonped', "'D'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0051411'", 'nonped', "'D'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0188327'", 'nonped', "'D'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0262057'", 'nonped', "'D'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-
-        # need to treat as faux segment
-        ('segmentid', "'0136096'", 'segmenttyp', "'F'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-
-        # should be coded as driveway
-        ('segmentid', "'0162857'", 'street', "'DRIVEWAY'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0162858'", 'street', "'DRIVEWAY'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        ('segmentid', "'0162859'", 'street', "'DRIVEWAY'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-        # not really a driveway but should be treated as such
-        ('segmentid', "'0291553'", 'street', "'DRIVEWAY'", "{}.{}".format(params.WORKING_SCHEMA, params.LION)),
-
-
-        # Fix rpl file errors
-        ('segmentidr', "134507", 'segmentidg', "313540", "{}.{}".format(params.WORKING_SCHEMA, params.RPL)),
-        ('segmentidr', "134506", 'segmentidg', "313540", "{}.{}".format(params.WORKING_SCHEMA, params.RPL)),
-
-        ('rpl_id', "8821", 'segmentidg', "NULL", "{}.{}".format(params.WORKING_SCHEMA, params.RPL)),
-        ('rpl_id', "8821", 'g_frnd', "NULL", "{}.{}".format(params.WORKING_SCHEMA, params.RPL))
-    ]
-
     print '\n'*25
-    suf.run()
-    setup_database(db)  # 221 sec
-    # temporary unitl gdb to db is fixed passing through shp casues problems
-    suf.temp_name_fix(db, params.WORKING_SCHEMA, params.LION)
-    #     2. Define street network to use (centerline)
-    manual_fixes(db, fixes)
-    define_usable_street_network(db, params.WORKING_SCHEMA, params.LION)
-    define_ramps(db, params.WORKING_SCHEMA, params.LION)
-    #     3. Define Intersections
-    build_generic_node_levels(db, params.WORKING_SCHEMA, params.NODE, params.LION, params.RPL)
-    build_street_name_table(db, params.WORKING_SCHEMA, params.LION, params.NODE)
+
+
+def node_names_stage(ctx):
     params.nodeStreetNames, params.nodeIsIntersection = node_names(
-        db,
+        ctx['db'],
         params.nodeStreetNames,
         params.nodeIsIntersection,
         params.WORKING_SCHEMA,
         params.NODE)
-    #     4. Build street network graph
-    params.nodeNextSteps = graph(
-        db,
-        params.nodeNextSteps,
+
+
+def graph_stage(ctx):
+    params.streetGraph = graph(
+        ctx['db'],
         params.WORKING_SCHEMA,
         params.LION)
+
+
+def search_stage(ctx):
     params.nodeStreetNames, params.streetSet = search(
         params.nodeStreetNames,
         params.streetSet,
         params.nodeIsIntersection,
-        params.nodeNextSteps)
-    params.altGraph = generate_blocks_from_masterids(
-        db,
-        params.altGraph,
+        params.streetGraph)
+
+
+def generate_blocks_stage(ctx):
+    params.mft1Dict = generate_blocks_from_masterids(
+        ctx['db'],
+        params.streetGraph,
         params.streetSet,
         params.mft1Dict,
-        params.FOLDER,
         params.LION,
         params.WORKING_SCHEMA)
 
-    update_blocks_limit_to_1_street_name(db,
-                                         params.LION,
-                                         params.WORKING_SCHEMA)
-
 
+def cluster_stage(ctx):
     params.clusterIntersections = intersection_cluster_dict(
         params.nodeStreetNames,
         params.clusterIntersections,
         params.nodeIsIntersection)
-    params.clusterIntersections = subset_merge_with_superset(  # 14 min!?!
-        db,
+
+
+def subset_merge_stage(ctx):
+    params.clusterIntersections = subset_merge_with_superset(
+        ctx['db'],
         params.WORKING_SCHEMA,
         params.clusterIntersections,
         params.nodeStreetNames)
-    params.clusterIntersections, params.nodeMaster, params.masterNodes = master_intersection_first_pass(
+
+
+def first_pass_stage(ctx):
+    params.clusterIntersections, params.nodeMaster = master_intersection_first_pass(
         params.clusterIntersections,
-        params.nodeMaster,
-        params.masterNodes)
-    #     6. Build simplified network - nodes
-    pct_lookup, pct_neighbors, node_coords = get_all_database_needs_for_distance_check(
-        db,
+        params.nodeMaster)
+
+
+def distance_check_stage(ctx):
+    ctx['pct_lookup'], ctx['pct_neighbors'], ctx['node_coords'] = get_all_database_needs_for_distance_check(
+        ctx['db'],
         params.WORKING_SCHEMA,
         params.NODE,
         params.PRECINCTS)
-    problem_masters = find_masters_with_distant_nodes(
-        params.masterNodes,
+
+
+def distant_nodes_stage(ctx):
+    ctx['problem_masters'] = find_masters_with_distant_nodes(
+        params.nodeMaster.groups(),
         params.nodeIsIntersection,
-        node_coords)
-    params.nodeMaster, params.masterNodes, params.nodeStreetNames = update_problem_groups(
-        problem_masters,
-        pct_lookup,
+        ctx['node_coords'])
+    params.nodeMaster, params.nodeStreetNames = update_problem_groups(
+        ctx['problem_masters'],
+        ctx['pct_lookup'],
         params.nodeMaster,
-        params.masterNodes,
         params.nodeStreetNames)
-    params.nodeMaster, params.masterNodes = near_by_simple(
-        db,
+
+
+def near_by_stage(ctx):
+    params.nodeMaster = near_by_simple(
+        ctx['db'],
         params.WORKING_SCHEMA,
         params.NODE,
         params.nodeMaster,
-        params.masterNodes,
         75)
-    tri, params.nodeMaster, params.masterNodes = triangle(
-        node_coords,
-        params.nodeNextSteps,
+
+
+def triangle_stage(ctx):
+    ctx['tri'], params.nodeMaster = triangle(
+        ctx['node_coords'],
+        params.streetGraph,
         params.nodeMaster,
-        params.masterNodes,
         params.nodeIsIntersection,
         150)
-    update_db_nodes(db,
-                    params.WORKING_SCHEMA,
-                    params.NODE,
-                    params.FOLDER,
-                    params.nodeMaster)
-    #     7. Generate stable master ids
-    stabilize_masters(db,
-                      params.NODE,
-                      params.WORKING_SCHEMA)
-    #     8. Rebuild street network with new masterid info
-    remap_from_to_masters(
-        db,
-        params.LION,
-        params.NODE,
-        params.WORKING_SCHEMA)
-    #     9. Update roadbeds
-    update_roadbeds(
-        db,
-        params.WORKING_SCHEMA,
-        params.LION,
-        params.RPL)
-    update_roadbed_nodes(
-        db,
-        params.WORKING_SCHEMA,
-        params.NODE,
-        params.RPL)
-    #     10. Generate corridors
-    corridor_names(db)
-    dissolve_corridors(db)
-    corridor_id(db)
-    add_corridor_to_lion(db)
 
-    db.dbClose()
-    del db
 
+# (snapshot label, stage a run started from the snapshot continues with)
+# clusters: before clustering, first_pass: first pass masters and the distance check data (tolerance tuning),
+# masters: the final merged masters
+SNAPSHOTS = [('clusters', 'intersection_cluster_dict'), ('first_pass', 'split_distant_masters'),
+             ('masters', 'update_db_nodes')]
+
+
+def snapshot_folder():
+    return params.SNAPSHOT_FOLDER or os.path.join(params.FOLDER, 'snapshots')
+
+
+def snapshot_stage(ctx, label):
+    # run(from_snapshot=label) or --from-snapshot label picks up from here without rebuilding the state
+    snapshot.save_params(snapshot_folder(), params.VERSION, ctx, label)
+
+
+def import_districts_stage(ctx):
+    import_districts(ctx['db'], params.WORKING_SCHEMA, params.FOLDER + '/DATA')
+    add_version(ctx['db'], params.WORKING_SCHEMA, params.VERSION, DISTRICT_TABLES)
+
+
+PUBLISHED = ['master_seg_geo_lookup', 'master_node_geo_lookup', 'node_stnameft', 'altnames']
+
+
+def permissions_stage(ctx):
+    db = ctx['db']
+    tables = [params.LION, params.NODE] + PUBLISHED
+    # versions, grants and comments go in together or not at all
+    with db.transaction():
+        add_version(db, params.WORKING_SCHEMA, params.VERSION, tables[2:])
+        statements = []
+        for table in tables:
+            statements.append("grant all on {s}.{t} to public;".format(
+                s=params.WORKING_SCHEMA,
+                t=table
+            ))
+            statements.append("""
+                           comment on table {s}.{t} is 'Created by {u} on {d}'
+                           """.format(s=params.WORKING_SCHEMA,
+                                      t=table,
+                                      u=getpass.getuser(),
+                                      d=datetime.now().strftime('%Y-%m-%d %H:%M')))
+        db.batch(statements)
+
+
+def stages():
+    S = pipeline.Stage
+    lion, node, rpl = params.LION, params.NODE, params.RPL
+    corridor = '{}.corridor'.format(lion)
+    return [
+        #     1. Setup databases
+        S('archive', archive_stage, reads=[lion, node], writes=['prompt']),
+        # downloads wait for the archive prompt
+        S('setup_folder', lambda ctx: suf.run(), reads=['prompt'], writes=['folder']),
+        S('setup_database', lambda ctx: setup_database(ctx['db'], districts=False),
+          reads=['folder'], writes=[lion, node, rpl, 'altnames']),
+        S('import_districts', import_districts_stage, reads=['folder'], writes=DISTRICT_TABLES),
+        # temporary unitl gdb to db is fixed passing through shp casues problems
+        S('temp_name_fix', lambda ctx: suf.temp_name_fix(ctx['db'], params.WORKING_SCHEMA, lion),
+          reads=[lion], writes=[lion]),
+        #     2. Define street network to use (centerline)
+        S('manual_fixes', lambda ctx: manual_fixes(ctx['db'], params.MANUAL_FIXES, params.WORKING_SCHEMA, lion, rpl),
+          reads=[lion, rpl], writes=[lion, rpl]),
+        S('define_usable_street_network',
+          lambda ctx: define_usable_street_network(ctx['db'], params.WORKING_SCHEMA, lion),
+          reads=[lion], writes=[lion]),
+        S('define_ramps', lambda ctx: define_ramps(ctx['db'], params.WORKING_SCHEMA, lion),
+          reads=[lion], writes=[lion]),
+        # only writes the district columns, so it runs alongside the intersection stages that read lion
+        S('add_districts', lambda ctx: add_districts(ctx['db'], params.WORKING_SCHEMA, lion),
+          reads=[lion] + DISTRICT_TABLES, writes=['{}.districts'.format(lion)]),
+        #     3. Define Intersections
+        S('build_generic_node_levels',
+          lambda ctx: build_generic_node_levels(ctx['db'], params.WORKING_SCHEMA, node, lion, rpl),
+          reads=[lion, node, rpl], writes=['node_levels']),
+        S('build_street_name_table', lambda ctx: build_street_name_table(ctx['db'], params.WORKING_SCHEMA, lion, node),
+          reads=[lion, node, 'node_levels'], writes=[node, 'node_stnameft', 'doubles']),
+        S('node_names', node_names_stage,
+          reads=[node, 'node_stnameft', 'params.nodeStreetNames', 'params.nodeIsIntersection'],
+          writes=['params.nodeStreetNames', 'params.nodeIsIntersection', 'params.streetIds']),
+        #     4. Build street network graph
+        S('graph', graph_stage, reads=[lion], writes=['params.streetGraph']),
+        S('search', search_stage,
+          reads=['params.nodeStreetNames', 'params.nodeIsIntersection', 'params.streetGraph'],
+          writes=['params.nodeStreetNames', 'params.streetSet']),
+        S('generate_blocks_from_masterids', generate_blocks_stage,
+          reads=[lion, 'params.streetGraph', 'params.streetSet'], writes=[lion, 'params.mft1Dict']),
+        S('update_blocks_limit_to_1_street_name',
+          lambda ctx: update_blocks_limit_to_1_street_name(ctx['db'], lion, params.WORKING_SCHEMA),
+          reads=[lion], writes=[lion]),
+        #     5. Cluster intersections
+        S('snapshot_clusters', lambda ctx: snapshot_stage(ctx, 'clusters'),
+          reads=['params.' + name for name in STATE_NAMES], writes=['snapshot_clusters']),
+        S('intersection_cluster_dict', cluster_stage,
+          reads=['params.nodeStreetNames', 'params.nodeIsIntersection'], writes=['params.clusterIntersections']),
+        S('subset_merge_with_superset', subset_merge_stage,
+          reads=['doubles', 'params.clusterIntersections', 'params.nodeStreetNames', 'params.streetIds'],
+          writes=['params.clusterIntersections']),
+        S('master_intersection_first_pass', first_pass_stage,
+          reads=['params.clusterIntersections', 'params.nodeMaster'],
+          writes=['params.clusterIntersections', 'params.nodeMaster']),
+        #     6. Build simplified network - nodes
+        S('distance_check_data', distance_check_stage,
+          reads=[node, params.PRECINCTS], writes=['ctx.pct_lookup', 'ctx.pct_neighbors', 'ctx.node_coords']),
+        S('snapshot_first_pass', lambda ctx: snapshot_stage(ctx, 'first_pass'),
+          reads=['params.' + name for name in STATE_NAMES] + ['ctx.' + name for name in snapshot.CTX_NAMES],
+          writes=['snapshot_first_pass']),
+        S('split_distant_masters', distant_nodes_stage,
+          reads=['params.nodeMaster', 'params.nodeIsIntersection', 'params.nodeStreetNames', 'ctx.node_coords',
+                 'ctx.pct_lookup'],
+          writes=['params.nodeMaster', 'params.nodeStreetNames', 'ctx.problem_masters']),
+        S('near_by_simple', near_by_stage, reads=[node, 'params.nodeMaster'], writes=['params.nodeMaster']),
+        S('triangle', triangle_stage,
+          reads=['ctx.node_coords', 'params.streetGraph', 'params.nodeMaster', 'params.nodeIsIntersection'],
+          writes=['params.nodeMaster', 'ctx.tri']),
+        S('snapshot_masters', lambda ctx: snapshot_stage(ctx, 'masters'),
+          reads=['params.' + name for name in STATE_NAMES] + ['ctx.' + name for name in snapshot.CTX_NAMES],
+          writes=['snapshot_masters']),
+        S('update_db_nodes', lambda ctx: update_db_nodes(ctx['db'], params.WORKING_SCHEMA, node, params.nodeMaster),
+          reads=[node, 'params.nodeMaster'], writes=[node]),
+        #     7. Generate stable master ids
+        S('stabilize_masters', lambda ctx: stabilize_masters(ctx['db'], node, params.WORKING_SCHEMA),
+          reads=[node], writes=[node]),
+        #     8. Rebuild street network with new masterid info
+        S('remap_from_to_masters', lambda ctx: remap_from_to_masters(ctx['db'], lion, node, params.WORKING_SCHEMA),
+          reads=[lion, node], writes=[lion]),
+        #     9. Update roadbeds
+        S('update_roadbeds', lambda ctx: update_roadbeds(ctx['db'], params.WORKING_SCHEMA, lion, rpl),
+          reads=[lion, rpl], writes=[lion]),
+        S('update_roadbed_nodes', lambda ctx: update_roadbed_nodes(ctx['db'], params.WORKING_SCHEMA, node, rpl),
+          reads=[lion, node, rpl], writes=[node]),
+        #     10. Generate corridors
+        # corridor stages only write the corridor columns (corridor_street, cid)
+        S('corridor_names', lambda ctx: corridor_names(ctx['db']), reads=[lion], writes=[corridor]),
+        S('dissolve_corridors', lambda ctx: dissolve_corridors(ctx['db']),
+          reads=[lion, corridor], writes=[corridor, '_corridor_']),
+        S('corridor_id', lambda ctx: corridor_id(ctx['db']),
+          reads=['_corridor_'], writes=['_corridor_', '_corridor2_', '_corridor3_']),
+        S('add_corridor_to_lion', lambda ctx: add_corridor_to_lion(ctx['db']),
+          reads=[lion, corridor, '_corridor2_'], writes=[corridor, '_corridor_', '_corridor2_']),
+        #     11.  Make master geom lookup tables
+        S('make_master_node_lookup',
+          lambda ctx: make_master_node_lookup(ctx['db'], params.WORKING_SCHEMA, node, params.VERSION),
+          reads=[node], writes=['master_node_geo_lookup']),
+        S('make_master_segment_lookup',
+          lambda ctx: make_master_segment_lookup(ctx['db'], params.WORKING_SCHEMA, lion, params.VERSION),
+          reads=[lion], writes=['master_seg_geo_lookup']),
+        #     12.  Make views
+        S('street_name_view', lambda ctx: street_name_view(ctx['db'], params.WORKING_SCHEMA, lion),
+          reads=[lion, 'altnames'], writes=['v_street_names', 'v_street_name_aliases']),
+        S('ramp_intersection_views',
+          lambda ctx: ramp_intersection_views(ctx['db'], params.WORKING_SCHEMA, node, lion),
+          reads=[lion, node], writes=['v_ramp_intersections']),
+        #     13. Cleanup and index
+        S('add_indexes', lambda ctx: add_indexes(ctx['db'], node, lion, params.WORKING_SCHEMA),
+          reads=[lion, node], writes=[lion, node]),
+        S('permissions', permissions_stage,
+          reads=[lion, node] + PUBLISHED, writes=[lion, node] + PUBLISHED),
+    ]
 
-def index_and_permissions():
-    print '\nIndex and permissions...\n'
-    # split here, because db was hanging somewhere in the make lookup when run in full, run in pieces was fine
-    db = db2.PostgresDb(params.DB_HOST, params.DB_NAME, quiet=True)
-    #     11.  Make master geom lookup tables
-    make_master_node_lookup(
-        db,
-        params.WORKING_SCHEMA,
-        params.NODE,
-        params.VERSION)
-    make_master_segment_lookup(
-        db,
-        params.WORKING_SCHEMA,
-        params.LION,
-        params.VERSION)
-    #     12.  Make views
-    street_name_view(
-        db,
-        params.WORKING_SCHEMA,
-        params.LION)
-    ramp_intersection_views(
-        db,
-        params.WORKING_SCHEMA,
-        params.NODE,
-        params.LION)
 
-#     13. Cleanup and index
-    add_indexes(db,
-                params.NODE,
-                params.LION,
-                params.WORKING_SCHEMA)
-    tables = [
-        params.LION,
-        params.NODE,
-        'master_seg_geo_lookup',
-        'master_node_geo_lookup',
-        'node_stnameft',
-        'altnames'
-    ]
-    add_version(db, params.WORKING_SCHEMA, params.VERSION, tables[2:])
-    for table in tqdm(tables):
-        db.query("grant all on {s}.{t} to public;".format(
-            s=params.WORKING_SCHEMA,
-            t=table
-        ))
-        db.query("""
-                       comment on table {s}.{t} is 'Created by {u} on {d}'
-                       """.format(s=params.WORKING_SCHEMA,
-                                  t=table,
-                                  u=getpass.getuser(),
-                                  d=datetime.now().strftime('%Y-%m-%d %H:%M')))
+@db2.timeDec
+def run(resume=False, from_stage=None, only=None, workers=params.PIPELINE_WORKERS, from_snapshot=None):
+    """
+    Runs the CLION stages, finished stages are recorded in WORKING_SCHEMA.clion_run_state and in memory
+    structures are checkpointed to CHECKPOINT_FOLDER so a failed run can be picked up where it stopped
+     :resume kwarg: continue the latest run, skipping its finished stages
+     :from_stage kwarg: rerun the latest run from this stage on
+     :only kwarg: rerun just these stages of the latest run
+     :workers kwarg: stages run at once (each on its own connection) when they do not depend on each other
+     :from_snapshot kwarg: snapshot label (SNAPSHOTS) of VERSION to start a new run from, the database tables
+                           are used as they are (the stages after the snapshot rewrite what they need)
+     :return: database connection of the last stage
+    """
+    db = db2.PostgresDb(params.DB_HOST, params.DB_NAME, quiet=True)
+    db.capture_plans(params.EXPLAIN_THRESHOLD)
+    ctx, start = {'db': db}, None
+    if from_snapshot:
+        start = dict(SNAPSHOTS)[from_snapshot]
+        ctx.update(snapshot.load(snapshot_folder(), params.VERSION, from_snapshot).restore())
+    pipe = pipeline.Pipeline(stages(), ctx, params.WORKING_SCHEMA,
+                             params.CHECKPOINT_FOLDER or os.path.join(params.FOLDER, 'checkpoints'), STATE_NAMES)
+    with run_trace.tracer.span('pipeline', 'CLION {}'.format(params.VERSION)):
+        db = pipe.run(resume, from_stage, only, workers, start)['db']
+    print pipe.report()
+    if db.plan_log:
+        db.plan_log.save(db, params.WORKING_SCHEMA)
+        print db.plan_log.summary()
 
     print '\n\n'
     print '#' * 50
     print '\n{s}DONE\n'.format(s=' '*23)
     print '#' * 50
+    return db
+
+
+def index_and_permissions():
+    # reruns steps 11 - 13 of the latest run
+    return run(from_stage='make_master_node_lookup')
 
 
 if __name__ == '__main__':
-    run()
-    index_and_permissions()
+    parser = argparse.ArgumentParser(description='Build CLION from LION')
+    parser.add_argument('--resume', action='store_true', help='continue the latest run, skipping finished stages')
+    parser.add_argument('--from-stage', help='rerun the latest run from this stage on')
+    parser.add_argument('--only', help='comma separated stages of the latest run to rerun')
+    parser.add_argument('--workers', type=int, default=params.PIPELINE_WORKERS,
+                        help='stages to run at once, 1 runs them in order on one connection')
+    parser.add_argument('--from-snapshot', choices=[label for label, stage in SNAPSHOTS],
+                        help='start a new run from a snapshot of VERSION in SNAPSHOT_FOLDER')
+    args = parser.parse_args()
+    # stage and statement timings are written to FOLDER/clion_run_<run id>.json and WORKING_SCHEMA.clion_run_stats
+    stats_db = run(args.resume, args.from_stage, args.only.split(',') if args.only else None, args.workers,
+                   args.from_snapshot)
+    run_trace.tracer.save(stats_db, params.WORKING_SCHEMA, params.FOLDER, params.VERSION)
@@ -7,16 +7,106 @@ from collections import defaultdict, namedtuple
 import csv
 import sys
 import os
+import re
 import subprocess
+import itertools
+from contextlib import contextmanager
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+from cStringIO import StringIO
+import run_trace
+import plan_capture
+
+
+# query results, built once instead of on every call
+output = namedtuple('output', 'data, columns')
+_row_types = dict()  # {column names: namedtuple row class}
+_cursor_ids = itertools.count(1)  # server side cursor names
+
+
+def row_type(columns):
+    # namedtuple class for a result's column names, cached so each result shape is only built once
+    columns = tuple(columns)
+    if columns not in _row_types:
+        _row_types[columns] = namedtuple('row', columns)
+    return _row_types[columns]
+
+
+def escape_query(qry):
+    # literal % for psycopg2, -pct- is written where a real % is wanted
+    qry = qry.replace('%', '%%')
+    return qry.replace('-pct-', '%')
+
+
+# SQLSTATEs worth retrying: serialization failure, deadlock, lock not available (lock_timeout),
+# query canceled (statement_timeout), class 08 is connection exceptions
+TRANSIENT_CODES = ('40001', '40P01', '55P03', '57014')
+
+
+class QueryError(Exception):
+    """
+    A query that failed (after any retries), raised instead of exiting so the caller can decide
+     :qry param: the query
+     :error param: the psycopg2 error
+     :transient param: True for connection loss, serialization failures, deadlocks and lock / statement timeouts
+    """
+    def __init__(self, qry, error, transient=False):
+        self.qry = qry
+        self.error = error
+        self.pgcode = getattr(error, 'pgcode', None)
+        self.transient = transient
+        Exception.__init__(self, '{}{}: {}'.format(
+            'Transient error ' if transient else '', self.pgcode or type(error).__name__, str(error).strip()))
+
+
+def is_transient(error):
+    # True for errors where running the same statement again can work
+    code = getattr(error, 'pgcode', None)
+    if code:
+        return code in TRANSIENT_CODES or code.startswith('08')
+    # no SQLSTATE: the connection broke before the server answered
+    return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+
+READ_RE = re.compile(r'^(select|show|explain|analyze|vacuum|set|grant|revoke|comment on)\b')
+DROP_RE = re.compile(r'^drop (?:table|view|materialized view|index) if exists ([\w."]+)')
+CREATE_RE = re.compile(r'^create (?:temp\w* |unlogged )?(?:table|view|materialized view|index) ([\w."]+)')
+
+
+def idempotent(qry):
+    """
+    True when running qry again after a failure (or a commit lost with the connection) ends the same:
+    reads, drop ... if exists, create ... if not exists / or replace, add column if not exists, creating
+    what the same query dropped first (drop table if exists x; create table x as ...), grants and comments
+     :qry param: 1 or more sql statements
+    """
+    dropped = set()
+    for statement in plan_capture.split_statements(qry):
+        sql = ' '.join(plan_capture.strip_comments(statement).lower().split())
+        drop, create = DROP_RE.match(sql), CREATE_RE.match(sql)
+        if drop:
+            dropped.add(drop.group(1))
+        elif create and create.group(1) in dropped:
+            continue
+        elif READ_RE.match(sql) or ' if not exists ' in sql or sql.startswith('create or replace '):
+            continue
+        elif sql.startswith('with ') and not re.search(r'\b(insert|update|delete)\b', sql):
+            continue
+        else:
+            return False
+    return True
 
 
 def timeDec(method):
+    # records the function as a stage of the run trace (run_trace.tracer) and prints its time
     def timed(*args, **kw):
         ts = time.time()
-        result = method(*args, **kw)
-        te = time.time()
-        print '%r %2.2f sec' % (method.__name__, te - ts)
+        with run_trace.tracer.span('stage', method.__name__):
+            result = method(*args, **kw)
+        print '%r %2.2f sec' % (method.__name__, time.time() - ts)
         return result
+    timed.__name__ = method.__name__
+    timed.__doc__ = method.__doc__
     return timed
 
 
@@ -28,9 +118,13 @@ class PostgresDb(object):
          :user kwarg: username
          :db_pass kwarg: password
          :quiet kwarg: turns off print statments, useful for multiple writes
+         :retries kwarg: times query retries a transient failure of an idempotent query (default 3)
+         :backoff kwarg: seconds before the first retry, doubled for each retry up to 60 (default 2)
         """
     def __init__(self, host, db_name, **kwargs):  # user=None, db_pass=None):
         self.quiet = kwargs.get('quiet', False)
+        self.retries = kwargs.get('retries', 3)
+        self.backoff = kwargs.get('backoff', 2)
         self.params = {
             'dbname': db_name,
             'user': kwargs.get('user', None),
@@ -41,6 +135,8 @@ class PostgresDb(object):
         if not kwargs.get('db_pass', None):
             self.db_login()
         self.conn = psycopg2.connect(**self.params)
+        self.in_transaction = 0  # open transaction() blocks, statements are not committed while > 0
+        self.plan_log = None  # plan_capture.PlanCapture, see capture_plans
 
     def db_login(self):
         if not self.params['user']:
@@ -55,35 +151,253 @@ class PostgresDb(object):
     def dbClose(self):
         self.conn.close()
 
-    def query(self, qry):
-        output = namedtuple('output', 'data, columns')
+    def reconnect(self):
+        # new connection with the same settings, session state (temp tables, settings) does not carry over
+        try:
+            self.conn.close()
+        except psycopg2.Error:
+            pass
+        self.dbConnect()
+
+    def rollback(self):
+        # rollback that does not hide the original error when the connection is gone
+        try:
+            self.conn.rollback()
+        except psycopg2.Error:
+            pass
+
+    def execute(self, qry):
+        """
+        Runs qry like query, but a failed query is rolled back and the error raised instead of exiting
+         :qry param: sql
+         :return: output(data, columns), both None for statements that do not return rows
+        """
         cur = self.conn.cursor()
-        qry = qry.replace('%', '%%')
-        qry = qry.replace('-pct-', '%')
         try:
-            cur.execute(qry)
+            ts = time.time()
+            with run_trace.tracer.statement(qry) as span:
+                cur.execute(escape_query(qry))
+                if span:
+                    span.rows = cur.rowcount
+            te = time.time()
             if cur.description:
                 columns = [desc[0] for desc in cur.description]
                 data = cur.fetchall()
             else:
                 data = None
                 columns = None
-                self.conn.commit()
+                if not self.in_transaction:
+                    self.conn.commit()
                 if not self.quiet:
                     print 'Update sucessfull'
+            if self.plan_log and te - ts >= self.plan_log.threshold:
+                self.plan_log.capture(self, escape_query(qry), te - ts)
+            return output(data=data, columns=columns)
+        except:
+            self.rollback()
+            raise
+        finally:
             del cur
-            if columns:
-                return output(data=data, columns=columns)
-            else:
-                return output(data=data, columns=None)
+
+    def retry(self, attempt, error):
+        """
+        Waits before retry number attempt (exponential backoff) and reconnects if the connection was lost
+         :return: False once retries are used up
+        """
+        if attempt > self.retries:
+            return False
+        delay = min(self.backoff * 2 ** (attempt - 1), 60)
+        print 'Transient error ({}), retry {} of {} in {} sec'.format(
+            getattr(error, 'pgcode', None) or str(error).strip(), attempt, self.retries, delay)
+        time.sleep(delay)
+        if self.conn.closed:
+            try:
+                self.reconnect()
+            except psycopg2.OperationalError as e:  # still down, the next attempt fails and waits longer
+                print 'Reconnect failed: {}'.format(str(e).strip())
+        return True
+
+    def query(self, qry, retry=None):
+        """
+        Runs qry like execute, transient failures (see is_transient) are retried with exponential backoff and a
+        reconnect when the query is safe to run again and not inside a transaction() block
+         :qry param: sql
+         :retry kwarg: True / False to say if qry is safe to run again, None decides with idempotent(qry)
+         :return: output(data, columns)
+         raises QueryError for sql errors and for transient errors once the retries are used up
+        """
+        if retry is None:
+            retry = idempotent(qry)
+        attempt = 0
+        while True:
+            try:
+                return self.execute(qry)
+            except psycopg2.Error as e:
+                transient = is_transient(e)
+                attempt += 1
+                if transient and retry and not self.in_transaction and self.retry(attempt, e):
+                    continue
+                print 'Query Failed:\n'
+                for i in escape_query(qry).split('\n'):
+                    print '\t{0}'.format(i)
+                print '\t{0}'.format(str(e).strip())
+                raise QueryError(qry, e, transient)
+
+    def capture_plans(self, threshold=30):
+        """
+        Turns on EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) capture for statements slower than threshold seconds
+        the plans are kept in self.plan_log (plan_capture.PlanCapture)
+         :threshold kwarg: seconds, None turns capture off
+        """
+        self.plan_log = plan_capture.PlanCapture(threshold) if threshold is not None else None
+        return self.plan_log
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups queries into 1 transaction, committed when the block ends, rolled back if anything in it fails
+        nested blocks join the outer transaction
+            with dbo.transaction():
+                dbo.query(...)
+                dbo.query(...)
+        """
+        self.in_transaction += 1
+        try:
+            yield self
         except:
+            self.in_transaction -= 1
+            self.conn.rollback()
+            raise
+        else:
+            self.in_transaction -= 1
+            if not self.in_transaction:
+                self.conn.commit()
+
+    def batch(self, statements):
+        """
+        Sends statements to the server in 1 round trip and commits once, a failure rolls back all of them
+         :statements param: list of sql statements
+         :return: output of the last statement
+        """
+        return self.query(';\n'.join(s.strip().rstrip(';') for s in statements))
+
+    def stream(self, qry, itersize=20000, batches=False, named=False):
+        """
+        Runs a select on a named (server side) cursor and yields rows as they arrive, itersize rows per round trip
+        so large results are never held in memory all at once
+        read it to the end (or close it) before running other queries that depend on the transaction,
+        outside a transaction() block the transaction is committed once the rows are read or the stream is closed
+         :qry param: select statement
+         :itersize kwarg: rows fetched per round trip
+         :batches kwarg: yield lists of up to itersize rows instead of single rows
+         :named kwarg: yield rows as namedtuples (row_type) instead of plain tuples
+        """
+        qry = escape_query(qry)
+        attempt = 0
+        while True:
+            try:
+                # nothing has been yielded yet, so the select can be run again
+                cur = self.conn.cursor(name='stream_{}'.format(next(_cursor_ids)))
+                cur.itersize = itersize
+                cur.execute(qry)
+                rows = cur.fetchmany(itersize)
+                break
+            except psycopg2.Error as e:
+                self.rollback()
+                attempt += 1
+                if is_transient(e) and not self.in_transaction and self.retry(attempt, e):
+                    continue
+                print 'Query Failed:\n'
+                for i in qry.split('\n'):
+                    print '\t{0}'.format(i)
+                raise QueryError(qry, e, is_transient(e))
+        try:
+            make_row = row_type(desc[0] for desc in cur.description)._make if named else None
+            while rows:
+                if make_row:
+                    rows = map(make_row, rows)
+                if batches:
+                    yield rows
+                else:
+                    for row in rows:
+                        yield row
+                rows = cur.fetchmany(itersize)
+        except psycopg2.Error as e:
             print 'Query Failed:\n'
             for i in qry.split('\n'):
                 print '\t{0}'.format(i)
-            self.conn.rollback()
+            self.rollback()
+            raise QueryError(qry, e, is_transient(e))
+        finally:
+            if not cur.closed:
+                cur.close()
+            # the named cursor opened a transaction, left open it holds its locks until the next commit
+            if not self.in_transaction and not self.conn.closed:
+                self.conn.commit()
+
+    def copy_rows(self, table_name, rows, columns=None, batch_size=100000, commit=True):
+        """
+        Streams rows into a table with COPY FROM STDIN (text format) through an in memory buffer
+        all batches are sent in one transaction, nothing is written to disk
+         :table_name param: schema qualified table name
+         :rows param: iterable of row tuples/lists (None is loaded as NULL)
+         :columns kwarg: column names, defaults to all of the table's columns in order
+         :batch_size kwarg: rows per COPY buffer
+         :commit kwarg: commit when done (False to leave the transaction open for the caller)
+         :return: number of rows copied
+        """
+        copy_sql = 'COPY {t} {c} FROM STDIN'.format(t=table_name, c='({})'.format(', '.join(columns)) if columns else '')
+        cur = self.conn.cursor()
+        row_cnt = 0
+        batch = []
+        try:
+            with run_trace.tracer.statement(copy_sql) as span:
+                for row in rows:
+                    batch.append('\t'.join([copy_text(v) for v in row]))
+                    if len(batch) == batch_size:
+                        cur.copy_expert(copy_sql, StringIO('\n'.join(batch) + '\n'))
+                        row_cnt += len(batch)
+                        batch = []
+                if batch:
+                    cur.copy_expert(copy_sql, StringIO('\n'.join(batch) + '\n'))
+                    row_cnt += len(batch)
+                if span:
+                    span.rows = row_cnt
+            if commit and not self.in_transaction:
+                self.conn.commit()
+        except:
+            self.rollback()
+            raise
+        finally:
             del cur
-            sys.exit()
+        return row_cnt
+
+    def column_type(self, schema, table_name, column):
+        # sql type of a table column, ex. 'integer', 'character varying(10)'
+        return self.query("""select format_type(atttypid, atttypmod)
+                             from pg_attribute
+                             where attrelid = '{s}.{t}'::regclass and attname = '{c}' and not attisdropped
+                          """.format(s=schema, t=table_name.lower(), c=column.lower())).data[0][0]
 
+    def copy_to_temp(self, table_name, columns, rows, key=None):
+        """
+        Loads rows into a typed session temp table with COPY FROM STDIN, then adds the key and analyzes it
+        so an UPDATE ... FROM against it joins on matching types without casts
+         :table_name param: temp table name (replaced if it exists)
+         :columns param: [(column name, sql type), ...]
+         :rows param: iterable of row tuples in column order
+         :key kwarg: column to use as the primary key
+         :return: number of rows copied
+        """
+        # pg_temp, so an unqualified name can never resolve to (and drop) a permanent table
+        table_name = 'pg_temp.{}'.format(table_name)
+        self.query('drop table if exists {t}; create table {t} ({c})'.format(
+            t=table_name, c=', '.join('{} {}'.format(name, typ) for name, typ in columns)))
+        row_cnt = self.copy_rows(table_name, rows, [name for name, typ in columns])
+        if key:
+            self.query('alter table {t} add primary key ({k})'.format(t=table_name, k=key))
+        self.query('analyze {}'.format(table_name))
+        return row_cnt
 
     def import_table(self, table_name, csv, seperator=','):
         cur = self.conn.cursor()
@@ -99,6 +413,76 @@ class PostgresDb(object):
         print '{} exported to {}'.format(csv, table_name)
 
 
+class PostgresPool(object):
+    """
+        Pool of connections to the same database as an open PostgresDb, for running independent statements at once
+         :dbo param: PostgresDb to take the connection settings (and quiet) from
+         :size kwarg: number of connections
+        """
+    def __init__(self, dbo, size=4):
+        self.size = size
+        self.idle = Queue()
+        self.dbs = [PostgresDb(dbo.params['host'], dbo.params['dbname'], user=dbo.params['user'],
+                               db_pass=dbo.params['password'], quiet=dbo.quiet, retries=dbo.retries,
+                               backoff=dbo.backoff) for _ in xrange(size)]
+        for db in self.dbs:
+            self.idle.put(db)
+
+    def _work(self, item):
+        # runs 1 item on the next free connection -> (result, error)
+        db = self.idle.get()
+        try:
+            if callable(item):
+                return item(db), None
+            return db.query(item), None
+        except Exception as e:
+            return None, e
+        finally:
+            self.idle.put(db)
+
+    def run(self, items):
+        """
+        Runs items concurrently, each on its own connection, and waits for all of them
+        only for independent work, statements updating the same rows block each other (or deadlock)
+         :items param: list of sql strings (run with query) or functions that take a PostgresDb
+         :return: results, errors - lists in item order, the error is None for items that succeeded
+        """
+        items = list(items)
+        if not items:
+            return [], []
+        workers = ThreadPool(min(self.size, len(items)))
+        try:
+            out = workers.map(self._work, items, chunksize=1)
+        finally:
+            workers.close()
+            workers.join()
+        return [r for r, e in out], [e for r, e in out]
+
+    def query(self, items):
+        # run with the same failure handling as PostgresDb.query, the first error is raised once all items finish
+        items = list(items)
+        results, errors = self.run(items)
+        failed = [(item, e) for item, e in zip(items, errors) if e is not None]
+        if failed:
+            for item, e in failed:
+                if isinstance(e, QueryError):
+                    continue  # already printed by query
+                print 'Query Failed:\n'
+                for i in (escape_query(item) if isinstance(item, basestring) else repr(item)).split('\n'):
+                    print '\t{0}'.format(i)
+                print '\t{0}'.format(e)
+            item, e = failed[0]
+            if isinstance(e, QueryError) or not isinstance(e, psycopg2.Error):
+                raise e
+            raise QueryError(item if isinstance(item, basestring) else repr(item), e, is_transient(e))
+        return results
+
+    def close(self):
+        for db in self.dbs:
+            db.rollback()
+            db.dbClose()
+
+
 class SqlDb(object):
     """
     Database connection helper fucntion for MS SQL server
@@ -141,7 +525,6 @@ class SqlDb(object):
         self.conn.close()
 
     def query(self, qry):
-        output = namedtuple('output', 'data, columns')
         cur = self.conn.cursor()
         qry = qry.replace('%', '%%')
         qry = qry.replace('-pct-', '%')
@@ -170,6 +553,17 @@ class SqlDb(object):
             sys.exit()
 
 
+def copy_text(value):
+    # value in COPY text format
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
 def data_to_dict_data(data, columns):
     dictdata = defaultdict(list)
     for row in data:
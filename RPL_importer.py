@@ -1,48 +1,121 @@
 import os
-from tqdm import tqdm
+import time
+import itertools
+import numpy as np
 import params
 
 
-def read_file(file_path):
-    with open(file_path, 'r') as f:
-        read_data = f.read()
-    return read_data
-
-
-def split_to_rows(raw_data):
-    d = raw_data.split('\n')
-    output = []
-    for row in d:
-        output.append(row.split(','))
-    return output
-
-def split_to_columns(data_rows):
-    data = []
-    # ['RPL_ID', 'SegmentIDG', 'SegmentIDR', 'RPC', 'NCI',
-    #         'NodeLevelF', 'NodeLevelT', 'R_FrNd', 'G_FrNd', 'R_ToNd', 'G_ToNd']
+# RPL.txt is fixed width, one record per line
+# numeric fields: (column, start, stop), blank fields load as NULL
+NUMERIC_FIELDS = (('segmentidg', 0, 7), ('segmentidr', 8, 15), ('r_frnd', 28, 35), ('g_frnd', 36, 43),
+                  ('r_tond', 44, 51), ('g_tond', 52, 59))
+# single character fields: (column, position)
+CHAR_FIELDS = (('rpc', 16), ('nci', 18), ('nodelevelf', 22), ('nodelevelt', 26))
+RECORD_WIDTH = 59  # bytes used, lines can be longer
+RPL_COLUMNS = ('rpl_id', 'segmentidg', 'segmentidr', 'rpc', 'nci', 'nodelevelf', 'nodelevelt',
+               'r_frnd', 'g_frnd', 'r_tond', 'g_tond')
+
+
+def read_records(file_path):
+    """
+    Memory maps RPL.txt as (records, record length) uint8 arrays, nothing is read until it is sliced
+    record length is taken from the first line, every record must be the same length
+    blank lines are skipped (files with them are read line by line)
+     :file_path param: path to RPL.txt
+     :return: list of record arrays (the last line is returned on its own if it has no line break)
+    """
+    size = os.path.getsize(file_path)
+    if not size:
+        return []
+    with open(file_path, 'rb') as f:
+        first = f.readline()
+    line_end = '\r\n' if first.endswith('\r\n') else '\n'
+    width = len(first) - len(line_end) if first.endswith('\n') else len(first)
+    rec_len = width + len(line_end)
+    if width < RECORD_WIDTH:
+        raise ValueError('RPL record 1 is {} bytes, expected at least {}'.format(width, RECORD_WIDTH))
+    mm = np.memmap(file_path, dtype=np.uint8, mode='r')
+    n_full, tail = divmod(size, rec_len)
+    if (mm[rec_len - 1:n_full * rec_len:rec_len] != 10).any():
+        # a blank line breaks the fixed stride, read line by line and skip them like the old loader did
+        return [read_lines(file_path, width)]
+    blocks = [mm[:n_full * rec_len].reshape(n_full, rec_len)]
+    if tail and mm[n_full * rec_len:].tostring().strip():
+        if tail != width:
+            raise ValueError('RPL record {} is {} bytes, expected {}'.format(n_full + 1, tail, width))
+        # last line without a line break
+        last = mm[n_full * rec_len:].tostring() + line_end
+        blocks.append(np.frombuffer(last, dtype=np.uint8).reshape(1, rec_len))
+    return blocks
+
+
+def read_lines(file_path, width):
+    # (records, width + 1) uint8 array of the non blank lines, every line must be width bytes
+    rows = []
+    with open(file_path, 'rb') as f:
+        for n, line in enumerate(f, 1):
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            if len(line) != width:
+                raise ValueError('RPL line {} is {} bytes, expected {}'.format(n, len(line), width))
+            rows.append(line + '\n')
+    return np.frombuffer(''.join(rows), dtype=np.uint8).reshape(len(rows), width + 1)
+
+
+def decode_numeric(field):
+    """
+    Digits to integers for a (records, width) uint8 field, leading and trailing spaces are skipped
+     :field param: uint8 array
+     :return: int64 masked array (masked where the field is blank), bool array of invalid records
+             (anything but digits and spaces, or a space between digits like '12 34')
+    """
+    is_digit = (field >= 48) & (field <= 57)
+    is_space = field == 32
+    # spaces after the first digit, a digit after one of them is inside the number
+    gap = np.logical_or.accumulate(is_space & np.logical_or.accumulate(is_digit, axis=1), axis=1)
+    invalid = ~(is_digit | is_space).all(axis=1) | (is_digit & gap).any(axis=1)
+    value = np.zeros(len(field), dtype=np.int64)
+    for j in xrange(field.shape[1]):
+        value = np.where(is_digit[:, j], value * 10 + (field[:, j].astype(np.int64) - 48), value)
+    return np.ma.masked_array(value, mask=~is_digit.any(axis=1)), invalid
+
+
+def parse_batches(file_path, batch_size=50000):
+    """
+    Decodes every fixed width field of a batch of records at once and validates record length
+    and numeric fields in the same pass
+     :file_path param: path to RPL.txt
+     :batch_size kwarg: records per batch
+     :return: generator of {column: array} batches, rpl_id numbers the records from 1
+    """
     idn = 0
-    for row in data_rows:
-        if row != ['']:
-            # print row
-            idn += 1
-            g_seg = row[0][:7]
-            g_seg_typ = row[0][7]
-            r_seg = row[0][8:15]
-            rpc = row[0][16]
-            nci = row[0][18]
-            fnode_level_code = row[0][22]
-            tnode_level_code = row[0][26]
-            f_node_rb_seg = row[0][28:35]
-            f_node_g_seg = row[0][36:43]
-            t_node_rb_seg = row[0][44:51]
-            t_node_g_seg = row[0][52:59]
-            data.append([idn, g_seg, r_seg, rpc, nci, fnode_level_code, tnode_level_code,
-                         f_node_rb_seg, f_node_g_seg, t_node_rb_seg, t_node_g_seg])
-    return data
-
-
-
-def add_to_db(db, data, rpl):
+    for records in read_records(file_path):
+        for b in xrange(0, len(records), batch_size):
+            chunk = records[b:b + batch_size]
+            # every record ends with a line break at the same position, so all are the same length
+            bad = np.flatnonzero(chunk[:, -1] != 10)
+            if len(bad):
+                raise ValueError('RPL record {} is not {} bytes'.format(idn + bad[0] + 1, chunk.shape[1] - 1))
+            batch = {'rpl_id': np.arange(idn + 1, idn + len(chunk) + 1, dtype=np.int64)}
+            for column, start, stop in NUMERIC_FIELDS:
+                batch[column], invalid = decode_numeric(chunk[:, start:stop])
+                if invalid.any():
+                    i = np.flatnonzero(invalid)[0]
+                    raise ValueError('RPL record {} has a non numeric {}: {!r}'.format(
+                        idn + i + 1, column, chunk[i, start:stop].tostring()))
+            for column, pos in CHAR_FIELDS:
+                batch[column] = np.ascontiguousarray(chunk[:, pos]).view('S1')
+            idn += len(chunk)
+            yield batch
+
+
+def batch_rows(batch):
+    # {column: array} batch -> row lists in RPL_COLUMNS order (masked values are None)
+    return itertools.izip(*[batch[column].tolist() for column in RPL_COLUMNS])
+
+
+def add_to_db(db, batches, rpl):
     rpl_table = 'tbl_'+rpl[:-4].lower()
     cur = db.conn.cursor()  # use cursor rather than full method to avoid noisy print statements
     # make sure table exists and is clean
@@ -58,21 +131,13 @@ def add_to_db(db, data, rpl):
     db.conn.commit()
     del cur
     print 'Adding RPL data'
-    for row in tqdm(data):
-        if row[0] != 'RPL_ID':
-            add_row(db, row)
-
-
-def add_row(db, row):
-    cur = db.conn.cursor()
-    if row[0]:
-        cur.execute("""INSERT INTO {s}.tbl_rpl (rpl_id, segmentidg, segmentidr, rpc, nci,nodelevelf,
-                        nodelevelt, r_frnd, g_frnd, r_tond, g_tond)
-                        VALUES ({v});
-                    """.format(s=params.WORKING_SCHEMA, v=str(row)[1:-1]))
-        db.conn.commit()
-        del cur
-        #print 'Added %s' % row[0]
+    start = time.time()
+    # stream the rows in with COPY, one transaction
+    row_cnt = db.copy_rows('{s}.{t}'.format(s=params.WORKING_SCHEMA, t=rpl_table),
+                           itertools.chain.from_iterable(batch_rows(batch) for batch in batches),
+                           columns=RPL_COLUMNS)
+    elapsed = max(time.time() - start, 0.001)
+    print '{} RPL rows added in {:.1f} sec ({:.0f} rows/sec)'.format(row_cnt, elapsed, row_cnt / elapsed)
 
 
 def add_manual_fix_flig(db, rpl):
@@ -80,10 +145,7 @@ def add_manual_fix_flig(db, rpl):
 
 
 def run(db, folder, rpl):
-    r_data = read_file(os.path.join(folder, rpl))
-    dta = split_to_rows(r_data)
-    split_data = split_to_columns(dta)
-    add_to_db(db, split_data, rpl)
+    add_to_db(db, parse_batches(os.path.join(folder, rpl)), rpl)
     add_manual_fix_flig(db, params.RPL)
 
 
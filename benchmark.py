@@ -0,0 +1,137 @@
+import os
+import csv
+import math
+import argparse
+from collections import defaultdict
+import params
+import pipeline
+import run_trace
+import master_groups
+import street_names
+import synthetic_lion
+import RIS_Tools as db2
+import CLION
+
+# stages that need the downloaded data (or a person), the synthetic network stands in for what they load
+# manual_fixes is for real LION ids, synthetic ids in the same range would be rewritten into another network
+SKIP = ('archive', 'setup_folder', 'setup_database', 'import_districts', 'temp_name_fix', 'manual_fixes')
+SUPERLINEAR = 1.2  # growth exponent above which a stage is flagged
+
+
+def reset_state():
+    # empties the params globals in place, so each scale starts from a fresh network state
+    for name, value in (('streetIds', street_names.StreetDictionary()),
+                        ('nodeStreetNames', defaultdict(params.st_name_factory)),
+                        ('nodeIsIntersection', {}),
+                        ('streetGraph', None),
+                        ('nodeMaster', master_groups.MasterGroups()),
+                        ('clusterIntersections', defaultdict(params.st_name_factory)),
+                        ('streetSet', []),
+                        ('mft1Dict', defaultdict(list))):
+        pipeline.restore(params, name, value)
+
+
+def run_scale(db, segments, folder, **kwargs):
+    """
+    Loads a synthetic network of about segments centerline segments into WORKING_SCHEMA and runs the CLION
+    stages on it, one at a time (cpu time and memory are of the whole process, so stages running at once
+    could not be told apart)
+     :db param: PostgresDb of the benchmark database (tables in WORKING_SCHEMA are replaced)
+     :segments param: target lion size
+     :folder param: folder for RPL.txt, checkpoints and snapshots of this scale
+     :kwargs: SyntheticLion options
+     :return: [{segments, nodes, stage, wall_sec, cpu_sec, peak_mem_mb}]
+    """
+    net = synthetic_lion.SyntheticLion.from_segments(segments, **kwargs)
+    db.query('create schema if not exists {}'.format(params.WORKING_SCHEMA))
+    lion_rows, node_rows = net.load(db, params.WORKING_SCHEMA, folder)
+    CLION.add_version(db, params.WORKING_SCHEMA, params.VERSION,
+                      [params.LION, params.NODE, params.RPL] + CLION.DISTRICT_TABLES)
+    CLION.add_clion_columns(db, params.WORKING_SCHEMA, params.LION, params.NODE)
+    reset_state()
+    params.SNAPSHOT_FOLDER = os.path.join(folder, 'snapshots')
+    pipe = pipeline.Pipeline([stage for stage in CLION.stages() if stage.name not in SKIP], {'db': db},
+                             params.WORKING_SCHEMA, os.path.join(folder, 'checkpoints'), CLION.STATE_NAMES)
+    with run_trace.tracer.span('pipeline', 'benchmark {}'.format(lion_rows)) as root:
+        pipe.run(workers=1)
+    print pipe.report()
+    return [{'segments': lion_rows, 'nodes': node_rows, 'stage': sp.name, 'wall_sec': sp.wall, 'cpu_sec': sp.cpu,
+             'peak_mem_mb': sp.peak_mem} for sp in root.children if sp.kind == 'stage']
+
+
+def exponent(small, large):
+    # growth of a stage between 2 scales, time ~ segments ** exponent
+    if not (small['wall_sec'] and large['wall_sec']) or large['segments'] == small['segments']:
+        return None
+    return math.log(large['wall_sec'] / small['wall_sec']) / math.log(float(large['segments']) / small['segments'])
+
+
+def write_csv(results, out_file):
+    columns = ['segments', 'nodes', 'stage', 'wall_sec', 'cpu_sec', 'peak_mem_mb']
+    with open(out_file, 'wb') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def report(results):
+    """
+    Stage times by scale with the growth exponent between the smallest and largest scale,
+    stages growing faster than SUPERLINEAR are marked with *
+    memory is how far the process grew above its size at the start of the stage (run_trace)
+     :results param: run_scale rows of 1 or more scales
+     :return: printable text
+    """
+    scales = sorted(set(r['segments'] for r in results))
+    by_stage = defaultdict(dict)
+    order = []
+    for r in results:
+        if r['stage'] not in by_stage:
+            order.append(r['stage'])
+        by_stage[r['stage']][r['segments']] = r
+    lines = ['{:<40} {}  {:>6}'.format('stage', ' '.join('{:>12}'.format(s) for s in scales), 'exp'),
+             '{:<40} {}'.format('', ' '.join('{:>12}'.format('sec / MB') for _ in scales))]
+    for stage in order:
+        runs = by_stage[stage]
+        cells = ['{:>6.1f}/{:<5.0f}'.format(runs[s]['wall_sec'], runs[s]['peak_mem_mb'] or 0)
+                 if s in runs else '{:>12}'.format('-') for s in scales]
+        done = [s for s in scales if s in runs]
+        exp = exponent(runs[done[0]], runs[done[-1]]) if len(done) > 1 else None
+        lines.append('{:<40} {}  {:>6}{}'.format(stage, ' '.join(cells), '' if exp is None else '{:.2f}'.format(exp),
+                                                 ' *' if exp is not None and exp > SUPERLINEAR else ''))
+    lines.append('{:<40} {}'.format('total', ' '.join(
+        '{:>12.1f}'.format(sum(r['wall_sec'] for r in results if r['segments'] == s)) for s in scales)))
+    return '\n'.join(lines)
+
+
+def run(scales, folder, host=params.DB_HOST, db_name='clion_benchmark', **kwargs):
+    """
+    Runs every scale on a new synthetic network in db_name (a scratch PostGIS database, its WORKING_SCHEMA
+    and precinct table are replaced) and writes folder/benchmark.csv
+     :scales param: list of lion sizes (segments)
+     :folder param: output folder
+     :return: run_scale rows of all scales
+    """
+    db = db2.PostgresDb(host, db_name, quiet=True)
+    results = []
+    for segments in sorted(scales):
+        results += run_scale(db, segments, os.path.join(folder, str(segments)), **kwargs)
+        write_csv(results, os.path.join(folder, 'benchmark.csv'))  # keep what finished if a larger scale fails
+    print report(results)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and memory of the CLION stages on synthetic LION')
+    parser.add_argument('folder', help='output folder (RPL.txt, checkpoints, benchmark.csv)')
+    parser.add_argument('--scales', default='10000,100000,1000000', help='comma separated lion sizes (segments)')
+    parser.add_argument('--host', default=params.DB_HOST)
+    parser.add_argument('--db', default='clion_benchmark', help='scratch PostGIS database')
+    parser.add_argument('--divided-every', type=int, default=5, help='every nth avenue is divided, 0 = none')
+    parser.add_argument('--ramp-every', type=int, default=4, help='ramp every nth block of a divided avenue, 0 = none')
+    parser.add_argument('--double-every', type=int, default=50, help='every nth street block is doubled, 0 = none')
+    parser.add_argument('--rename-every', type=int, default=7, help='every nth street changes name, 0 = none')
+    args = parser.parse_args()
+    run([int(s) for s in args.scales.split(',')], args.folder, args.host, args.db,
+        divided_every=args.divided_every, ramp_every=args.ramp_every, double_every=args.double_every,
+        rename_every=args.rename_every)
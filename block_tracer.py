@@ -0,0 +1,58 @@
+import numpy as np
+
+
+def trace_blocks(street_graph, is_int):
+    """
+    Builds intersection to intersection blocks along each street of the graph
+     :street_graph param: street_graph.StreetGraph
+     :is_int param: bool array of intersection flags by node index
+     :return: list of node index arrays, each block is emitted once starting from its lowest index intersection
+
+    a block is a run of non-intersection nodes along one street plus the intersections at its ends
+        1(i) - 2 - 3 - 4(i) - 5
+        -> [1, 2, 3, 4], [4, 5]
+    intersections next to each other on the same street make a 2 node block [1(i), 2(i)]
+    """
+    offsets = street_graph.offsets.tolist()
+    targets = street_graph.targets.tolist()
+    streets = street_graph.half_streets.tolist()
+    is_int = np.asarray(is_int, dtype=bool)
+    flags = is_int.tolist()
+    n = len(flags)
+    # non-intersection nodes already in a block, keyed by street * n + node
+    # (a non-intersection node can sit on more than 1 street, ex. doubles and ramps)
+    visited = set()
+    blocks = []
+    for start in np.flatnonzero(is_int).tolist():
+        stepped = set()
+        for h in xrange(offsets[start], offsets[start + 1]):
+            street, nxt = streets[h], targets[h]
+            if (street, nxt) in stepped:  # parallel segments with the same name
+                continue
+            stepped.add((street, nxt))
+            if flags[nxt]:
+                # block between 2 intersections, emit from the lower end only
+                if start <= nxt:
+                    blocks.append(np.array([start, nxt], dtype=np.int32))
+                continue
+            if street * n + nxt in visited:  # already traced from the other end
+                continue
+            visited.add(street * n + nxt)
+            block = [start]
+            members = {start, nxt}
+            stack = [nxt]
+            while stack:
+                node = stack.pop()
+                block.append(node)
+                if flags[node]:  # end of the block
+                    continue
+                for h2 in xrange(offsets[node], offsets[node + 1]):
+                    if streets[h2] == street:
+                        other = targets[h2]
+                        if other not in members:
+                            members.add(other)
+                            if not flags[other]:
+                                visited.add(street * n + other)
+                            stack.append(other)
+            blocks.append(np.array(block, dtype=np.int32))
+    return blocks
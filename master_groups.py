@@ -0,0 +1,106 @@
+from collections import defaultdict
+
+
+class MasterGroups(object):
+    """
+    Disjoint set (union-find) of nodes grouped by masterid
+    path compression + union by size, so merging masters is near constant time
+    masters[node], node in masters, iterating nodes and len work like the old {node: masterid} dict
+    {masterid: [nodes]} is only built when asked for with groups()
+    """
+    def __init__(self):
+        self.parent = dict()  # {node: parent node}
+        self.size = dict()  # {root node: number of nodes in the group}
+        self.label = dict()  # {root node: masterid}
+        self.roots = dict()  # {masterid: root node}
+
+    def load(self, node_master):
+        # start from a {node: masterid} assignment, ex. first pass clusters
+        for node, master in node_master.iteritems():
+            root = self.roots.setdefault(master, node)
+            self.parent[node] = root
+            self.size[root] = self.size.get(root, 0) + 1
+            self.label[root] = master
+        return self
+
+    def find(self, node):
+        root = node
+        parent = self.parent
+        while parent[root] != root:
+            root = parent[root]
+        # path compression
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    def union(self, nodes):
+        # merge the masters of all nodes, the group keeps the master of the first node
+        nodes = list(nodes)
+        if not nodes:
+            return None
+        root = self.find(nodes[0])
+        keep = self.label[root]
+        for node in nodes[1:]:
+            other = self.find(node)
+            if other == root:
+                continue
+            if self.size[other] > self.size[root]:
+                root, other = other, root
+            self.parent[other] = root
+            self.size[root] += self.size.pop(other)
+            del self.roots[self.label.pop(other)]
+        if self.label[root] != keep:
+            del self.roots[self.label[root]]
+            self.label[root] = keep
+            self.roots[keep] = root
+        return keep
+
+    def split(self, master, node_groups):
+        """
+        Replaces master with a new master for each list of nodes
+        node_groups must cover every node in master (ex. from groups()[master])
+         :return: [(new masterid, nodes), ...]
+        """
+        root = self.roots.pop(master)
+        del self.label[root]
+        del self.size[root]
+        out = []
+        for nodes in node_groups:
+            # get next availible masterid
+            new_master = max(self.roots) + 1 if self.roots else 1
+            new_root = nodes[0]
+            for node in nodes:
+                self.parent[node] = new_root
+            self.size[new_root] = len(nodes)
+            self.label[new_root] = new_master
+            self.roots[new_master] = new_root
+            out.append((new_master, nodes))
+        return out
+
+    def __getitem__(self, node):
+        return self.label[self.find(node)]
+
+    def __contains__(self, node):
+        return node in self.parent
+
+    def __iter__(self):
+        return iter(self.parent)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def keys(self):
+        return self.parent.keys()
+
+    def items(self):
+        return [(node, self[node]) for node in self.parent]
+
+    def masters(self):
+        return self.roots.keys()
+
+    def groups(self):
+        # materialized {masterid: [nodes]}
+        master_nodes = defaultdict(list)
+        for node in self.parent:
+            master_nodes[self[node]].append(node)
+        return master_nodes
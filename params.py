@@ -1,4 +1,7 @@
+import os
 from collections import defaultdict
+import master_groups
+import street_names
 
 __author__ = 'SHostetter'
 # set up base globals
@@ -6,6 +9,9 @@ DOWLOAD_PATH = # path to where downloads land
 DB_HOST = # database host
 DB_NAME =   # Database
 WORKING_SCHEMA =  'working'
+DB_POOL_SIZE = 4  # connections for stages that run statements in parallel
+PIPELINE_WORKERS = 4  # independent pipeline stages run at once, each on its own connection
+EXPLAIN_THRESHOLD = None  # seconds, capture EXPLAIN ANALYZE plans of slower statements (reruns them), None = off
 FINAL_SCHEMA = 'public'
 ARCHIVE_SCHEMA = 'archive'
 LION = 'lion'
@@ -17,23 +23,26 @@ PRECINCTS = 'districts_police_precincts'
 BOROUGHS = 'districts_boroughs'
 HIGHWAYS = True
 SRID = 2263
+STREET_NAME_EXCEPTIONS = None  # optional file of street names to keep whole (one per line)
+MANUAL_FIXES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'manual_fixes.csv')  # known LION/RPL errors
 
 FOLDER = # working folder 
+CHECKPOINT_FOLDER = None  # pipeline checkpoints of in memory structures, None = FOLDER/checkpoints
+SNAPSHOT_FOLDER = None  # snapshots of the network state by VERSION (see snapshot.py), None = FOLDER/snapshots
 
 
 # global dictionaries
 def st_name_factory():
     return [set(), 0]
-nodeStreetNames = defaultdict(st_name_factory)  # {node: [{street names}, masterid}
+streetIds = street_names.StreetDictionary()  # {normalized street name: id}
+nodeStreetNames = defaultdict(st_name_factory)  # {node: [(sorted street name ids), masterid}
 nodeIsIntersection = {}  # {node: True or False}
-nodeNextSteps = defaultdict(lambda: defaultdict(set))  # {node: {street: fromNode, toNode}}
+streetGraph = None  # street_graph.StreetGraph of the included street network
 segmentBlocks = {}  # {segmentID: fromMaster, toMaster}
-nodeMaster = {}  # {node: masterid}
-masterNodes = defaultdict(list)  # {masterid: [nodeid, nodeid, ...]}
-clusterIntersections = defaultdict(st_name_factory)  # {sorted-street-names: [set([nodes]), masterID]}
+nodeMaster = master_groups.MasterGroups()  # {node: masterid}, {masterid: [nodeid, nodeid, ...]} from nodeMaster.groups()
+clusterIntersections = defaultdict(st_name_factory)  # {(sorted-street-name-ids): [set([nodes]), masterID]}
 mfts = []
 coordFromMaster = {}  # {master: [x,y]
 # minor datastores - can be deleted after use?
-streetSet = []
+streetSet = []  # blocks as arrays of streetGraph node indexes
 mft1Dict = defaultdict(list)  # mft: [segmentid, segmentid]
-altGraph = defaultdict(list)
@@ -0,0 +1,366 @@
+import os
+import sys
+import time
+import threading
+import cPickle as pickle
+from Queue import Queue
+from datetime import datetime
+import params
+import run_trace
+import RIS_Tools as db2
+
+
+class Stage(object):
+    """
+    One step of a pipeline
+     :name param: stage name (unique)
+     :func param: function taking the pipeline context (dict, ctx['db'] is the PostgresDb)
+     :reads kwarg: tables and in memory structures the stage reads
+     :writes kwarg: tables and in memory structures the stage creates or changes
+    in memory structures are named 'params.<global>' or 'ctx.<key>', stages that write them are checkpointed
+    '<table>.<part>' is a group of columns: writing it conflicts with writers of the table and readers of the
+    part, but not with stages that only read the rest of the table
+    """
+    def __init__(self, name, func, reads=(), writes=()):
+        self.name = name
+        self.func = func
+        self.reads = frozenset(reads)
+        self.writes = frozenset(writes)
+
+    @property
+    def in_memory(self):
+        return any(w.startswith(('params.', 'ctx.')) for w in self.writes)
+
+    @property
+    def uses_memory(self):
+        return any(r.startswith(('params.', 'ctx.')) for r in self.reads | self.writes)
+
+    def __repr__(self):
+        return 'Stage({!r})'.format(self.name)
+
+
+def covers(written, name):
+    # writing a table changes its column groups, writing a column group leaves the rest of the table alone
+    return name == written or (name.startswith(written + '.') and not written.startswith(('params.', 'ctx.')))
+
+
+def conflicts(stage, earlier):
+    return (any(covers(w, r) for w in earlier.writes for r in stage.reads) or
+            any(covers(w, r) for w in stage.writes for r in earlier.reads) or
+            any(covers(w, v) or covers(v, w) for w in earlier.writes for v in stage.writes))
+
+
+def dependencies(stages):
+    """
+    Stages each stage has to wait for, from read/write conflicts with the stages declared before it
+    (read after write, write after read, write after write)
+     :stages param: list of Stage in a valid serial order
+     :return: {stage name: set(stage names)}
+    """
+    deps = dict()
+    for i, stage in enumerate(stages):
+        deps[stage.name] = set(earlier.name for earlier in stages[:i] if conflicts(stage, earlier))
+    return deps
+
+
+def restore(module, name, value):
+    # puts a checkpointed value back in place, functions hold params structures as default arguments
+    current = getattr(module, name, None)
+    if isinstance(current, dict) and isinstance(value, dict):
+        current.clear()
+        current.update(value)
+    elif isinstance(current, list) and isinstance(value, list):
+        current[:] = value
+    elif type(current) is type(value) and hasattr(current, '__dict__'):
+        current.__dict__.clear()
+        current.__dict__.update(value.__dict__)
+    else:
+        setattr(module, name, value)
+
+
+class Pipeline(object):
+    """
+    Runs stages with completion markers in a run state table and checkpoints of in memory state
+    after every stage that writes params globals or ctx values
+     :stages param: list of Stage in a valid serial order
+     :ctx param: dict passed to every stage, ctx['db'] is the PostgresDb (also used for the run state table)
+     :schema param: schema of the run state table
+     :checkpoint_dir param: folder for checkpoints, 1 sub folder per run
+     :state_names kwarg: params globals saved in checkpoints
+     :table kwarg: run state table
+    """
+    def __init__(self, stages, ctx, schema, checkpoint_dir, state_names=(), table='clion_run_state'):
+        self.stages = stages
+        self.position = dict((stage.name, i) for i, stage in enumerate(stages))
+        self.deps = dependencies(stages)
+        self.ctx = ctx
+        self.schema = schema
+        self.checkpoint_dir = checkpoint_dir
+        self.state_names = state_names
+        self.table = '{}.{}'.format(schema, table)
+        self.run_id = None
+        self.timings = dict()  # {stage: (start, seconds)} of the last run, start in seconds from its start
+        self.wall = None
+
+    @property
+    def db(self):
+        return self.ctx['db']
+
+    def setup(self):
+        self.db.query("""create table if not exists {t} (
+                            run_id text, stage text, position int, status text,
+                            started timestamp, finished timestamp, checkpoint text, error text
+                         )""".format(t=self.table))
+
+    def latest_run(self):
+        data = self.db.query("select run_id from {t} order by started desc limit 1".format(t=self.table)).data
+        return data[0][0] if data else None
+
+    def status(self, run_id):
+        # {stage: (status, checkpoint)} for a run
+        return dict((stage, (status, ckpt)) for stage, status, ckpt in self.db.query(
+            "select stage, status, checkpoint from {t} where run_id = '{r}'".format(t=self.table, r=run_id)).data)
+
+    def mark(self, stage, status, started, checkpoint=None, error=None):
+        self.db.query("delete from {t} where run_id = '{r}' and stage = '{s}'".format(
+            t=self.table, r=self.run_id, s=stage.name))
+        self.db.copy_rows(self.table, [(self.run_id, stage.name, self.position[stage.name], status, started,
+                                        datetime.now(), checkpoint, error)])
+
+    def select(self, resume=False, from_stage=None, only=None, start=None):
+        """
+        Stages to run and the run id to record them under
+         :resume kwarg: continue the latest run, skipping its finished stages
+         :from_stage kwarg: rerun the latest run from this stage on
+         :only kwarg: rerun just these stages of the latest run
+         :start kwarg: new run from this stage on, with in memory state the caller restored (ex. a snapshot)
+         :return: list of Stage
+        """
+        for name in ([from_stage] if from_stage else []) + list(only or []) + ([start] if start else []):
+            if name not in self.position:
+                raise ValueError('Unknown stage {}, stages are: {}'.format(
+                    name, ', '.join(stage.name for stage in self.stages)))
+        if start and (resume or from_stage or only):
+            raise ValueError('A run started from restored state is new, it can not also resume or rerun')
+        if not (resume or from_stage or only):
+            self.run_id = datetime.now().strftime('%Y%m%d_%H%M%S')
+            return self.stages[self.position[start]:] if start else list(self.stages)
+        self.run_id = self.latest_run()
+        if self.run_id is None:
+            raise ValueError('No previous run to resume')
+        if only:
+            return [stage for stage in self.stages if stage.name in only]
+        if from_stage:
+            return self.stages[self.position[from_stage]:]
+        done = self.status(self.run_id)
+        return [stage for stage in self.stages if done.get(stage.name, (None,))[0] != 'done']
+
+    def checkpoint(self, stage):
+        folder = os.path.join(self.checkpoint_dir, self.run_id)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        path = os.path.join(folder, '{}.pkl'.format(stage.name))
+        state = {'params': dict((name, getattr(params, name)) for name in self.state_names),
+                 'ctx': dict((k, v) for k, v in self.ctx.iteritems() if k != 'db')}
+        with open(path, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        return path
+
+    def load_checkpoint(self, to_run):
+        """
+        Restores in memory state for rerunning to_run from the checkpoint of the last finished (not the last
+        positioned, stages run at once finish out of order) done in memory stage that is skipped.
+        In memory stages of to_run that finished before it would find their own changes in that state, so only
+        checkpoints from before the first of them are used, skipped in memory stages that finished later are
+        rerun as well.
+         :to_run param: list of Stage
+         :return: list of Stage to run, in order
+        """
+        names = set(stage.name for stage in to_run)
+        done = sorted((finished, self.position[name], name, ckpt) for name, status, finished, ckpt in self.db.query(
+            "select stage, status, finished, checkpoint from {t} where run_id = '{r}'".format(
+                t=self.table, r=self.run_id)).data
+            if status == 'done' and name in self.position and self.stages[self.position[name]].in_memory)
+        rerun = [row for row in done if row[2] in names]
+        limit = rerun[0][:2] if rerun else None
+        skipped = [row for row in done if row[2] not in names]
+        found = [row for row in skipped if row[3] and (limit is None or row[:2] < limit)]
+        again = set(row[2] for row in skipped if limit is not None and row[:2] > limit)
+        if again:
+            print 'Also rerunning {} (finished after stages being rerun, not in a usable checkpoint)'.format(
+                ', '.join(sorted(again, key=self.position.get)))
+        if found:
+            path = found[-1][3]
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            for name, value in state['params'].iteritems():
+                restore(params, name, value)
+            self.ctx.update(state['ctx'])
+            print 'Restored in memory state from {}'.format(path)
+        return [stage for stage in self.stages if stage.name in names or stage.name in again]
+
+    def mark_restored(self, to_run):
+        # stages before a restored start count as done, the restored state is checkpointed under the last in
+        # memory one, so the run resumes like any other
+        names = set(stage.name for stage in to_run)
+        skipped = [stage for stage in self.stages if stage.name not in names]
+        last = [stage for stage in skipped if stage.in_memory][-1:]
+        for stage in skipped:
+            self.mark(stage, 'done', datetime.now(), self.checkpoint(stage) if stage in last else None)
+
+    def run(self, resume=False, from_stage=None, only=None, workers=1, start=None):
+        """
+        Runs the selected stages (see select), in order on ctx['db'] or with workers > 1 any stages that do
+        not depend on each other at once, each on its own connection
+         :return: ctx
+        """
+        self.setup()
+        to_run = self.select(resume, from_stage, only, start)
+        if not to_run:
+            print 'Nothing to run, every stage of run {} is done'.format(self.run_id)
+            return self.ctx
+        if start:
+            self.mark_restored(to_run)
+        elif len(to_run) < len(self.stages):
+            to_run = self.load_checkpoint(to_run)
+            done = self.status(self.run_id)
+            names = set(stage.name for stage in to_run)
+            for stage in to_run:
+                missing = [d for d in self.deps[stage.name]
+                           if d not in names and done.get(d, (None,))[0] != 'done']
+                if missing:
+                    print 'Warning: {} depends on stages not done in run {}: {}'.format(
+                        stage.name, self.run_id, ', '.join(sorted(missing)))
+        print 'Run {}: {} of {} stages'.format(self.run_id, len(to_run), len(self.stages))
+        self.timings = dict()
+        self.t0 = time.time()
+        try:
+            if workers > 1:
+                self.run_concurrent(to_run, workers)
+            else:
+                for stage in to_run:
+                    self.run_stage(stage)
+        finally:
+            self.wall = time.time() - self.t0
+        return self.ctx
+
+    def call(self, stage, ctx):
+        # runs 1 stage -> (start, end, exc_info or None)
+        start = time.time()
+        try:
+            with run_trace.tracer.span('stage', stage.name):
+                stage.func(ctx)
+        except BaseException:  # RIS_Tools.QueryError, also ctrl-c and exits
+            return start, time.time(), sys.exc_info()
+        return start, time.time(), None
+
+    def finish(self, stage, started, start, end, error):
+        # records a finished stage (from the scheduling thread, so checkpoints see a consistent state)
+        self.timings[stage.name] = (start - self.t0, end - start)
+        if error:
+            self.mark(stage, 'failed', started, error=repr(error[1]))
+            print 'Stage {} failed, rerun with --resume once fixed'.format(stage.name)
+        else:
+            self.mark(stage, 'done', started, self.checkpoint(stage) if stage.in_memory else None)
+
+    def run_stage(self, stage):
+        started = datetime.now()
+        self.mark(stage, 'running', started)
+        start, end, error = self.call(stage, self.ctx)
+        self.finish(stage, started, start, end, error)
+        if error:
+            raise error[0], error[1], error[2]
+
+    def run_concurrent(self, to_run, workers):
+        """
+        Starts every stage whose dependencies in to_run are done, up to workers at once, each with a copy of ctx
+        holding its own connection. Stages that change in memory structures do not run alongside other stages
+        that use them. After a failure no new stages are started, the running ones are waited for and the
+        first error is raised.
+        """
+        pool = db2.PostgresPool(self.db, workers)
+        idle = Queue()
+        for db in pool.dbs:
+            db.plan_log = self.db.plan_log
+            idle.put(db)
+        finished = Queue()
+        names = set(stage.name for stage in to_run)
+        pending, running, done, errors = list(to_run), dict(), set(), []
+
+        def work(stage, ctx):
+            finished.put((stage, ctx) + self.call(stage, ctx))
+
+        try:
+            while pending or running:
+                for stage in list(pending):
+                    if errors or len(running) >= workers:
+                        break
+                    if (self.deps[stage.name] & names) - done:
+                        continue
+                    if stage.uses_memory and any(r.uses_memory and (r.in_memory or stage.in_memory)
+                                                 for r, _, _ in running.itervalues()):
+                        continue
+                    pending.remove(stage)
+                    started = datetime.now()
+                    self.mark(stage, 'running', started)
+                    ctx = dict(self.ctx)
+                    running[stage.name] = (stage, started, dict(ctx))
+                    ctx['db'] = idle.get()
+                    thread = threading.Thread(target=work, args=(stage, ctx), name=stage.name)
+                    thread.daemon = True
+                    thread.start()
+                if not running:
+                    break
+                stage, ctx, start, end, error = finished.get()
+                _, started, before = running.pop(stage.name)
+                db = ctx.pop('db')
+                # a connection left idle in a transaction (a select, a stream not read to the end) keeps its locks
+                # and blocks the ddl of later stages on the other connections, so end it before handing it out
+                if error:
+                    db.rollback()
+                elif not db.conn.closed:
+                    db.conn.commit()
+                idle.put(db)
+                if not error:
+                    # values the stage added or replaced in its copy of ctx
+                    self.ctx.update((k, v) for k, v in ctx.iteritems() if k not in before or before[k] is not v)
+                    done.add(stage.name)
+                else:
+                    errors.append(error)
+                self.finish(stage, started, start, end, error)
+        finally:
+            pool.close()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def critical_path(self):
+        """
+        Longest chain of dependent stages of the last run by stage time, the least the run can take
+        however many workers run it
+         :return: seconds, [stage names]
+        """
+        finish, prev = dict(), dict()
+        for stage in self.stages:
+            if stage.name not in self.timings:
+                continue
+            before = [d for d in self.deps[stage.name] if d in finish]
+            prev[stage.name] = max(before, key=finish.get) if before else None
+            finish[stage.name] = finish.get(prev[stage.name], 0) + self.timings[stage.name][1]
+        if not finish:
+            return 0, []
+        name = max(finish, key=finish.get)
+        total, path = finish[name], []
+        while name:
+            path.append(name)
+            name = prev[name]
+        return total, path[::-1]
+
+    def report(self):
+        # critical path of the last run as printable text
+        total, path = self.critical_path()
+        lines = ['Stages took {:.1f} sec in {:.1f} sec of run time, critical path {:.1f} sec:'.format(
+            sum(seconds for _, seconds in self.timings.itervalues()), self.wall or 0, total)]
+        for name in path:
+            start, seconds = self.timings[name]
+            lines.append('\t{:<40} {:>9.1f} sec  (started at {:.1f} sec)'.format(name, seconds, start))
+        return '\n'.join(lines)
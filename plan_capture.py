@@ -0,0 +1,149 @@
+import re
+import json
+from collections import defaultdict
+from datetime import datetime
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+import run_trace
+
+
+def split_statements(sql):
+    """
+    Splits a query string on ; outside of quotes, dollar quotes and comments
+     :sql param: 1 or more sql statements
+     :return: list of statements (comments kept, empty statements dropped)
+    """
+    statements = []
+    start = i = 0
+    n = len(sql)
+    while i < n:
+        c = sql[i]
+        if c in ("'", '"'):
+            i = sql.find(c, i + 1)  # '' inside a string just closes and reopens it
+            i = n if i < 0 else i + 1
+        elif sql.startswith('--', i):
+            i = sql.find('\n', i)
+            i = n if i < 0 else i + 1
+        elif sql.startswith('/*', i):
+            i = sql.find('*/', i + 2)
+            i = n if i < 0 else i + 2
+        elif c == '$':
+            tag = re.match(r'\$\w*\$', sql[i:])
+            if tag:
+                i = sql.find(tag.group(), i + len(tag.group()))
+                i = n if i < 0 else i + len(tag.group())
+            else:
+                i += 1
+        elif c == ';':
+            statements.append(sql[start:i])
+            start = i = i + 1
+        else:
+            i += 1
+    statements.append(sql[start:])
+    return [s.strip() for s in statements if strip_comments(s).strip()]
+
+
+def strip_comments(sql):
+    return re.sub(r'--[^\n]*|/\*.*?\*/', ' ', sql, flags=re.S)
+
+
+# create table x as <select>, the select is what gets explained
+CTAS_RE = re.compile(r'^\s*create\s+(?:temp\w*\s+|unlogged\s+)?table\s+(?:if\s+not\s+exists\s+)?[\w."]+\s+as\s+(.*)$',
+                     re.I | re.S)
+
+
+def explainable(statement):
+    """
+    Part of a statement that can be run under EXPLAIN ANALYZE, None for DDL and other utility statements
+     :return: sql to explain or None
+    """
+    body = strip_comments(statement).strip()
+    ctas = CTAS_RE.match(body)
+    if ctas:
+        body = ctas.group(1)
+    word = body.split(None, 1)[0].lower() if body else ''
+    if word in ('select', 'with', 'values', 'table', 'insert', 'update', 'delete'):
+        return body
+    return None
+
+
+def walk(plan):
+    # every node of a json plan
+    todo = [plan]
+    while todo:
+        node = todo.pop()
+        yield node
+        todo.extend(node.get('Plans', []))
+
+
+class PlanCapture(object):
+    """
+    Opt in EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) capture for PostgresDb statements slower than a threshold
+    slow statements are run again under EXPLAIN right after they finish, data changing statements inside a
+    savepoint that is rolled back, so the plans are of the already updated tables (and the run takes longer)
+    a transaction still open (transaction() blocks, uncommitted update ... returning) is left as it was
+     :threshold kwarg: seconds
+    """
+    def __init__(self, threshold=30):
+        self.threshold = threshold
+        self.plans = []  # [{stage, statement, seconds (of the whole query string), plan, error, captured}]
+
+    def capture(self, dbo, qry, seconds):
+        # qry as it was sent to the server (escaped)
+        stage = run_trace.tracer.current_stage()
+        # statements that return rows (update ... returning) are not committed yet, leave them pending
+        committed = dbo.conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+        cur = dbo.conn.cursor()
+        try:
+            for statement in split_statements(qry):
+                sql = explainable(statement)
+                if not sql:
+                    continue
+                record = {'stage': stage, 'statement': statement, 'seconds': seconds, 'plan': None, 'error': None,
+                          'captured': datetime.now().isoformat()}
+                cur.execute('SAVEPOINT plan_capture')
+                try:
+                    cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql)
+                    plan = cur.fetchone()[0]
+                    record['plan'] = json.loads(plan) if isinstance(plan, basestring) else plan
+                except Exception as e:  # ex. temp tables the statement dropped after itself
+                    record['error'] = str(e).strip()
+                cur.execute('ROLLBACK TO SAVEPOINT plan_capture')
+                cur.execute('RELEASE SAVEPOINT plan_capture')
+                self.plans.append(record)
+            if committed:
+                dbo.conn.rollback()  # ends the transaction the explains opened, nothing else is in it
+        finally:
+            del cur
+
+    def seq_scans(self, tables=('lion', 'node')):
+        """
+        Sequential scans on tables in the captured plans
+         :return: [(stage, table, scans, rows scanned, total ms)] slowest first
+        """
+        found = defaultdict(lambda: [0, 0, 0.0])
+        for record in self.plans:
+            if not record['plan']:
+                continue
+            for node in walk(record['plan'][0]['Plan']):
+                if node.get('Node Type') == 'Seq Scan' and node.get('Relation Name') in tables:
+                    key = (record['stage'], node['Relation Name'])
+                    found[key][0] += 1
+                    found[key][1] += node.get('Actual Rows', 0) * node.get('Actual Loops', 1)
+                    found[key][2] += node.get('Actual Total Time', 0) * node.get('Actual Loops', 1)
+        return sorted((k + tuple(v) for k, v in found.iteritems()), key=lambda r: -r[4])
+
+    def summary(self, tables=('lion', 'node')):
+        lines = ['{} plans captured (statements over {} sec)'.format(len(self.plans), self.threshold)]
+        for stage, table, scans, rows, ms in self.seq_scans(tables):
+            lines.append('\t{:<40} seq scan {:<6} x{:<4} {:>12} rows {:>10.0f} ms'.format(
+                stage, table, scans, rows, ms))
+        return '\n'.join(lines)
+
+    def save(self, dbo, schema, table='clion_plans'):
+        # appends the captured plans to schema.clion_plans
+        dbo.query("""create table if not exists {s}.{t} (
+                        captured timestamp, stage text, statement text, seconds float, plan json, error text
+                     )""".format(s=schema, t=table))
+        dbo.copy_rows('{}.{}'.format(schema, table),
+                      [(r['captured'], r['stage'], r['statement'], r['seconds'],
+                        json.dumps(r['plan']) if r['plan'] else None, r['error']) for r in self.plans])
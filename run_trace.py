@@ -0,0 +1,189 @@
+import os
+import re
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+try:
+    PAGE_MB = os.sysconf('SC_PAGE_SIZE') / 1048576.0
+except (AttributeError, ValueError):  # no sysconf on windows
+    PAGE_MB = None
+
+
+def cpu_time():
+    # user + system cpu seconds of the process
+    t = os.times()
+    return t[0] + t[1]
+
+
+def rss_mb():
+    # resident memory of the process now (linux /proc), None where it is not available
+    if PAGE_MB is None:
+        return None
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_MB
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+class Span(object):
+    """
+    One timed piece of a run: the pipeline, a stage (function) or a single statement
+     :kind param: 'pipeline', 'stage' or 'statement'
+     :name param: stage name or statement text
+     :parent kwarg: enclosing Span
+    """
+    def __init__(self, kind, name, parent=None):
+        self.kind = kind
+        self.name = name
+        self.parent = parent
+        self.children = []
+        self.started = datetime.now()
+        self.wall = None
+        self.cpu = None
+        self.rows = None  # rows returned or affected (statements)
+        self.peak_mem = None  # mb the process grew above its size at the start of the span (stages, sampled)
+        self.rss_start = self.rss_max = None
+        self._t0 = time.time()
+        self._c0 = cpu_time()
+
+    def close(self):
+        self.wall = time.time() - self._t0
+        self.cpu = cpu_time() - self._c0
+        if self.rss_start is not None:
+            self.rss_max = max(self.rss_max, rss_mb() or 0)
+            self.peak_mem = self.rss_max - self.rss_start
+
+    @property
+    def elapsed(self):
+        return self.wall if self.wall is not None else time.time() - self._t0
+
+    def to_dict(self):
+        return {'kind': self.kind, 'name': self.name, 'started': self.started.isoformat(),
+                'wall_sec': self.elapsed, 'cpu_sec': self.cpu, 'rows': self.rows, 'peak_mem_mb': self.peak_mem,
+                'children': [c.to_dict() for c in self.children]}
+
+
+class Tracer(object):
+    """
+    Collects nested spans for a run: pipeline -> stage -> statement
+    stages and statements are only recorded inside an open pipeline, statements run on other threads
+    (PostgresPool) are added to the stage open on the main thread
+    memory is the resident size of the process sampled every interval seconds while a pipeline or stage is
+    open, stages running at once (pipeline workers) share the process, so their peaks (and cpu) overlap
+     :interval kwarg: seconds between memory samples
+    """
+    def __init__(self, interval=0.05):
+        self.roots = []
+        self.main = []  # span stack of the main thread
+        self.main_thread = threading.current_thread()
+        self.local = threading.local()
+        self.interval = interval
+        self.open_spans = set()  # pipeline and stage spans being sampled
+        self.sampler = None
+
+    def _stack(self):
+        if threading.current_thread() is self.main_thread:
+            return self.main
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def current(self):
+        stack = self._stack()
+        if stack:
+            return stack[-1]
+        return self.main[-1] if self.main else None
+
+    def current_stage(self):
+        # name of the innermost open stage
+        sp = self.current()
+        while sp is not None and sp.kind != 'stage':
+            sp = sp.parent
+        return sp.name if sp else None
+
+    def sample(self):
+        # background thread raising rss_max of the open spans
+        while True:
+            time.sleep(self.interval)
+            rss = rss_mb()
+            for sp in list(self.open_spans):
+                if rss > sp.rss_max:
+                    sp.rss_max = rss
+
+    @contextmanager
+    def span(self, kind, name):
+        stack = self._stack()
+        parent = self.current()
+        if kind != 'pipeline' and parent is None:
+            yield None  # not tracing
+            return
+        sp = Span(kind, name, parent)
+        if parent is None:
+            self.roots.append(sp)
+        else:
+            parent.children.append(sp)
+        if kind != 'statement':
+            sp.rss_start = sp.rss_max = rss_mb()
+            if sp.rss_start is not None:
+                self.open_spans.add(sp)
+                if self.sampler is None:
+                    self.sampler = threading.Thread(target=self.sample, name='run_trace memory')
+                    self.sampler.daemon = True
+                    self.sampler.start()
+        stack.append(sp)
+        try:
+            yield sp
+        finally:
+            stack.pop()
+            self.open_spans.discard(sp)
+            sp.close()
+
+    def statement(self, qry):
+        # span for 1 sql statement, named by its collapsed text
+        return self.span('statement', re.sub(r'\s+', ' ', qry).strip()[:2000])
+
+    def spans(self):
+        # depth first [(span id, parent id, span)]
+        out, ids = [], {}
+        todo = list(reversed(self.roots))
+        while todo:
+            sp = todo.pop()
+            ids[sp] = len(out) + 1
+            out.append((ids[sp], ids.get(sp.parent), sp))
+            todo.extend(reversed(sp.children))
+        return out
+
+    def stage_summary(self, top=15):
+        # slowest stages as printable lines
+        stages = sorted((sp for _, _, sp in self.spans() if sp.kind == 'stage'), key=lambda s: -s.elapsed)
+        return ['{:<45} {:>9.1f} sec {:>9.1f} cpu {:>9}'.format(
+            sp.name, sp.elapsed, sp.cpu or 0, '' if sp.peak_mem is None else '{:.0f} MB'.format(sp.peak_mem))
+            for sp in stages[:top]]
+
+    def write_json(self, out_file):
+        with open(out_file, 'w') as f:
+            json.dump([sp.to_dict() for sp in self.roots], f, indent=1)
+
+    def write_table(self, dbo, schema, run_id, version=None, table='clion_run_stats'):
+        # appends the run's spans to schema.clion_run_stats, so runs can be compared
+        dbo.query("""create table if not exists {s}.{t} (
+                        run_id text, version text, span_id int, parent_id int, kind text, name text,
+                        started timestamp, wall_sec float, cpu_sec float, rows bigint, peak_mem_mb float
+                     )""".format(s=schema, t=table))
+        dbo.copy_rows('{}.{}'.format(schema, table),
+                      [(run_id, version, i, p, sp.kind, sp.name, sp.started.isoformat(), sp.elapsed, sp.cpu,
+                        sp.rows, sp.peak_mem) for i, p, sp in self.spans()])
+
+    def save(self, dbo, schema, folder, version=None):
+        # writes the trace to folder/clion_run_<run id>.json and the run stats table
+        run_id = self.roots[0].started.strftime('%Y%m%d_%H%M%S') if self.roots else 'empty'
+        self.write_json(os.path.join(folder, 'clion_run_{}.json'.format(run_id)))
+        self.write_table(dbo, schema, run_id, version)
+        print '\n'.join(['Slowest stages:'] + self.stage_summary())
+        return run_id
+
+
+tracer = Tracer()  # default tracer used by RIS_Tools.timeDec and PostgresDb
@@ -0,0 +1,212 @@
+import os
+import json
+from collections import defaultdict
+from datetime import datetime
+import numpy as np
+import params
+import pipeline
+import master_groups
+import street_names as sn
+import street_graph as sg
+
+FORMAT = 1  # bump when the array layout changes, older snapshots are refused on load
+CTX_NAMES = ('node_coords', 'pct_lookup', 'pct_neighbors')  # pipeline ctx values kept in snapshots
+
+
+def ragged(rows, dtype):
+    # (offsets, values) CSR arrays of a list of sequences, row i is values[offsets[i]:offsets[i + 1]]
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(r) for r in rows])
+    values = np.fromiter((v for r in rows for v in r), dtype=dtype, count=int(offsets[-1]))
+    return offsets, values
+
+
+def name_array(names):
+    # fixed width byte strings, so names can be memory mapped like the rest
+    names = [n.encode('utf-8') if isinstance(n, unicode) else (n or '') for n in names]
+    return np.array(names, dtype='S{}'.format(max([len(n) for n in names] + [1])))
+
+
+def flags(values):
+    # True / False / None as 1 / 0 / -1
+    return np.fromiter((-1 if v is None else int(bool(v)) for v in values), dtype=np.int8, count=len(values))
+
+
+def path(folder, version=params.VERSION, label=None):
+    # folder/version or folder/version/label
+    return os.path.join(folder, str(version), *([label] if label else []))
+
+
+def save(folder, version=params.VERSION, street_ids=None, node_street_names=None, node_is_intersection=None,
+         cluster_intersections=None, node_master=None, street_graph=None, street_set=None, node_coords=None,
+         pct_lookup=None, pct_neighbors=None, label=None):
+    """
+    Writes the in memory network state as one .npy file per column plus manifest.json to folder/version/label
+    structures left as None are not written
+     :folder param: snapshot root folder
+     :version kwarg: LION version the state was built from
+     :label kwarg: point of the run the state is from (ex. 'first_pass'), None writes to folder/version
+     :return: snapshot folder
+    """
+    arrays = dict()
+    if street_ids is not None:
+        arrays['street_names'] = name_array(street_ids.names)
+    if node_street_names is not None:
+        nodes = sorted(node_street_names)
+        arrays['nsn_node'] = np.array(nodes, dtype=np.int64)
+        arrays['nsn_master'] = np.array([node_street_names[n][1] for n in nodes], dtype=np.int64)
+        arrays['nsn_offsets'], arrays['nsn_streets'] = ragged(
+            [sorted(node_street_names[n][0]) for n in nodes], np.int32)
+    if node_is_intersection is not None:
+        nodes = sorted(node_is_intersection)
+        arrays['int_node'] = np.array(nodes, dtype=np.int64)
+        arrays['int_flag'] = flags([node_is_intersection[n] for n in nodes])
+    if cluster_intersections is not None:
+        keys = sorted(cluster_intersections)
+        arrays['cluster_master'] = np.array([cluster_intersections[k][1] for k in keys], dtype=np.int64)
+        arrays['cluster_key_offsets'], arrays['cluster_keys'] = ragged(keys, np.int32)
+        arrays['cluster_node_offsets'], arrays['cluster_nodes'] = ragged(
+            [sorted(cluster_intersections[k][0]) for k in keys], np.int64)
+    if node_master is not None:
+        nodes = sorted(node_master)
+        arrays['master_node'] = np.array(nodes, dtype=np.int64)
+        arrays['master_id'] = np.array([node_master[n] for n in nodes], dtype=np.int64)
+    if street_graph is not None:
+        for name in ('node_ids', 'offsets', 'targets', 'edges', 'half_streets', 'segments'):
+            arrays['graph_' + name] = np.asarray(getattr(street_graph, name))
+        arrays['graph_street_names'] = name_array(street_graph.streets.names)
+    if street_set is not None:
+        arrays['block_offsets'], arrays['block_nodes'] = ragged(street_set, np.int32)
+    if node_coords is not None:
+        nodes = sorted(node_coords)
+        arrays['coord_node'] = np.array(nodes, dtype=np.int64)
+        arrays['coord_xy'] = np.array([node_coords[n] for n in nodes], dtype=np.float64).reshape(-1, 2)
+    if pct_lookup is not None:
+        nodes = sorted(pct_lookup)
+        arrays['pct_node'] = np.array(nodes, dtype=np.int64)
+        arrays['pct_precinct'] = np.array([pct_lookup[n] for n in nodes], dtype=np.int64)
+    if pct_neighbors is not None:
+        pcts = sorted(pct_neighbors)
+        arrays['nb_precinct'] = np.array(pcts, dtype=np.int64)
+        arrays['nb_offsets'], arrays['nb_neighbors'] = ragged([sorted(pct_neighbors[p]) for p in pcts], np.int64)
+
+    out = path(folder, version, label)
+    if not os.path.exists(out):
+        os.makedirs(out)
+    for name, array in arrays.iteritems():
+        np.save(os.path.join(out, name + '.npy'), array)
+    manifest = {'format': FORMAT, 'version': version, 'label': label, 'created': datetime.now().isoformat(),
+                'arrays': dict((name, {'dtype': a.dtype.str, 'shape': list(a.shape)}) for name, a in arrays.iteritems())}
+    with open(os.path.join(out, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    print 'Snapshot {} ({:.1f} MB)'.format(out, sum(a.nbytes for a in arrays.itervalues()) / 1e6)
+    return out
+
+
+def save_params(folder, version=params.VERSION, ctx=None, label=None):
+    # snapshot of the params globals and the distance check values of the pipeline ctx (CTX_NAMES)
+    ctx = ctx or {}
+    return save(folder, version, params.streetIds, params.nodeStreetNames, params.nodeIsIntersection,
+                params.clusterIntersections, params.nodeMaster, params.streetGraph, params.streetSet,
+                label=label, **dict((name, ctx.get(name)) for name in CTX_NAMES))
+
+
+class Snapshot(object):
+    """
+    A saved network state, the arrays are memory mapped (read only) and the structures are only rebuilt
+    when asked for. The street graph and blocks are views of the mapped arrays, the dicts are built from them.
+     :folder param: snapshot root folder
+     :version kwarg: LION version
+     :label kwarg: snapshot label (see save)
+     :mmap_mode kwarg: numpy.load mmap_mode, None reads the arrays into memory
+    """
+    def __init__(self, folder, version=params.VERSION, label=None, mmap_mode='r'):
+        self.path = path(folder, version, label)
+        with open(os.path.join(self.path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        if self.manifest['format'] != FORMAT:
+            raise ValueError('{} is snapshot format {}, this reads format {}'.format(
+                self.path, self.manifest['format'], FORMAT))
+        self.version = self.manifest['version']
+        self.arrays = dict((name, np.load(os.path.join(self.path, name + '.npy'), mmap_mode=mmap_mode))
+                           for name in self.manifest['arrays'])
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def rows(self, offsets, values):
+        # row views of CSR arrays
+        offsets, values = self[offsets], self[values]
+        return [values[offsets[i]:offsets[i + 1]] for i in xrange(len(offsets) - 1)]
+
+    def street_ids(self):
+        return sn.StreetDictionary(self['street_names'].tolist())
+
+    def node_street_names(self):
+        out = defaultdict(params.st_name_factory)
+        for node, master, streets in zip(self['nsn_node'].tolist(), self['nsn_master'].tolist(),
+                                         self.rows('nsn_offsets', 'nsn_streets')):
+            out[node] = [tuple(streets.tolist()), master]
+        return out
+
+    def node_is_intersection(self):
+        return dict((node, None if flag < 0 else bool(flag))
+                    for node, flag in zip(self['int_node'].tolist(), self['int_flag'].tolist()))
+
+    def cluster_intersections(self):
+        out = defaultdict(params.st_name_factory)
+        for key, nodes, master in zip(self.rows('cluster_key_offsets', 'cluster_keys'),
+                                      self.rows('cluster_node_offsets', 'cluster_nodes'),
+                                      self['cluster_master'].tolist()):
+            out[tuple(key.tolist())] = [set(nodes.tolist()), master]
+        return out
+
+    def node_master(self):
+        return master_groups.MasterGroups().load(dict(zip(self['master_node'].tolist(),
+                                                          self['master_id'].tolist())))
+
+    def street_graph(self):
+        return sg.StreetGraph(*[self['graph_' + name] for name in
+                                ('node_ids', 'offsets', 'targets', 'edges', 'half_streets', 'segments')] +
+                              [sn.StreetDictionary(self['graph_street_names'].tolist())])
+
+    def street_set(self):
+        return self.rows('block_offsets', 'block_nodes')
+
+    def node_coords(self):
+        return dict(zip(self['coord_node'].tolist(), map(tuple, self['coord_xy'].tolist())))
+
+    def pct_lookup(self):
+        return dict(zip(self['pct_node'].tolist(), self['pct_precinct'].tolist()))
+
+    def pct_neighbors(self):
+        out = defaultdict(set)
+        for pct, neighbors in zip(self['nb_precinct'].tolist(), self.rows('nb_offsets', 'nb_neighbors')):
+            out[pct] = set(neighbors.tolist())
+        return out
+
+    def restore(self):
+        """
+        Puts the saved structures back into params (in place, functions hold them as default arguments)
+         :return: {ctx name: value} of the saved pipeline ctx values
+        """
+        for name, array, build in (('streetIds', 'street_names', self.street_ids),
+                                   ('nodeStreetNames', 'nsn_node', self.node_street_names),
+                                   ('nodeIsIntersection', 'int_node', self.node_is_intersection),
+                                   ('clusterIntersections', 'cluster_master', self.cluster_intersections),
+                                   ('nodeMaster', 'master_node', self.node_master),
+                                   ('streetGraph', 'graph_node_ids', self.street_graph),
+                                   ('streetSet', 'block_offsets', self.street_set)):
+            if array in self:
+                pipeline.restore(params, name, build())
+        return dict((name, build()) for name, array, build in (('node_coords', 'coord_node', self.node_coords),
+                                                               ('pct_lookup', 'pct_node', self.pct_lookup),
+                                                               ('pct_neighbors', 'nb_precinct', self.pct_neighbors))
+                    if array in self)
+
+
+def load(folder, version=params.VERSION, label=None, mmap_mode='r'):
+    return Snapshot(folder, version, label, mmap_mode)
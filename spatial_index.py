@@ -0,0 +1,139 @@
+import math
+from collections import defaultdict
+import numpy as np
+
+
+class NodeIndex(object):
+    """
+    In memory grid hash of node points, replaces per node st_dwithin queries
+     :node_ids param: nodeid of each point
+     :xy param: float array (n, 2) of point coordinates
+     :is_int param: bool array of intersection flags
+     :cell_size kwarg: grid cell size, defaults to 75 ft (the near_by_simple search distance)
+    """
+    def __init__(self, node_ids, xy, is_int, cell_size=75):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        self.is_int = np.asarray(is_int, dtype=bool)
+        self.cell_size = float(cell_size)
+        cells = self._cells(self.xy)
+        keys = self._keys(cells[:, 0], cells[:, 1])
+        # points sorted by grid cell, each cell's points are contiguous
+        self.order = np.argsort(keys, kind='mergesort')
+        self.cell_keys, self.cell_start, self.cell_count = np.unique(
+            keys[self.order], return_index=True, return_counts=True)
+
+    @classmethod
+    def from_db(cls, dbo, schema, node_table, cell_size=75):
+        node_ids, xy, is_int = [], [], []
+        for nodeid, x, y, flag in dbo.stream("""select nodeid, st_x(geom), st_y(geom), coalesce(is_int, False)
+                                                from {s}.{n} where geom is not null""".format(s=schema, n=node_table)):
+            node_ids.append(int(nodeid))
+            xy.append((x, y))
+            is_int.append(flag)
+        return cls(node_ids, np.array(xy, dtype=np.float64).reshape(-1, 2), is_int, cell_size)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def _cells(self, xy):
+        return np.floor(xy / self.cell_size).astype(np.int64)
+
+    @staticmethod
+    def _keys(cx, cy):
+        # pack cell x, y into one sortable key (state plane ft coordinates stay well inside 2**31 cells)
+        return (cx << 32) + (cy & 0xFFFFFFFF)
+
+    def _candidates(self, points, distance):
+        # (point, candidate) position pairs for every point in the cells within distance
+        rings = int(math.ceil(distance / self.cell_size))
+        cells = self._cells(self.xy[points])
+        src, cand = [], []
+        for dx in range(-rings, rings + 1):
+            for dy in range(-rings, rings + 1):
+                keys = self._keys(cells[:, 0] + dx, cells[:, 1] + dy)
+                pos = np.searchsorted(self.cell_keys, keys)
+                pos[pos == len(self.cell_keys)] = 0
+                found = self.cell_keys[pos] == keys if len(self.cell_keys) else np.zeros(len(keys), bool)
+                starts = self.cell_start[pos[found]]
+                counts = self.cell_count[pos[found]]
+                # expand each cell's [start, start + count) range
+                ends = np.cumsum(counts)
+                flat = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - counts - starts, counts)
+                src.append(np.repeat(points[found], counts))
+                cand.append(self.order[flat])
+        return np.concatenate(src), np.concatenate(cand)
+
+    def pairs_within(self, distance, nodes=None, int_only=True):
+        """
+        Batched radius search, matches st_dwithin(near.geom, src.geom, distance) and near.nodeid != src.nodeid
+         :distance param: search distance
+         :nodes kwarg: source nodeids (defaults to all nodes)
+         :int_only kwarg: only return intersection nodes (near.is_int = True)
+         :return: {nodeid: [near nodeids]}
+        """
+        if nodes is None:
+            points = np.arange(len(self.node_ids))
+        else:
+            points = np.flatnonzero(np.in1d(self.node_ids, np.fromiter(nodes, dtype=np.int64)))
+        near = defaultdict(list)
+        if not len(points):
+            return near
+        src, cand = self._candidates(points, distance)
+        keep = self.node_ids[src] != self.node_ids[cand]
+        if int_only:
+            keep &= self.is_int[cand]
+        src, cand = src[keep], cand[keep]
+        # same test as PostGIS: sqrt(dx^2 + dy^2) <= distance
+        d = self.xy[src] - self.xy[cand]
+        keep = np.sqrt(d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1]) <= distance
+        for s, c in zip(self.node_ids[src[keep]].tolist(), self.node_ids[cand[keep]].tolist()):
+            near[s].append(c)
+        return near
+
+    def near(self, node, distance, int_only=True):
+        # nodeids within distance of a single node
+        return self.pairs_within(distance, [node], int_only).get(node, [])
+
+
+class GroupExtents(object):
+    """
+    Point extents of node groups (ex. intersection nodes by master) for repeated distance checks
+    bounding boxes are computed for every group at once, exact pairwise distances only for groups whose
+    box diagonal is over the tolerance (and are cached, so other tolerances can be tried cheaply)
+     :groups param: {group id: [nodeid, ...]}
+     :node_coords param: {nodeid: (x, y)}
+    """
+    def __init__(self, groups, node_coords):
+        self.ids, sizes, xy = [], [], []
+        for group, nodes in groups.iteritems():
+            if len(nodes) > 1:
+                self.ids.append(group)
+                sizes.append(len(nodes))
+                xy.extend(node_coords[n] for n in nodes)
+        self.xy = np.array(xy, dtype=np.float64).reshape(-1, 2)
+        self.bounds = np.cumsum([0] + sizes)
+        if self.ids:
+            lo = np.minimum.reduceat(self.xy, self.bounds[:-1], axis=0)
+            hi = np.maximum.reduceat(self.xy, self.bounds[:-1], axis=0)
+            span = hi - lo
+            self.diagonal = np.sqrt(span[:, 0] * span[:, 0] + span[:, 1] * span[:, 1])
+        else:
+            self.diagonal = np.zeros(0)
+        self._diameter = dict()
+
+    def diameter(self, k, chunk=512):
+        # largest distance between 2 points of group k (position in self.ids)
+        if k not in self._diameter:
+            pts = self.xy[self.bounds[k]:self.bounds[k + 1]]
+            longest = 0.0
+            for i in xrange(0, len(pts), chunk):
+                d = pts[i:i + chunk, None, :] - pts[None, :, :]
+                longest = max(longest, np.sqrt(d[..., 0] * d[..., 0] + d[..., 1] * d[..., 1]).max())
+            self._diameter[k] = longest
+        return self._diameter[k]
+
+    def wider_than(self, tolerance):
+        # group ids with any 2 points more than tolerance apart (each group once)
+        return [self.ids[k] for k in np.flatnonzero(self.diagonal > tolerance).tolist()
+                if self.diameter(k) > tolerance]
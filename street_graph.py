@@ -0,0 +1,131 @@
+import numpy as np
+import street_names as sn
+
+
+class StreetGraph(object):
+    """
+    Non-directional graph of the included street network stored as CSR arrays
+    nodes are mapped to dense indexes (0..n-1), LION node ids are kept in node_ids
+     :node_ids param: LION nodeid for each node index (sorted)
+     :offsets param: half edges of node i are offsets[i]:offsets[i+1]
+     :targets param: node index at the other end of each half edge
+     :edges param: edge (LION row) index of each half edge
+     :half_streets param: street name id of each half edge
+     :segments param: LION segmentid of each edge
+     :streets param: street_names.StreetDictionary of the street name ids
+    """
+    def __init__(self, node_ids, offsets, targets, edges, half_streets, segments, streets):
+        self.node_ids = node_ids
+        self.offsets = offsets
+        self.targets = targets
+        self.edges = edges
+        self.half_streets = half_streets
+        self.segments = segments
+        self.streets = streets
+        self.index = dict((n, i) for i, n in enumerate(node_ids.tolist()))  # {nodeid: node index}
+
+    @classmethod
+    def from_rows(cls, rows):
+        # rows: (street, segmentid, nodeidfrom, nodeidto)
+        streets = sn.StreetDictionary()
+        segments, from_nodes, to_nodes, edge_streets = [], [], [], []
+        for street, segmentid, nodeidfrom, nodeidto in rows:
+            edge_streets.append(streets.id(street))
+            segments.append(segmentid)
+            from_nodes.append(int(nodeidfrom))
+            to_nodes.append(int(nodeidto))
+        n_edges = len(segments)
+        node_ids, inverse = np.unique(np.array(from_nodes + to_nodes, dtype=np.int64), return_inverse=True)
+        src, dst = inverse[:n_edges], inverse[n_edges:]
+        edge_streets = np.array(edge_streets, dtype=np.int32)
+        # each edge is stored once from each end
+        half_src = np.concatenate([src, dst])
+        half_dst = np.concatenate([dst, src])
+        half_edge = np.concatenate([np.arange(n_edges), np.arange(n_edges)])
+        # group half edges by source node, then street, so each street's neighbors are contiguous
+        order = np.lexsort((half_dst, edge_streets[half_edge], half_src))
+        offsets = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(half_src, minlength=len(node_ids)))
+        return cls(node_ids,
+                   offsets,
+                   half_dst[order].astype(np.int32),
+                   half_edge[order].astype(np.int32),
+                   edge_streets[half_edge[order]],
+                   np.array(segments),
+                   streets)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.node_ids, self.offsets, self.targets, self.edges,
+                                      self.half_streets, self.segments))
+
+    def neighbors(self, i):
+        # node indexes one step away from node i on any street
+        return self.targets[self.offsets[i]:self.offsets[i + 1]]
+
+    def streets_at(self, i):
+        # street name ids of the edges at node i
+        return np.unique(self.half_streets[self.offsets[i]:self.offsets[i + 1]])
+
+    def street_neighbors(self, i, street):
+        # node indexes one step away from node i along street (street name id)
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.targets[start:stop][self.half_streets[start:stop] == street]
+
+    def block_segments(self, nodes):
+        # segmentids of edges with both ends in nodes (node indexes)
+        members = set(nodes)
+        edges = set()
+        for n in members:
+            start, stop = self.offsets[n], self.offsets[n + 1]
+            for other, edge in zip(self.targets[start:stop].tolist(), self.edges[start:stop].tolist()):
+                if other in members:
+                    edges.add(edge)
+        return self.segments[sorted(edges)]
+
+    def mask(self, node_flags):
+        # {nodeid: bool} -> bool array by node index (missing nodes are False)
+        return np.array([bool(node_flags.get(n, False)) for n in self.node_ids.tolist()], dtype=bool)
+
+    def coords(self, node_coords):
+        # {nodeid: (x, y)} -> float array (n, 2) by node index (missing nodes are nan)
+        nan = (np.nan, np.nan)
+        return np.array([node_coords.get(n, nan) for n in self.node_ids.tolist()], dtype=np.float64)
+
+
+def find_triangles(street_graph, xy, is_int, nodes, max_dist):
+    """
+    Finds intersections that are connected to exactly 2 intersections within max_dist,
+    where those 2 intersections are also connected to each other
+     :street_graph param: StreetGraph
+     :xy param: float array (n, 2) of node coordinates by node index
+     :is_int param: bool array of intersection flags by node index
+     :nodes param: node indexes to start from
+     :max_dist param: edge length (straight line between nodes) must be less than this
+     :return: set of frozensets of node indexes
+    """
+    n = len(street_graph)
+    src = np.repeat(np.arange(n, dtype=np.int64), np.diff(street_graph.offsets))
+    tgt = street_graph.targets.astype(np.int64)
+    # every neighbor pair (any street), encoded as src * n + tgt and sorted
+    adjacent = np.unique(src * n + tgt)
+    # short edges to intersections
+    d = xy[src] - xy[tgt]
+    with np.errstate(invalid='ignore'):
+        short = is_int[tgt] & (np.sqrt(d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1]) < max_dist)
+    pairs = np.unique(src[short] * n + tgt[short])
+    s, t = pairs // n, pairs % n
+    # start nodes with exactly 2 distinct short intersection neighbors
+    counts = np.bincount(s, minlength=n)
+    start = np.asarray(nodes, dtype=np.int64)
+    start = start[counts[start] == 2]
+    first = np.searchsorted(s, start)
+    n1, n2 = t[first], t[first + 1]
+    # the 2 neighbors need to be connected to each other
+    pos = np.searchsorted(adjacent, n1 * n + n2)
+    pos[pos == len(adjacent)] = 0
+    closed = adjacent[pos] == n1 * n + n2
+    return set(frozenset(tri) for tri in zip(start[closed].tolist(), n1[closed].tolist(), n2[closed].tolist()))
@@ -0,0 +1,112 @@
+import csv
+import re
+
+
+# directional suffixes collapsed to ' DIR' to create better street name sets
+# order matters - it is the order the suffixes were always replaced in (' NORTH' before ' NORTHBOUND')
+SUFFIXES = (' NORTH', ' WEST', ' EB', ' NB', ' SB', ' EXIT', ' NORTHBOUND', ' EAST', ' APPROACH', ' ENTRANCE',
+            ' WB', ' SOUTHBOUND', ' WESTBOUND', ' EASTBOUND', ' SOUTH')
+# one pass with the alternatives in the same order gives the same result as replacing them one at a time
+SUFFIX_RE = re.compile('|'.join(re.escape(s) for s in SUFFIXES))
+
+# streets where the direction is the name
+EXCEPTIONS = frozenset([
+    'WEST STREET', 'SOUTH STREET', 'NORTH STREET', 'EAST STREET',
+    'WEST AVENUE', 'SOUTH AVENUE', 'NORTH AVENUE', 'EAST AVENUE',
+    'WEST BOULEVARD', 'SOUTH BOULEVARD', 'NORTH BOULEVARD', 'EAST BOULEVARD',
+    'WEST LOOP', 'SOUTH LOOP', 'NORTH LOOP', 'EAST LOOP',
+    'WEST DRIVE', 'SOUTH DRIVE', 'NORTH DRIVE', 'EAST DRIVE',
+    'WEST ROAD', 'SOUTH ROAD', 'NORTH ROAD', 'EAST ROAD',
+    'JUNIPER BOULEVARD NORTH', 'JUNIPER BOULEVARD SOUTH',
+    'PROSPECT PARK WEST', 'AVENUE N', 'AVENUE S', 'AVENUE E',
+    'AVENUE W'])
+
+
+def read_exceptions(path):
+    # street names to keep whole, first column of a csv/text file (blank lines and # comments skipped)
+    names = set()
+    with open(path, 'rb') as f:
+        for row in csv.reader(f):
+            if row and row[0].strip() and not row[0].startswith('#'):
+                names.add(row[0].strip().upper())
+    return names
+
+
+class StreetNameNormalizer(object):
+    """
+    Removes some precision in street names to create better sets (ex. 'BROADWAY NB' -> 'BROADWAY DIR')
+    results are cached by input name, LION only has a few thousand distinct names
+     :exceptions kwarg: names to leave as is, defaults to EXCEPTIONS
+    """
+    def __init__(self, exceptions=EXCEPTIONS):
+        self.exceptions = frozenset(exceptions)
+        self.cache = dict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_file(cls, path, defaults=True):
+        # exception list from a data file, added to the default exceptions unless defaults=False
+        names = read_exceptions(path)
+        if defaults:
+            names |= EXCEPTIONS
+        return cls(names)
+
+    def __call__(self, name):
+        try:
+            normalized = self.cache[name]
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            normalized = self.cache[name] = self.normalize(name)
+        return normalized
+
+    def normalize(self, name):
+        if not name or name in self.exceptions:
+            return name
+        return SUFFIX_RE.sub(' DIR', name)
+
+    def stats(self):
+        return '{} names normalized, {} cache hits, {} misses'.format(self.hits + self.misses, self.hits, self.misses)
+
+
+class StreetDictionary(object):
+    """
+    Interns street names as small integer ids (0..n-1) so name sets can be held as sorted int tuples
+     :names kwarg: names to add up front
+    """
+    def __init__(self, names=()):
+        self.ids = dict()  # {street name: id}
+        self.names = []  # street names by id
+        for name in names:
+            self.id(name)
+
+    def id(self, name):
+        # id for name, adds the name if it is new
+        sid = self.ids.get(name)
+        if sid is None:
+            sid = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return sid
+
+    def get(self, name, default=None):
+        return self.ids.get(name, default)
+
+    def name(self, sid):
+        return self.names[sid]
+
+    def key(self, names):
+        # hashable sorted tuple of ids for a collection of names
+        return tuple(sorted(self.id(name) for name in names))
+
+    def names_of(self, ids):
+        return [self.names[sid] for sid in ids]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __iter__(self):
+        return iter(self.names)
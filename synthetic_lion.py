@@ -0,0 +1,220 @@
+import os
+import math
+import params
+import RPL_importer as RPLi
+
+# state plane (ft) origin of the grid, roughly midtown so distances and srid behave like the real thing
+X0, Y0 = 980000.0, 190000.0
+RB_OFFSET = 20.0  # ft from a divided avenue's centerline to each roadbed
+
+
+def pad(value, width=7):
+    # LION keeps node and segment ids as zero padded text
+    return str(value).zfill(width)
+
+
+def line(*points):
+    return 'SRID={};LINESTRING({})'.format(params.SRID, ', '.join('{:.1f} {:.1f}'.format(x, y) for x, y in points))
+
+
+def polygon(x1, y1, x2, y2):
+    return 'SRID={0};MULTIPOLYGON((({1:.1f} {2:.1f}, {3:.1f} {2:.1f}, {3:.1f} {4:.1f}, {1:.1f} {4:.1f}, ' \
+           '{1:.1f} {2:.1f})))'.format(params.SRID, x1, y1, x2, y2)
+
+
+class SyntheticLion(object):
+    """
+    Grid street network laid out like LION (generic centerline + roadbeds) for benchmarks and test runs
+    streets run east-west, avenues north-south, every grid point is an intersection
+     :rows param: number of streets
+     :cols param: number of avenues
+     :spacing kwarg: ft between streets and between avenues
+     :divided_every kwarg: every nth avenue is divided (generic 'G' centerline + 2 'R' roadbeds linked in RPL), 0 = none
+     :ramp_every kwarg: every nth intersection on a divided avenue gets an exit ramp, 0 = none
+     :double_every kwarg: every nth street block gets a second segment with another name between the same nodes
+     :rename_every kwarg: every nth street changes name at its middle avenue (3 names meet there), 0 = none
+     :district_cells kwarg: grid cells per side of each precinct / district square
+    """
+    def __init__(self, rows, cols, spacing=300.0, divided_every=5, ramp_every=4, double_every=50, rename_every=7,
+                 district_cells=20):
+        self.rows = rows
+        self.cols = cols
+        self.spacing = spacing
+        self.divided_every = divided_every
+        self.ramp_every = ramp_every
+        self.double_every = double_every
+        self.rename_every = rename_every
+        self.district_cells = district_cells
+        self.segment_count = 0
+        self.node_count = 0
+
+    @classmethod
+    def from_segments(cls, segments, **kwargs):
+        # square grid with about this many centerline segments (2 per grid point)
+        side = max(2, int(round(math.sqrt(segments / 2.0))))
+        return cls(side, side, **kwargs)
+
+    def node_id(self, i, j):
+        return 1 + i * self.cols + j
+
+    def roadbed_node_ids(self, i, j):
+        # west and east roadbed nodes of a divided avenue, numbered after the grid nodes
+        n = self.node_id(i, j) + self.rows * self.cols
+        return 2 * n - 1, 2 * n
+
+    def ramp_node_id(self, i, j):
+        return self.node_id(i, j) + 5 * self.rows * self.cols
+
+    def xy(self, i, j):
+        return X0 + j * self.spacing, Y0 + i * self.spacing
+
+    def divided(self, j):
+        return bool(self.divided_every) and j % self.divided_every == self.divided_every - 1
+
+    def street_name(self, i, j):
+        # name of street i east of avenue j, renamed streets change name at the middle avenue
+        if self.rename_every and i % self.rename_every == 0 and j >= self.cols // 2:
+            return 'SYN {} BOULEVARD'.format(i + 1)
+        return 'SYN {} STREET'.format(i + 1)
+
+    def avenue_name(self, j):
+        return 'SYN {} AVENUE'.format(j + 1)
+
+    def segments(self):
+        """
+        LION rows, segment ids are numbered as they are generated
+         :return: generator of (segmentid, street, featuretyp, rb_layer, nonped, trafdir, rw_type, segmenttyp,
+                  nodeidfrom, nodeidto, nodelevelf, nodelevelt, lboro, rboro, geom) and RPL links
+                  as ('rpl', segmentidg, segmentidr, g_frnd, g_tond, r_frnd, r_tond)
+        """
+        seg = 0
+        for i in xrange(self.rows):
+            for j in xrange(self.cols):
+                x, y = self.xy(i, j)
+                node = self.node_id(i, j)
+                if j + 1 < self.cols:
+                    # street block to the east
+                    seg += 1
+                    other = self.node_id(i, j + 1)
+                    yield (pad(seg), self.street_name(i, j), '0', 'B', None, 'T', '1', 'U', pad(node), pad(other),
+                           'M', 'M', 1, 1, line((x, y), (x + self.spacing, y)))
+                    if self.double_every and seg % self.double_every == 0:
+                        # service road sharing both nodes
+                        seg += 1
+                        yield (pad(seg), 'SYN {} SERVICE ROAD'.format(i + 1), '0', 'B', None, 'T', '1', 'U',
+                               pad(node), pad(other), 'M', 'M', 1, 1,
+                               line((x, y), (x + self.spacing / 2, y + 15), (x + self.spacing, y)))
+                if i + 1 < self.rows:
+                    # avenue block to the north
+                    other = self.node_id(i + 1, j)
+                    seg += 1
+                    if not self.divided(j):
+                        yield (pad(seg), self.avenue_name(j), '0', 'B', None, 'T', '1', 'U', pad(node), pad(other),
+                               'M', 'M', 1, 1, line((x, y), (x, y + self.spacing)))
+                        continue
+                    generic = seg
+                    yield (pad(generic), self.avenue_name(j), '0', 'G', None, 'T', '1', 'U', pad(node), pad(other),
+                           'M', 'M', 1, 1, line((x, y), (x, y + self.spacing)))
+                    for side, offset in ((0, -RB_OFFSET), (1, RB_OFFSET)):
+                        seg += 1
+                        frm, to = self.roadbed_node_ids(i, j)[side], self.roadbed_node_ids(i + 1, j)[side]
+                        yield (pad(seg), self.avenue_name(j), '0', 'R', None, 'W' if side else 'A', '1', 'R',
+                               pad(frm), pad(to), 'M', 'M', 1, 1,
+                               line((x + offset, y), (x + offset, y + self.spacing)))
+                        yield ('rpl', generic, seg, node, other, frm, to)
+                if self.divided(j) and self.ramp_every and i % self.ramp_every == 0 and j + 1 < self.cols:
+                    # exit ramp off the divided avenue, dead ends into the middle of the block
+                    seg += 1
+                    yield (pad(seg), '{} EXIT {}'.format(self.avenue_name(j), i + 1), '0', 'B', 'V', 'W', '9', 'E',
+                           pad(node), pad(self.ramp_node_id(i, j)), 'M', 'M', 1, 1,
+                           line((x, y), (x + self.spacing / 2, y + self.spacing / 3)))
+        self.segment_count = seg
+
+    def nodes(self):
+        # (nodeid, vintersect, geom) of grid, roadbed and ramp nodes
+        for i in xrange(self.rows):
+            for j in xrange(self.cols):
+                x, y = self.xy(i, j)
+                yield self.node_id(i, j), None, 'SRID={};POINT({:.1f} {:.1f})'.format(params.SRID, x, y)
+                if self.divided(j):
+                    for node, offset in zip(self.roadbed_node_ids(i, j), (-RB_OFFSET, RB_OFFSET)):
+                        yield node, None, 'SRID={};POINT({:.1f} {:.1f})'.format(params.SRID, x + offset, y)
+                    if self.ramp_every and i % self.ramp_every == 0 and j + 1 < self.cols:
+                        yield self.ramp_node_id(i, j), None, 'SRID={};POINT({:.1f} {:.1f})'.format(
+                            params.SRID, x + self.spacing / 2, y + self.spacing / 3)
+
+    def districts(self, cells):
+        # (district number, geom) squares of cells x cells grid blocks covering the grid (with a margin)
+        size = cells * self.spacing
+        n = 0
+        for bi in xrange(int(math.ceil(self.rows / float(cells))) or 1):
+            for bj in xrange(int(math.ceil(self.cols / float(cells))) or 1):
+                n += 1
+                x1, y1 = X0 - self.spacing / 2 + bj * size, Y0 - self.spacing / 2 + bi * size
+                yield n, polygon(x1, y1, x1 + size, y1 + size)
+
+    def rpl_line(self, segmentidg, segmentidr, g_frnd, g_tond, r_frnd, r_tond):
+        # 1 RPL.txt record (RPL_importer field positions)
+        rec = [' '] * RPLi.RECORD_WIDTH
+        for column, value in (('segmentidg', segmentidg), ('segmentidr', segmentidr), ('r_frnd', r_frnd),
+                              ('g_frnd', g_frnd), ('r_tond', r_tond), ('g_tond', g_tond)):
+            start, stop = [(s, e) for c, s, e in RPLi.NUMERIC_FIELDS if c == column][0]
+            rec[start:stop] = pad(value, stop - start)
+        for column, value in (('rpc', 'R'), ('nci', 'N'), ('nodelevelf', 'M'), ('nodelevelt', 'M')):
+            rec[dict(RPLi.CHAR_FIELDS)[column]] = value
+        return ''.join(rec) + '\n'
+
+    def load(self, dbo, schema, folder, lion=params.LION, node=params.NODE, rpl=params.RPL_TXT):
+        """
+        Writes the network to schema (replacing lion, node, tbl_rpl, the district tables, the precinct table and
+        altnames) the way setup_database leaves them before add_clion_columns, RPL.txt is written to folder
+         :return: (segments, nodes)
+        """
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        dbo.batch([
+            "drop table if exists {s}.{l} cascade".format(s=schema, l=lion),
+            """create table {s}.{l} (
+                ogc_fid serial primary key, segmentid varchar(7), street varchar(40), featuretyp varchar(1),
+                rb_layer varchar(1), nonped varchar(1), trafdir varchar(1), rw_type varchar(2),
+                segmenttyp varchar(1), nodeidfrom varchar(7), nodeidto varchar(7), nodelevelf varchar(1),
+                nodelevelt varchar(1), lboro numeric, rboro numeric, geom geometry(LineString, {srid})
+            )""".format(s=schema, l=lion, srid=params.SRID),
+            "drop table if exists {s}.{n} cascade".format(s=schema, n=node),
+            """create table {s}.{n} (
+                ogc_fid serial primary key, nodeid int, vintersect varchar(32), geom geometry(Point, {srid})
+            )""".format(s=schema, n=node, srid=params.SRID),
+            "drop table if exists {s}.altnames".format(s=schema),
+            "create table {s}.altnames (join_id varchar(10), street varchar(40))".format(s=schema)
+        ])
+        columns = ['segmentid', 'street', 'featuretyp', 'rb_layer', 'nonped', 'trafdir', 'rw_type', 'segmenttyp',
+                   'nodeidfrom', 'nodeidto', 'nodelevelf', 'nodelevelt', 'lboro', 'rboro', 'geom']
+        with open(os.path.join(folder, rpl), 'w') as rpl_file:
+            def lion_rows():
+                for row in self.segments():
+                    if row[0] == 'rpl':
+                        rpl_file.write(self.rpl_line(*row[1:]))
+                    else:
+                        yield row
+            dbo.copy_rows('{}.{}'.format(schema, lion), lion_rows(), columns)
+        self.node_count = dbo.copy_rows('{}.{}'.format(schema, node), self.nodes(), ['nodeid', 'vintersect', 'geom'])
+        RPLi.run(dbo, folder, rpl)
+        # renamed streets are aliases of each other
+        dbo.copy_rows('{}.altnames'.format(schema),
+                      [(pad(i, 10), name) for i in xrange(0, self.rows, self.rename_every or self.rows + 1)
+                       for name in ('SYN {} STREET'.format(i + 1), 'SYN {} BOULEVARD'.format(i + 1))])
+        # district layers (field names as add_districts expects) and the precinct table
+        layers = [('nycc', 'coundist', 2), ('nynta', 'ntacode', 3), ('nypp', 'precinct', 1), ('nyss', 'stsendist', 4)]
+        for table, field, scale in layers:
+            dbo.batch(["drop table if exists {s}.{t}".format(s=schema, t=table),
+                       "create table {s}.{t} (ogc_fid serial primary key, {f} {typ}, geom geometry(MultiPolygon, {srid}))"
+                       .format(s=schema, t=table, f=field, typ='varchar(10)' if field == 'ntacode' else 'int',
+                               srid=params.SRID)])
+            dbo.copy_rows('{}.{}'.format(schema, table),
+                          (('SY{:02d}'.format(n) if field == 'ntacode' else n, geom)
+                           for n, geom in self.districts(self.district_cells * scale)), [field, 'geom'])
+        dbo.batch(["drop table if exists {p}".format(p=params.PRECINCTS),
+                   "create table {p} as select precinct, geom from {s}.nypp".format(p=params.PRECINCTS, s=schema)])
+        print 'Synthetic LION: {} x {} grid, {} segments, {} nodes'.format(
+            self.rows, self.cols, self.segment_count, self.node_count)
+        return self.segment_count, self.node_count
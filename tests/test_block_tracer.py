@@ -0,0 +1,76 @@
+import random
+import street_graph as sg
+import block_tracer as bt
+
+
+def old_go_to_end(street, done, todo, is_int, street_graph):
+    # the recursive tracer block_tracer replaced
+    if len(todo) == 0:
+        return done
+    start = todo.pop()
+    done.append(start)
+    if not is_int[start]:
+        for i in street_graph.street_neighbors(start, street).tolist():
+            if i not in done:
+                todo.add(i)
+    return old_go_to_end(street, done, todo, is_int, street_graph)
+
+
+def old_search(street_graph, is_int):
+    # the search loop before trace_blocks, every block is found from both ends -> [(street, nodes)]
+    street_set = []
+    for start in xrange(len(street_graph)):
+        if is_int[start]:
+            for street in street_graph.streets_at(start).tolist():
+                queue = street_graph.street_neighbors(start, street).tolist()
+                while len(queue) > 0:
+                    street_set.append((street, old_go_to_end(street, [start], {queue.pop()}, is_int, street_graph)))
+    return street_set
+
+
+def grid(rows, cols, rnd):
+    # streets east-west, avenues north-south with gaps (mid block and dead end nodes), doubled segments
+    # and service roads between the same nodes
+    out, seg = [], 0
+    for i in xrange(rows):
+        for j in xrange(cols):
+            node = i * cols + j
+            if j + 1 < cols and rnd.random() > 0.1:
+                seg += 1
+                out.append(('S {}'.format(i), seg, node, node + 1))
+                if rnd.random() < 0.05:
+                    seg += 1
+                    out.append(('S {}'.format(i), seg, node, node + 1))
+                if rnd.random() < 0.05:
+                    seg += 1
+                    out.append(('S {} SERVICE ROAD'.format(i), seg, node, node + 1))
+            if i + 1 < rows and rnd.random() > 0.4:
+                seg += 1
+                out.append(('A {}'.format(j), seg, node, node + cols))
+    return out
+
+
+def intersections(street_graph):
+    # nodes where more than 1 street meets
+    return [len(street_graph.streets_at(i)) > 1 for i in xrange(len(street_graph))]
+
+
+def test_trace_blocks_matches_recursive_tracer():
+    rnd = random.Random(3)
+    for _ in xrange(30):
+        graph = sg.StreetGraph.from_rows(grid(8, 9, rnd))
+        is_int = intersections(graph)
+        new = [tuple(sorted(block.tolist())) for block in bt.trace_blocks(graph, is_int)]
+        old = set((street, tuple(sorted(block))) for street, block in old_search(graph, is_int))
+        # same blocks, each traced once per street (2 streets between the same nodes are 2 blocks)
+        assert set(new) == set(block for street, block in old)
+        assert len(new) == len(old)
+
+
+def test_trace_blocks_order():
+    # 1(i) - 2 - 3 - 4(i) - 5 along A ST, B AVE crosses at 1 and 4
+    rows = [('A ST', 1, 1, 2), ('A ST', 2, 2, 3), ('A ST', 3, 3, 4), ('A ST', 4, 4, 5),
+            ('B AVE', 5, 1, 6), ('B AVE', 6, 4, 7)]
+    graph = sg.StreetGraph.from_rows(rows)
+    blocks = [graph.node_ids[block].tolist() for block in bt.trace_blocks(graph, intersections(graph))]
+    assert sorted(blocks) == [[1, 2, 3, 4], [1, 6], [4, 5], [4, 7]]
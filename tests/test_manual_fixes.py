@@ -0,0 +1,62 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import pytest
+
+pytest.importorskip('psycopg2')
+try:
+    import params
+except SyntaxError:  # params.py still has the connection settings to fill in
+    pytest.skip('params.py is not filled in', allow_module_level=True)
+CLION = pytest.importorskip('CLION')
+
+output = namedtuple('output', ['data', 'columns'])
+
+FIXES = """table,where_field,where_value,update_field,update_value,comment
+lion,segmentid,0001234,street,BROADWAY,name
+lion,segmentid,0001234,nodeidto,17,wrong node
+rpl,segmentid,0005678,street,5 AVENUE,
+lion,segmentid,0001234,street,WEST BROADWAY,name was still wrong
+lion,ogc_fid,12,street,,unnamed
+"""
+
+
+class FixDb(object):
+    # the manual_fix_list a manual_fixes run loads
+    def __init__(self):
+        self.rows = None
+
+    def copy_to_temp(self, table_name, columns, rows, key=None):
+        self.rows = list(rows)
+        return len(self.rows)
+
+    @contextmanager
+    def transaction(self):
+        yield self
+
+    def column_type(self, schema, table_name, column):
+        return 'text'
+
+    def query(self, qry):
+        return output([], None)
+
+
+@pytest.fixture
+def fix_file(tmpdir):
+    path = tmpdir.join('manual_fixes.csv')
+    path.write(FIXES)
+    return str(path)
+
+
+def test_read_manual_fixes(fix_file):
+    fixes = CLION.read_manual_fixes(fix_file)
+    assert [fix[0] for fix in fixes] == [1, 2, 3, 4, 5]
+    assert fixes[4] == (5, 'lion', 'ogc_fid', '12', 'street', None, 'unnamed')
+
+
+def test_a_later_fix_of_the_same_field_overrides_the_earlier_one(fix_file):
+    fixes = CLION.latest_fixes(CLION.read_manual_fixes(fix_file))
+    # fix 1 sets the same street as fix 4, the other field and the other table are kept
+    assert [fix[0] for fix in fixes] == [2, 3, 4, 5]
+    db = FixDb()
+    CLION.manual_fixes(db, fix_file, 'w', 'lion', 'rpl')
+    assert db.rows == fixes
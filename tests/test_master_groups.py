@@ -0,0 +1,82 @@
+import random
+from collections import defaultdict
+import master_groups
+
+
+def old_merge_masters(nodes_to_merge, node_master, master_node):
+    # CLION.merge_masters before MasterGroups
+    masters_to_merge = [node_master[n] for n in nodes_to_merge]
+    new_master = masters_to_merge[0]
+    all_nodes_to_merge = list()
+    for n in [master_node[m] for m in masters_to_merge]:
+        all_nodes_to_merge += n
+    for n in all_nodes_to_merge:
+        node_master[n] = new_master
+    for m in masters_to_merge:
+        if m != new_master:
+            master_node[new_master] = master_node[new_master] + master_node[m]
+            del master_node[m]
+    return node_master, master_node
+
+
+def old_split(master, node_groups, node_master, master_node):
+    # the split in CLION.update_problem_groups before MasterGroups
+    del master_node[master]
+    for nodes in node_groups:
+        mx = max(master_node.keys()) + 1
+        for node in nodes:
+            node_master[node] = mx
+            master_node[mx].append(node)
+
+
+def start(n_nodes, n_masters, rnd):
+    node_master = dict((node, rnd.randint(1, n_masters)) for node in xrange(n_nodes))
+    master_node = defaultdict(list)
+    for node, master in sorted(node_master.iteritems()):
+        master_node[master].append(node)
+    return node_master, master_node, master_groups.MasterGroups().load(node_master)
+
+
+def same(node_master, master_node, masters):
+    assert dict(masters.items()) == node_master
+    assert dict((m, sorted(nodes)) for m, nodes in masters.groups().iteritems()) == \
+        dict((m, sorted(nodes)) for m, nodes in master_node.iteritems())
+    assert sorted(masters.masters()) == sorted(master_node)
+
+
+def test_union_matches_merge_masters():
+    rnd = random.Random(1)
+    for _ in xrange(20):
+        node_master, master_node, masters = start(200, 60, rnd)
+        for _ in xrange(100):
+            picked, seen = [], set()
+            # the old merge fails on 2 nodes of the same master, so 1 node per master
+            for node in rnd.sample(xrange(200), rnd.randint(2, 4)):
+                if node_master[node] not in seen:
+                    seen.add(node_master[node])
+                    picked.append(node)
+            old_merge_masters(picked, node_master, master_node)
+            assert masters.union(picked) == node_master[picked[0]]
+        same(node_master, master_node, masters)
+
+
+def test_split_matches_old_split():
+    rnd = random.Random(2)
+    for _ in xrange(20):
+        node_master, master_node, masters = start(200, 40, rnd)
+        for _ in xrange(30):
+            master = rnd.choice(sorted(master_node))
+            nodes = list(master_node[master])
+            rnd.shuffle(nodes)
+            cut = sorted(rnd.sample(xrange(1, len(nodes)), min(2, len(nodes) - 1))) if len(nodes) > 1 else []
+            groups = [nodes[i:j] for i, j in zip([0] + cut, cut + [len(nodes)])]
+            old_split(master, groups, node_master, master_node)
+            out = masters.split(master, groups)
+            assert [nodes for m, nodes in out] == groups
+            for m, nodes in out:
+                assert all(node_master[n] == m for n in nodes)
+            # merges after splits still agree
+            a, b = rnd.sample(sorted(master_node), 2)
+            old_merge_masters([master_node[a][0], master_node[b][0]], node_master, master_node)
+            masters.union([masters.groups()[a][0], masters.groups()[b][0]])
+        same(node_master, master_node, masters)
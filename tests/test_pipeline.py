@@ -0,0 +1,241 @@
+import re
+from collections import namedtuple
+from datetime import datetime
+import pytest
+
+pytest.importorskip('psycopg2')
+try:
+    import params
+except SyntaxError:  # params.py still has the connection settings to fill in
+    pytest.skip('params.py is not filled in', allow_module_level=True)
+import pipeline
+
+output = namedtuple('output', ['data', 'columns'])
+
+
+class RunStateDb(object):
+    # the run state table of a Pipeline in memory
+    plan_log = None
+
+    def __init__(self):
+        self.rows = []  # (run_id, stage, position, status, started, finished, checkpoint, error)
+
+    def query(self, qry):
+        run_id = re.findall(r"run_id = '(.*?)'", qry)
+        if qry.startswith('delete'):
+            stage = re.findall(r"stage = '(.*?)'", qry)[0]
+            self.rows = [r for r in self.rows if (r[0], r[1]) != (run_id[0], stage)]
+        elif 'order by started desc' in qry:
+            return output([(r[0],) for r in sorted(self.rows, key=lambda r: r[4], reverse=True)[:1]], None)
+        elif qry.startswith('select stage, status, finished, checkpoint'):
+            return output([(r[1], r[3], r[5], r[6]) for r in self.rows if r[0] == run_id[0]], None)
+        elif qry.startswith('select stage, status, checkpoint'):
+            return output([(r[1], r[3], r[6]) for r in self.rows if r[0] == run_id[0]], None)
+        return output(None, None)
+
+    def copy_rows(self, table_name, rows, columns=None):
+        self.rows.extend(rows)
+        return len(rows)
+
+
+S = pipeline.Stage
+
+
+def test_dependencies():
+    stages = [S('load', None, writes=['lion']),
+              S('read', None, reads=['lion'], writes=['blocks']),
+              S('rewrite', None, reads=['lion'], writes=['lion']),
+              S('columns', None, reads=['lion'], writes=['lion.corridor']),
+              S('lookup', None, reads=['lion']),
+              S('corridor', None, reads=['lion.corridor']),
+              S('memory', None, writes=['params.streetSet']),
+              S('memory2', None, reads=['params.streetSet'], writes=['ctx.x'])]
+    deps = pipeline.dependencies(stages)
+    assert deps['load'] == set()
+    assert deps['read'] == {'load'}  # read after write
+    assert deps['rewrite'] == {'load', 'read'}  # write after write, write after read
+    assert deps['columns'] == {'load', 'rewrite'}
+    # a column group write leaves stages that only read the rest of the table alone
+    assert deps['lookup'] == {'load', 'rewrite'}
+    assert deps['corridor'] == {'load', 'rewrite', 'columns'}
+    assert deps['memory2'] == {'memory'}
+
+
+def test_clion_stages_are_in_dependency_order():
+    CLION = pytest.importorskip('CLION')
+    stages = CLION.stages()
+    deps = pipeline.dependencies(stages)
+    position = dict((stage.name, i) for i, stage in enumerate(stages))
+    for name, before in deps.iteritems():
+        assert all(position[b] < position[name] for b in before)
+    # the street name limit only touches lion, so with workers the clustering stages can finish before it
+    for name in ('intersection_cluster_dict', 'subset_merge_with_superset', 'master_intersection_first_pass',
+                 'distance_check_data'):
+        assert 'update_blocks_limit_to_1_street_name' not in deps[name]
+
+
+@pytest.fixture
+def state(monkeypatch):
+    monkeypatch.setattr(params, 'streetSet', [])
+    return params.streetSet
+
+
+def clustering_stages(calls, fail):
+    # the shape of blocks -> limit to 1 street name / clustering -> split distant masters in CLION
+    def blocks(ctx):
+        calls.append('blocks')
+        params.streetSet[:] = [1, 2]
+
+    def limit(ctx):
+        calls.append('limit')
+        if fail:
+            raise ValueError('limit failed')
+
+    def cluster(ctx):
+        calls.append('cluster')
+        ctx['masters'] = len(params.streetSet)
+
+    def dist(ctx):
+        calls.append('dist')
+        ctx['coords'] = 'xy'
+
+    def split(ctx):
+        calls.append('split')
+        assert (ctx['masters'], ctx['coords']) == (2, 'xy')
+
+    return [S('blocks', blocks, writes=['params.streetSet']),
+            S('limit', limit, reads=['lion'], writes=['lion']),
+            S('cluster', cluster, reads=['params.streetSet'], writes=['ctx.masters']),
+            S('dist', dist, reads=['node'], writes=['ctx.coords']),
+            S('split', split, reads=['lion', 'ctx.masters', 'ctx.coords'], writes=['ctx.masters'])]
+
+
+def finish_out_of_order(pipe, names):
+    # the order a run with workers can finish them in
+    pipe.setup()
+    pipe.run_id = 'run1'
+    pipe.t0 = 0
+    for name in names:
+        stage = pipe.stages[pipe.position[name]]
+        try:
+            pipe.run_stage(stage)
+        except ValueError:
+            pass
+
+
+def test_resume_restores_the_last_finished_checkpoint(state, tmpdir):
+    db, calls = RunStateDb(), []
+    first = pipeline.Pipeline(clustering_stages(calls, True), {'db': db}, 'w', str(tmpdir), ['streetSet'])
+    finish_out_of_order(first, ['blocks', 'cluster', 'dist', 'limit'])
+    assert first.status('run1')['limit'][0] == 'failed'
+    # new process
+    del state[:], calls[:]
+    again = pipeline.Pipeline(clustering_stages(calls, False), {'db': db}, 'w', str(tmpdir), ['streetSet'])
+    ctx = again.run(resume=True)
+    assert calls == ['limit', 'split']
+    assert state == [1, 2] and ctx['masters'] == 2 and ctx['coords'] == 'xy'
+
+
+def test_only_reruns_in_memory_stages_that_finished_later(state, tmpdir):
+    db, calls = RunStateDb(), []
+    first = pipeline.Pipeline(clustering_stages(calls, False), {'db': db}, 'w', str(tmpdir), ['streetSet'])
+    finish_out_of_order(first, ['blocks', 'cluster', 'dist', 'limit', 'split'])
+    del state[:], calls[:]
+    again = pipeline.Pipeline(clustering_stages(calls, False), {'db': db}, 'w', str(tmpdir), ['streetSet'])
+    ctx = again.run(only=['cluster'])
+    # dist and split finished after cluster, their checkpoints hold cluster's result
+    assert calls == ['cluster', 'dist', 'split']
+    assert state == [1, 2] and ctx['masters'] == 2
+
+
+def test_start_from_restored_state(state, tmpdir):
+    db, calls = RunStateDb(), []
+    state[:] = [1, 2]
+    pipe = pipeline.Pipeline(clustering_stages(calls, False), {'db': db, 'masters': 2, 'coords': 'xy'}, 'w',
+                             str(tmpdir), ['streetSet'])
+    pipe.run(start='split')
+    assert calls == ['split']
+    status = pipe.status(pipe.run_id)
+    assert all(s == 'done' for s, ckpt in status.itervalues())
+    # the restored state is checkpointed under the last in memory stage before the start
+    assert status['dist'][1] and not status['cluster'][1]
+
+
+def test_critical_path():
+    stages = [S('a', None, writes=['x']), S('b', None, reads=['x'], writes=['y']),
+              S('c', None, reads=['x'], writes=['z']), S('d', None, reads=['y', 'z'])]
+    pipe = pipeline.Pipeline(stages, {'db': None}, 'w', '/tmp')
+    pipe.timings = {'a': (0, 2.0), 'b': (2, 1.0), 'c': (2, 5.0), 'd': (7, 1.0)}
+    pipe.wall = 8.0
+    assert pipe.critical_path() == (8.0, ['a', 'c', 'd'])
+    pipe.timings = {'b': (0, 1.0), 'c': (0, 3.0)}  # a and d not run
+    assert pipe.critical_path() == (3.0, ['c'])
+    pipe.timings = {}
+    assert pipe.critical_path() == (0, [])
+    assert 'critical path' in pipe.report()
+
+
+class WorkerConn(object):
+    closed = 0
+
+    def __init__(self):
+        self.open = False  # idle in a transaction
+
+    def commit(self):
+        self.open = False
+
+    def rollback(self):
+        self.open = False
+
+
+class WorkerDb(object):
+    plan_log = None
+
+    def __init__(self):
+        self.conn = WorkerConn()
+        self.closed = False
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def dbClose(self):
+        self.closed = True
+
+
+class WorkerPool(object):
+    pools = []
+
+    def __init__(self, dbo, size=4):
+        self.dbs = [WorkerDb() for _ in xrange(size)]
+        WorkerPool.pools.append(self)
+
+    def close(self):
+        for db in self.dbs:
+            db.dbClose()
+
+
+def test_concurrent_connections_come_back_without_a_transaction(tmpdir, monkeypatch):
+    monkeypatch.setattr(pipeline.db2, 'PostgresPool', WorkerPool)
+    calls = []
+
+    def select(name, fail=False):
+        # like distance_check_data, a stage ending in a select leaves its connection in a transaction
+        def func(ctx):
+            calls.append(name)
+            assert not ctx['db'].conn.open, '{} got a connection idle in a transaction'.format(name)
+            ctx['db'].conn.open = True
+            if fail:
+                raise ValueError('{} failed'.format(name))
+        return func
+
+    stages = [S('a', select('a'), reads=['node'], writes=['x']),
+              S('b', select('b'), reads=['x'], writes=['y']),
+              S('c', select('c'), reads=['y'], writes=['z']),
+              S('d', select('d', True), reads=['z'])]
+    pipe = pipeline.Pipeline(stages, {'db': RunStateDb()}, 'w', str(tmpdir))
+    with pytest.raises(ValueError):
+        pipe.run(workers=2)
+    assert calls == ['a', 'b', 'c', 'd']
+    assert pipe.status(pipe.run_id)['d'][0] == 'failed'
+    dbs = WorkerPool.pools[-1].dbs
+    assert all(not db.conn.open and db.closed for db in dbs)